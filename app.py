@@ -1,10 +1,47 @@
-from flask import Flask, render_template, request, session, redirect, url_for, jsonify
+from flask import Flask, render_template, request, session, redirect, url_for, jsonify, g, stream_with_context, has_request_context
 import os
 import sqlite3
 import random
 import string
 import json
+import base64
+import threading
+import time
+import hashlib
+import csv
+import io
+import zipfile
+import re
+import tempfile
+import shutil
+import secrets
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import functools
+import itertools
+import math
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from werkzeug.datastructures import FileStorage
+from flask.cli import AppGroup
+import click
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
 import bcrypt
+import gzip
+import cProfile
+from werkzeug.security import safe_join
+
+try:
+    from PIL import Image, features
+except ImportError: # image variants are skipped without Pillow, uploads still work
+    Image = None
+
+try:
+    import brotli
+except ImportError: # only gzip is offered without it
+    brotli = None
 
 app = Flask(__name__, static_url_path='/static')
 app.secret_key = 'BAD_SECRET_KEY'
@@ -13,44 +50,1933 @@ app.secret_key = 'BAD_SECRET_KEY'
 app.config['PERMANENT_SESSION_LIFETIME'] = 900 # session expiry time
 app.config['SESSION_REFRESH_EACH_REQUEST'] = True # reloads expiry time after every request
 app.config['UPLOAD_EXTENSIONS'] = ['.jpg', '.jpeg', '.png', '.gif'] # specifies file extensions for uploads
+app.config['UPLOAD_FOLDER'] = 'static/uploads'
+app.config['UPLOAD_CACHE_CONTROL'] = 'public, max-age=31536000, immutable' # upload names never change content
+app.config['UPLOAD_SPOOL_FOLDER'] = os.path.join(app.root_path, 'spool') # uploads wait here, outside static/, until a worker has checked them
+app.config['IMAGE_VARIANT_WIDTHS'] = [160, 320, 640] # thumbnail widths, the original width is always added
+app.config['IMAGE_VARIANT_FORMATS'] = ['avif', 'webp'] # skipped if this Pillow build can't write them
+app.config['UPLOAD_WORKERS'] = 2 # background threads processing uploaded images
+app.config['UPLOAD_JOB_LEASE'] = 300 # seconds before a 'running' upload job is assumed abandoned
+app.config['UPLOAD_JOB_ATTEMPTS'] = 3
+
+app.config['IMPORT_BATCH_SIZE'] = 1000 # rows per executemany() in a bulk import
+app.config['IMPORT_MAX_ERRORS'] = 1000 # row errors reported in full, the rest are only counted
+app.config['IMPORT_MAX_IMAGE_SIZE'] = 20 * 1024 * 1024 # bytes, larger archive members are rejected unread
+
+app.config['ORDER_PROCESSOR'] = 'stub' # payment/fulfilment backend, a key of order_processors
+app.config['ORDER_JOB_BATCH'] = 50 # orders claimed per worker round, their outcomes commit together
+app.config['ORDER_JOB_LEASE'] = 300 # seconds before a 'running' order job is assumed abandoned
+app.config['ORDER_JOB_ATTEMPTS'] = 5 # tries per step before the order is given up on
+app.config['ORDER_JOB_BACKOFF'] = 30 # seconds before the first retry, doubled every attempt
+app.config['ORDER_WORKER_INTERVAL'] = 5 # seconds flask fulfil-orders --watch sleeps on an empty queue
+app.config['STUB_PROCESSOR_DELAY'] = 0 # seconds the stub processor spends on each step
+app.config['STUB_PROCESSOR_FAILURE_RATE'] = 0 # fraction of stub steps that fail and get retried
+app.config['STUB_PAYMENT_LIMIT'] = None # pence, the stub declines orders costing more
+
+app.config['STOCK_LEDGER'] = True # checkouts append to stockmovements in group commits and only bump products.version when compacted, so the cached catalog survives them; False takes stock off products in each checkout's own transaction
+app.config['STOCK_COMMIT_BATCH'] = 64 # max checkouts sharing one transaction
+app.config['STOCK_COMPACT_INTERVAL'] = 5 # seconds between folding the ledger into products.stock, which is what pages show
+app.config['STOCK_VIEW_TTL'] = 1 # seconds basket clamping trusts this worker's copy of a stock level, checkout re-checks anyway
+app.config['STOCK_VIEW_ENTRIES'] = 4096
+
+app.config['BCRYPT_ROUNDS'] = 12 # work factor for new hashes; older hashes are upgraded on login
+app.config['PASSWORD_WORKERS'] = 2 # bcrypt processes per app process, 0 hashes inline
+app.config['PASSWORD_QUEUE_MAX'] = 16 # hashes in flight before logins are turned away
+app.config['PASSWORD_TIMEOUT'] = 10 # seconds a login waits on the hashing pool
+app.config['LOGIN_RATE_IP'] = (10, 0.2) # token bucket (capacity, tokens per second) per client ip
+app.config['LOGIN_RATE_USERNAME'] = (5, 0.05) # per username, so one account can't be brute forced from many ips
+
+app.config['DATABASE'] = 'app.db'
+app.config['ASYNC_VIEWS'] = os.environ.get('STORE_ASYNC_VIEWS') == '1' # opt-in, storefront reads become coroutines with their sqlite work on db_executor
+app.config['DB_POOL_SIZE'] = 8 # max connections held open per worker process
+app.config['DB_POOL_TIMEOUT'] = 5 # seconds a request waits for a free connection
+app.config['DB_EXECUTOR_WORKERS'] = app.config['DB_POOL_SIZE'] # threads running sqlite work for async views
+app.config['ASGI_WSGI_THREADS'] = app.config['DB_POOL_SIZE'] # requests asgi.py runs at once, each holds at most one pooled connection
+app.config['DB_BUSY_RETRIES'] = 5 # extra attempts for a write transaction that hits SQLITE_BUSY
+app.config['DB_BUSY_BACKOFF'] = 0.05 # seconds, doubled on every retry
+app.config['DB_PRAGMAS'] = { # applied once when a pooled connection is opened
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -8000, # negative = KiB, so ~8MB page cache
+    'mmap_size': 67108864,
+    'busy_timeout': 5000,
+}
+
+app.config['CATALOG_CACHE_TTL'] = 60 # seconds a cached /api/products body is served for, 0 disables the cache
+app.config['CATALOG_CACHE_SHARED'] = False # check a version counter in the db so every worker sees invalidations
+app.config['CATALOG_CACHE_ENTRIES'] = 256 # max cached page variants per worker
+app.config['PRODUCT_FRAGMENT_ENTRIES'] = 1024 # rendered product page bodies kept per worker
+app.config['TEMPLATE_CACHE_FOLDER'] = os.path.join(app.root_path, '.jinja_cache') # compiled templates shared by workers, None to disable
+app.config['PRODUCTS_PAGE_DEFAULT'] = 100 # /api/products page size when no limit is given
+app.config['PRODUCTS_PAGE_MAX'] = 500
+app.config['HOME_PAGE_SIZE'] = 24 # grid products rendered into home.html, keep in step with PRODUCT_PAGE_SIZE in script.js
+app.config['HOME_PRELOAD_IMAGES'] = 4 # the first row's images get preload hints and load eagerly
+app.config['SEARCH_PAGE_DEFAULT'] = 20 # /api/search results per page
+app.config['SEARCH_PAGE_MAX'] = 100
+app.config['SEARCH_WEIGHTS'] = (10.0, 1.0) # bm25 weight of a match in name vs description
+app.config['RELATED_TOP_K'] = 8 # "frequently bought together" products shown per product
+app.config['RELATED_CACHE_TTL'] = 300 # seconds a product's neighbour list is served from memory
+app.config['RELATED_CACHE_ENTRIES'] = 4096
+app.config['RELATED_ORDER_LINES_MAX'] = 50 # bigger orders are left out of the co-purchase counts, pairs grow with the square of the lines
+app.config['RELATED_REBUILD_BATCH'] = 50000 # pair counts held in memory by flask rebuild-related before they're written
+app.config['ORDERS_PAGE_SIZE'] = 10 # orders per /api/account/orders page
+app.config['REPORT_DAYS_DEFAULT'] = 30 # days covered by the /admin/reports endpoints when none are given
+app.config['REPORT_DAYS_MAX'] = 366
+app.config['REPORT_TOP_DEFAULT'] = 10 # rows in the top sellers/customers reports
+app.config['REPORT_TOP_MAX'] = 100
+app.config['STREAM_BATCH_SIZE'] = 500 # rows fetched per fetchmany() when streaming responses
+
+app.config['BASKET_STORE'] = 'sqlite' # 'sqlite' keeps baskets server-side, 'cookie' keeps them in the signed session
+app.config['BASKET_CACHE_ENTRIES'] = 1024 # decoded baskets kept per worker, revalidated against the row version
+app.config['BASKET_TTL'] = 30 * 24 * 3600 # seconds an anonymous basket is kept by flask prune-baskets
+
+app.config['CACHE_POLICIES'] = { # Cache-Control per endpoint, uploads use UPLOAD_CACHE_CONTROL instead
+    'static': 'public, max-age=300', # unversioned script.js/styles.css, revalidated by ETag afterwards
+    'getProducts': 'public, no-cache',
+    'searchProducts': 'public, no-cache',
+    'relatedProducts': 'public, max-age=300', # recommendations can lag, like the server-side copy
+    'index': 'private, no-cache',
+    'displayProduct': 'private, no-cache', # the header shows the visitor's basket
+}
+app.config['COMPRESS_MIMETYPES'] = {'text/html', 'text/css', 'text/javascript', 'application/javascript', 'application/json', 'image/svg+xml'}
+app.config['COMPRESS_MIN_SIZE'] = 1024 # bytes, smaller bodies aren't worth the header overhead
+app.config['COMPRESS_LEVELS'] = {'br': 4, 'gzip': 6} # dynamic responses, compressed on every request
+app.config['STATIC_COMPRESS_LEVELS'] = {'br': 11, 'gzip': 9} # static assets, compressed once per file version
+app.config['STATIC_COMPRESSED_ENTRIES'] = 128
+
+app.config['LATENCY_BUCKETS'] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5) # seconds, /metrics histogram bounds
+app.config['SLOW_QUERY_SECONDS'] = 0.1 # statements slower than this are logged with their text
+app.config['METRICS_TOKEN'] = os.environ.get('STORE_METRICS_TOKEN') # bearer token for scrapers, admins need none
+app.config['METRICS_TRUST_LOOPBACK'] = os.environ.get('STORE_METRICS_TRUST_LOOPBACK') == '1' # off behind a same-host proxy, where every client looks local
+app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('STORE_PROFILE_SAMPLE_RATE', 0)) # fraction of requests run under cProfile
+app.config['PROFILE_THRESHOLD'] = 0.5 # seconds, sampled requests slower than this are dumped
+app.config['PROFILE_FOLDER'] = os.path.join(app.root_path, 'profiles') # <endpoint>-<time>-<ms>ms.prof, open with pstats/snakeviz
+
+app.config['MIGRATIONS_FOLDER'] = os.path.join(app.root_path, 'migrations') # NNNN_name.sql, applied in order by migrate()
+app.config['MIGRATE_ON_START'] = True # each process runs migrate() before its first request, so deploys can't serve an old schema
+
+if app.config['TEMPLATE_CACHE_FOLDER']:
+    os.makedirs(app.config['TEMPLATE_CACHE_FOLDER'], exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config['TEMPLATE_CACHE_FOLDER']) # skips template compilation on cold workers
+
+PRODUCT_FIELDS = ('itemid', 'name', 'description', 'price', 'stock', 'image')
+PRODUCT_GRID_FIELDS = ('itemid', 'name', 'price', 'image') # what a grid card shows, the /api/products default
+PRODUCT_SORTS = { # sort -> (ORDER BY, keyset comparison against the cursor row)
+    'newest': ("itemid DESC", "itemid < ?"),
+    'price_asc': ("price ASC, itemid ASC", "(price, itemid) > ((SELECT price FROM products WHERE itemid = ?), ?)"),
+    'price_desc': ("price DESC, itemid DESC", "(price, itemid) < ((SELECT price FROM products WHERE itemid = ?), ?)"),
+}
+
+TRANSACTION_CONTROL = re.compile(r"\s*(BEGIN|COMMIT|END|ROLLBACK|SAVEPOINT|RELEASE)\b", re.IGNORECASE)
+
+def record_query(sql, elapsed):
+    if has_request_context() and 'query_count' in g:
+        g.query_count += 1
+        g.query_time += elapsed
+    if elapsed < app.config['SLOW_QUERY_SECONDS']:
+        return
+    if TRANSACTION_CONTROL.match(sql):
+        # a slow BEGIN IMMEDIATE is time spent queued for the write lock, not a statement worth tuning
+        app.logger.info("lock wait (%.1f ms): %s", elapsed * 1000, " ".join(sql.split()))
+    else:
+        app.logger.warning("slow query (%.1f ms): %s", elapsed * 1000, " ".join(sql.split()))
+
+class InstrumentedCursor(sqlite3.Cursor):
+    # times execute()/executemany(); rows fetched afterwards aren't included
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_query(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            record_query(sql, time.perf_counter() - start)
+
+class InstrumentedConnection(sqlite3.Connection):
+    # sqlite3.connect(..., factory=InstrumentedConnection) so conn.execute() goes through the timed cursor too
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self.cursor().executemany(sql, parameters)
 
 def get_db_connection():
-    return sqlite3.connect("app.db", check_same_thread=False) 
+    conn = sqlite3.connect(app.config['DATABASE'], check_same_thread=False, factory=InstrumentedConnection)
+    for pragma, value in app.config['DB_PRAGMAS'].items():
+        conn.execute(f"PRAGMA {pragma} = {value};")
+    return conn
+
+class PoolTimeout(sqlite3.OperationalError):
+    pass
+
+class ConnectionPool:
+    # bounded pool of sqlite connections, each handed to one request at a time
+
+    def __init__(self, connect, size, timeout):
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.idle = []
+        self.opened = 0
+        self.lock = threading.Condition()
+        self.metrics = {"hits": 0, "misses": 0, "waits": 0, "wait_time": 0.0, "timeouts": 0, "discarded": 0}
+
+    def acquire(self):
+        with self.lock:
+            if not self.idle and self.opened >= self.size:
+                self.metrics["waits"] += 1
+                started = time.monotonic()
+                if not self.lock.wait_for(lambda: self.idle or self.opened < self.size, self.timeout):
+                    self.metrics["timeouts"] += 1
+                    raise PoolTimeout("timed out waiting for a database connection")
+                self.metrics["wait_time"] += time.monotonic() - started
+            if self.idle:
+                conn = self.idle.pop()
+                self.metrics["hits"] += 1
+            else:
+                conn = None
+                self.opened += 1
+                self.metrics["misses"] += 1
+
+        if conn is not None and self.healthy(conn):
+            return conn
+        if conn is not None:
+            try:
+                conn.close() # release its file handles before opening the replacement
+            except sqlite3.Error:
+                pass
+            with self.lock:
+                self.metrics["discarded"] += 1
+        try:
+            return self.connect()
+        except Exception:
+            with self.lock:
+                self.opened -= 1
+                self.lock.notify()
+            raise
+
+    def healthy(self, conn):
+        try:
+            sqlite3.Connection.execute(conn, "SELECT 1;") # bypasses InstrumentedConnection, the ping isn't the request's query
+            return True
+        except sqlite3.Error:
+            return False
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback() # don't hand uncommitted work to the next request
+            reusable = True
+        except sqlite3.Error:
+            reusable = False
+
+        with self.lock:
+            if reusable:
+                self.idle.append(conn)
+            else:
+                self.opened -= 1
+                conn.close()
+            self.lock.notify()
+
+    def close_all(self):
+        with self.lock:
+            for conn in self.idle:
+                conn.close()
+            self.opened -= len(self.idle)
+            self.idle = []
+
+    def stats(self):
+        with self.lock:
+            return dict(self.metrics, size=self.size, opened=self.opened, idle=len(self.idle), in_use=self.opened - len(self.idle))
+
+# the lambda looks get_db_connection up on each call so tests can patch it
+db_pool = ConnectionPool(lambda: get_db_connection(), app.config['DB_POOL_SIZE'], app.config['DB_POOL_TIMEOUT'])
+
+db_executor = None
+
+def storefront_view(view):
+    # in async mode the view runs as a coroutine whose blocking sqlite work is handed to db_executor
+    if not app.config['ASYNC_VIEWS']:
+        return view
+
+    from asgiref.sync import sync_to_async # flask[async]; only needed in async mode
+    global db_executor
+    if db_executor is None:
+        db_executor = ThreadPoolExecutor(app.config['DB_EXECUTOR_WORKERS'], thread_name_prefix='db')
+    run = sync_to_async(view, thread_sensitive=False, executor=db_executor)
+
+    @functools.wraps(view)
+    async def async_view(*args, **kwargs):
+        return await run(*args, **kwargs)
+    return async_view
+
+def is_busy(error):
+    code = getattr(error, 'sqlite_errorcode', None)
+    return code in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED) or 'locked' in str(error) or 'busy' in str(error)
+
+def run_transaction(conn, work):
+    # runs work(cursor) inside BEGIN IMMEDIATE, retrying with backoff while another writer holds the lock
+    retries = app.config['DB_BUSY_RETRIES']
+    for attempt in range(retries + 1):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            conn.execute("BEGIN IMMEDIATE;")
+            result = work(conn.cursor())
+            conn.commit()
+            return result
+        except sqlite3.OperationalError as e:
+            conn.rollback()
+            if not is_busy(e) or attempt == retries:
+                raise
+            time.sleep(app.config['DB_BUSY_BACKOFF'] * 2 ** attempt * random.uniform(0.5, 1.5))
+        except BaseException:
+            conn.rollback()
+            raise
+
+def get_db():
+    # one pooled connection per request, handed back in release_db()
+    if 'db' not in g:
+        g.db = db_pool.acquire()
+    return g.db
+
+def list_migrations():
+    migrations = []
+    for filename in sorted(os.listdir(app.config['MIGRATIONS_FOLDER'])):
+        version, _, name = filename.partition('_')
+        if filename.endswith('.sql') and version.isdigit():
+            migrations.append((int(version), name[:-len('.sql')], os.path.join(app.config['MIGRATIONS_FOLDER'], filename)))
+    return migrations
+
+def migrate(conn):
+    # applies every migration newer than schema_version, each in its own transaction
+    conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, name TEXT NOT NULL, applied_at DATETIME DEFAULT CURRENT_TIMESTAMP);")
+    conn.commit()
+    current = conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version;").fetchone()[0]
+
+    applied = []
+    for version, name, path in list_migrations():
+        if version <= current:
+            continue
+        with open(path) as f:
+            script = f.read()
+        try:
+            # the version row goes in first: if another process applied this migration while we waited for the lock,
+            # its primary key stops the script before anything runs twice
+            quoted = name.replace("'", "''")
+            conn.executescript(f"BEGIN IMMEDIATE;\nINSERT INTO schema_version (version, name) VALUES ({version}, '{quoted}');\n" + script)
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            if conn.execute("SELECT 1 FROM schema_version WHERE version = ?;", (version,)).fetchone():
+                continue
+            raise
+        applied.append((version, name))
+    return applied
+
+schema_migrated = False
+schema_lock = threading.Lock()
+
+@app.before_request
+def migrate_schema():
+    # gunicorn app:app and uvicorn asgi:application never run flask db upgrade, so the first request of each process does
+    global schema_migrated
+    if schema_migrated or not app.config['MIGRATE_ON_START']:
+        return
+    with schema_lock:
+        if not schema_migrated:
+            conn = get_db_connection()
+            try:
+                migrate(conn)
+            finally:
+                conn.close()
+            schema_migrated = True
+
+db_cli = AppGroup('db', help="Database schema commands.")
+
+@db_cli.command('upgrade')
+def dbUpgradeCommand():
+    conn = get_db_connection()
+    try:
+        applied = migrate(conn)
+    finally:
+        conn.close()
+    for version, name in applied:
+        print(f"applied {version:04d}_{name}")
+    if not applied:
+        print("database is up to date")
+
+app.cli.add_command(db_cli)
+
+@app.cli.command('backfill-images')
+def backfillImagesCommand():
+    if Image is None:
+        print("Pillow is not installed, nothing to do")
+        return
+    conn = get_db_connection()
+    done = {row[0] for row in conn.execute("SELECT DISTINCT image FROM imagevariants;")}
+    images = [row[0] for row in conn.execute("SELECT DISTINCT image FROM products WHERE image != '';")]
+    for image in images:
+        if image in done:
+            continue
+        try:
+            rows = generate_image_variants(conn, image)
+            cursor = conn.cursor()
+            cursor.execute("UPDATE products SET version = version + 1 WHERE image = ?;", (image,)) # their cached pages lack the srcset
+            bump_catalog_version(cursor)
+            conn.commit()
+            print(f"{image}: {len(rows)} variants")
+        except OSError as e:
+            print(f"{image}: skipped ({e})")
+    conn.close()
+    catalog_cache.invalidate()
+    product_fragments.invalidate()
+
+@app.cli.command('prune-baskets')
+def pruneBasketsCommand():
+    conn = get_db_connection()
+    cursor = conn.execute("DELETE FROM baskets WHERE userid IS NULL AND updated_at < datetime('now', ?);", (f"-{app.config['BASKET_TTL']} seconds",))
+    conn.commit()
+    print(f"{cursor.rowcount} anonymous baskets removed")
+    conn.close()
+
+@app.cli.command('import-products')
+@click.argument('catalog', type=click.Path(exists=True, dir_okay=False))
+@click.option('--images', type=click.Path(exists=True, dir_okay=False), help="zip archive holding the files named in the image column")
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']), help="defaults to the catalog's extension")
+def importProductsCommand(catalog, images, fmt):
+    conn = get_db_connection()
+    archive = zipfile.ZipFile(images) if images else None
+    try:
+        with open(catalog, 'rb') as stream:
+            for progress in import_products(conn, stream, import_format(catalog, fmt), archive):
+                if progress.get("done"):
+                    for error in progress["errors"]:
+                        print(f"line {error['line']}: {error['error']}")
+                    print(f"{progress['imported']} imported, {progress['failed']} failed, {progress['images']} images queued")
+                else:
+                    print(f"{progress['rows']} rows read, {progress['imported']} imported, {progress['failed']} failed")
+        upload_workers.drain() # the CLI process would otherwise exit before the images are processed
+    finally:
+        if archive:
+            archive.close()
+        conn.close()
+
+@app.cli.command('compact-stock')
+def compactStockCommand():
+    conn = get_db_connection()
+    try:
+        changed = compact_stock(conn)
+    finally:
+        conn.close()
+    print(f"stock updated for {len(changed)} products")
+
+@app.cli.command('rebuild-sales')
+def rebuildSalesCommand():
+    conn = get_db_connection()
+    try:
+        days, orders = rebuild_sales(conn)
+    finally:
+        conn.close()
+    print(f"sales summaries rebuilt from {orders} orders over {days} days")
+
+@app.cli.command('rebuild-related')
+def rebuildRelatedCommand():
+    conn = get_db_connection()
+    try:
+        orders = rebuild_copurchases(conn)
+        pairs = conn.execute("SELECT COUNT(*) FROM copurchases;").fetchone()[0]
+    finally:
+        conn.close()
+    print(f"co-purchase counts rebuilt from {orders} orders, {pairs} product pairs")
+
+@app.cli.command('restock')
+@click.argument('itemid', type=int)
+@click.argument('quantity', type=int)
+def restockCommand(itemid, quantity):
+    if quantity <= 0:
+        raise click.BadParameter("must be positive", param_hint='QUANTITY')
+    conn = get_db_connection()
+    try:
+        conn.execute("INSERT INTO stockmovements (itemid, quantity, kind) VALUES (?, ?, 'restock');", (itemid, quantity))
+        conn.commit()
+        print(f"{stock_levels(conn.cursor(), [itemid]).get(itemid, 0)} available")
+    finally:
+        conn.close()
+
+@app.cli.command('fulfil-orders')
+@click.option('--batch', type=int, help="orders claimed per round, defaults to ORDER_JOB_BATCH")
+@click.option('--watch', is_flag=True, help="keep polling for new orders instead of exiting once none are due")
+def fulfilOrdersCommand(batch, watch):
+    conn = get_db_connection()
+    try:
+        while True:
+            counts = process_order_jobs(conn, batch)
+            if counts:
+                print(", ".join(f"{count} {status.lower()}" for status, count in sorted(counts.items())))
+            elif watch:
+                maybe_compact_stock(conn) # keeps products.stock current while no orders are due
+                time.sleep(app.config['ORDER_WORKER_INTERVAL'])
+            else:
+                break
+    finally:
+        conn.close()
+
+class CatalogCache:
+    # pre-serialised JSON bodies + ETags for the product catalog, keyed by query variant
+
+    def __init__(self, ttl='CATALOG_CACHE_TTL', entries='CATALOG_CACHE_ENTRIES'):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.generation = 0 # bumped on invalidate so in-flight rebuilds don't store stale data
+        self.ttl_key = ttl
+        self.entries_key = entries
+
+    def get(self, key, build):
+        ttl = app.config[self.ttl_key]
+        version = get_catalog_version() if app.config['CATALOG_CACHE_SHARED'] else None
+        now = time.monotonic()
+
+        with self.lock:
+            entry = self.entries.get(key)
+            generation = self.generation
+            if entry:
+                self.entries.move_to_end(key)
+        if entry and now - entry["loaded_at"] < ttl and entry["version"] == version:
+            return entry["body"], entry["etag"], entry["headers"]
+
+        data, headers = build() # build returns (payload, extra response headers)
+        body = json.dumps(data, separators=(",", ":")).encode('utf-8')
+        etag = hashlib.sha256(body).hexdigest()[:32]
+        with self.lock:
+            if ttl > 0 and generation == self.generation:
+                self.entries[key] = {"body": body, "etag": etag, "headers": headers, "loaded_at": now, "version": version}
+                self.entries.move_to_end(key)
+                while len(self.entries) > app.config[self.entries_key]:
+                    self.entries.popitem(last=False)
+        return body, etag, headers
+
+    def invalidate(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            self.generation += 1
+
+catalog_cache = CatalogCache()
+related_cache = CatalogCache('RELATED_CACHE_TTL', 'RELATED_CACHE_ENTRIES') # top-K neighbour lists per product, only ever stale by the TTL
+
+class FragmentCache:
+    # rendered template fragments keyed by (id, row version), so any change to the row misses on every worker
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key, build):
+        with self.lock:
+            html = self.entries.get(key)
+            if html is not None:
+                self.entries.move_to_end(key)
+                return html
+        html = Markup(build())
+        with self.lock:
+            self.entries[key] = html
+            while len(self.entries) > app.config['PRODUCT_FRAGMENT_ENTRIES']:
+                self.entries.popitem(last=False)
+        return html
+
+    def discard(self, ids):
+        # drops superseded versions early; correctness doesn't depend on it
+        ids = set(ids)
+        with self.lock:
+            for key in [key for key in self.entries if key[0] in ids]:
+                del self.entries[key]
+
+    def invalidate(self):
+        with self.lock:
+            self.entries = OrderedDict()
+
+product_fragments = FragmentCache()
+
+def get_catalog_version():
+    resp = get_db().execute("SELECT version FROM catalog_version WHERE name = 'products';").fetchone()
+    return resp[0] if resp else 0
+
+def bump_catalog_version(cursor):
+    # call inside the writing transaction, then catalog_cache.invalidate() once committed
+    if app.config['CATALOG_CACHE_SHARED']:
+        cursor.execute("INSERT INTO catalog_version (name, version) VALUES ('products', 1) ON CONFLICT(name) DO UPDATE SET version = version + 1;")
+
+def search_match(q):
+    # user text -> FTS5 query: every word must match, the last one as a prefix for type-ahead
+    words = re.findall(r"\w+", q)[:8]
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    if len(words[-1]) >= 2: # the prefix index starts at 2 characters, shorter prefixes would scan
+        terms[-1] += "*"
+    return " ".join(terms)
+
+def search_query(after, limit):
+    # keyset over (bm25 score, itemid); bm25 is lower-is-better
+    keyset = "WHERE (s.score, p.itemid) > (?, ?)" if after else ""
+    return f"""SELECT p.itemid, p.name, p.price, p.image, s.score
+                FROM (SELECT rowid, bm25(products_fts, ?, ?) AS score FROM products_fts WHERE products_fts MATCH ?) s
+                JOIN products p ON p.itemid = s.rowid AND p.status = 'active'
+                {keyset}
+                ORDER BY s.score, p.itemid LIMIT {int(limit)};"""
+
+def add_srcsets(products):
+    srcsets = get_image_srcsets(product['image'] for product in products)
+    for product in products:
+        if product['image'] in srcsets:
+            product['srcset'] = srcsets[product['image']]
+
+def product_query(sort, fields, after, limit):
+    # builds the keyset query behind /api/products, returns (sql, params, columns)
+    order_by, keyset = PRODUCT_SORTS[sort]
+    columns = ('itemid',) + tuple(f for f in fields if f != 'itemid') # itemid is the cursor, always fetched
+    query = f"SELECT {', '.join(columns)} FROM products WHERE status = 'active'"
+    params = []
+    if after is not None:
+        query += f" AND {keyset}"
+        params = [after] * keyset.count('?')
+    query += f" ORDER BY {order_by}"
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit)
+    return query + ";", params, columns
+
+def product_page(sort, fields, limit, after):
+    # one cached /api/products page -> (body, etag, headers); index() renders the first one from the same entry
+    def build():
+        # one extra row tells us whether there is a next page
+        query, params, columns = product_query(sort, fields, after, limit + 1)
+        cursor = get_db().cursor()
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
+        headers = {}
+        if len(rows) > limit:
+            rows = rows[:limit]
+            headers['X-Next-Cursor'] = str(rows[-1][0])
+        products = [
+            {field: value for field, value in zip(columns, row) if field in fields}
+            for row in rows
+        ]
+        if 'image' in fields:
+            add_srcsets(products)
+        return products, headers
+
+    return catalog_cache.get(("products", sort, fields, limit, after), build)
+
+def iter_rows(cursor):
+    batch_size = app.config['STREAM_BATCH_SIZE']
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield from rows
+
+def stream_json(records, ndjson=False):
+    # streams records as a JSON array (or one object per line) without building the list in memory
+    batch_size = app.config['STREAM_BATCH_SIZE']
+
+    def generate():
+        if not ndjson:
+            yield "["
+        chunk = []
+        first = True
+        for record in records:
+            line = json.dumps(record, separators=(",", ":"))
+            if ndjson:
+                chunk.append(line + "\n")
+            else:
+                chunk.append(line if first else "," + line)
+            first = False
+            if len(chunk) >= batch_size:
+                yield "".join(chunk)
+                chunk = []
+        if chunk:
+            yield "".join(chunk)
+        if not ndjson:
+            yield "]"
+
+    mimetype = 'application/x-ndjson' if ndjson else 'application/json'
+    return app.response_class(stream_with_context(generate()), mimetype=mimetype)
+
+def wants_ndjson():
+    return request.args.get('format') == 'ndjson' or request.accept_mimetypes.best == 'application/x-ndjson'
+
+def bcrypt_hash(password, rounds):
+    # runs in the password pool processes, returns (result, seconds spent hashing)
+    started = time.monotonic()
+    hashed = bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+    return hashed, time.monotonic() - started
+
+def bcrypt_check(password, hashed):
+    started = time.monotonic()
+    if isinstance(hashed, str):
+        hashed = hashed.encode('utf-8')
+    result = bcrypt.checkpw(password, hashed)
+    return result, time.monotonic() - started
+
+def bcrypt_rounds(hashed):
+    if isinstance(hashed, str):
+        hashed = hashed.encode('utf-8')
+    return int(hashed.split(b'$')[2])
+
+class PasswordBusy(Exception):
+    pass
+
+class PasswordPool:
+    # bcrypt runs in a few worker processes so a burst of logins can't starve the request threads
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.executor = None
+        self.pending = 0
+        self.metrics = {"hashes": 0, "checks": 0, "rejected": 0, "queue_wait": 0.0, "hash_time": 0.0}
+
+    def run(self, metric, fn, *args):
+        with self.lock:
+            if self.pending >= app.config['PASSWORD_QUEUE_MAX']:
+                self.metrics["rejected"] += 1
+                raise PasswordBusy()
+            self.pending += 1
+            if self.executor is None and app.config['PASSWORD_WORKERS'] > 0:
+                # spawn rather than fork: the app process already runs pool and upload threads
+                self.executor = ProcessPoolExecutor(app.config['PASSWORD_WORKERS'], mp_context=multiprocessing.get_context('spawn'))
+            executor = self.executor
+
+        started = time.monotonic()
+        if executor is None:
+            try:
+                result, hash_time = fn(*args)
+            finally:
+                self.finished()
+        else:
+            try:
+                future = executor.submit(fn, *args)
+            except BrokenProcessPool:
+                self.finished()
+                self.broken()
+                raise PasswordBusy()
+            # a job stays pending until its worker is done with it, even if we stop waiting
+            future.add_done_callback(lambda future: self.finished())
+            try:
+                result, hash_time = future.result(timeout=app.config['PASSWORD_TIMEOUT'])
+            except BrokenProcessPool:
+                self.broken()
+                raise PasswordBusy()
+            except TimeoutError:
+                future.cancel() # only works while it's still queued
+                raise PasswordBusy()
+
+        with self.lock:
+            self.metrics[metric] += 1
+            self.metrics["hash_time"] += hash_time
+            self.metrics["queue_wait"] += time.monotonic() - started - hash_time
+        return result
+
+    def finished(self):
+        with self.lock:
+            self.pending -= 1
+
+    def broken(self):
+        with self.lock:
+            self.executor = None # a worker died, start a fresh pool next time
+
+    def hash(self, password):
+        return self.run("hashes", bcrypt_hash, password.encode('utf-8'), app.config['BCRYPT_ROUNDS'])
+
+    def check(self, password, hashed):
+        return self.run("checks", bcrypt_check, password.encode('utf-8'), hashed)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.metrics, pending=self.pending, workers=app.config['PASSWORD_WORKERS'], queue_max=app.config['PASSWORD_QUEUE_MAX'])
+
+password_pool = PasswordPool()
+
+class RateLimiter:
+    # token buckets keyed by ip or username, oldest keys are dropped once max_keys is reached
+
+    def __init__(self, max_keys=10000):
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()
+        self.max_keys = max_keys
+
+    def allow(self, key, capacity, rate):
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            self.buckets[key] = (tokens - 1 if allowed else tokens, now)
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        return allowed
+
+    def reset(self):
+        with self.lock:
+            self.buckets = OrderedDict()
+
+login_limiter = RateLimiter()
+
+def login_allowed(username=None):
+    # cheap check before any hashing: one bucket per client ip and, for logins, per username
+    if not login_limiter.allow(('ip', request.remote_addr), *app.config['LOGIN_RATE_IP']):
+        return False
+    if username is not None and not login_limiter.allow(('user', username), *app.config['LOGIN_RATE_USERNAME']):
+        return False
+    return True
+
+def is_admin():
+    return session.get('privilege') == 'admin'
 
 def check_uploaded_file(file):
+    # stores an upload under the sha256 of its content, so identical uploads share one file
     if file.filename != '':
         file_ext = os.path.splitext(file.filename)[1]
         if file_ext not in app.config['UPLOAD_EXTENSIONS']:
             return ''
         else:
-            fnlength = 16
-            counter=1
-            new_filename = ''.join(random.choice(string.ascii_lowercase) for i in range(fnlength)) + file_ext
-            while os.path.exists(os.path.join('static/uploads'), new_filename):
-                new_filename = os.path.join(f"{os.path.split(new_filename)[0]}_{counter}{file_ext}")
-                counter += 1
-            file.save(os.path.join('static/uploads', new_filename))
+            digest = hashlib.sha256()
+            with tempfile.NamedTemporaryFile(dir=app.config['UPLOAD_FOLDER'], suffix='.part', delete=False) as temp:
+                for chunk in iter(lambda: file.stream.read(65536), b''): # hash while writing, no second read
+                    digest.update(chunk)
+                    temp.write(chunk)
+
+            new_filename = digest.hexdigest()[:32] + file_ext
+            destination = os.path.join(app.config['UPLOAD_FOLDER'], new_filename)
+            if os.path.exists(destination):
+                os.remove(temp.name) # duplicate upload, keep the existing copy
+            else:
+                os.replace(temp.name, destination)
             return new_filename
+
+def upload_refcount(conn, image):
+    # products referencing an upload; the file is only deleted once nothing does
+    return conn.execute("SELECT COUNT(*) FROM products WHERE image = ?;", (image,)).fetchone()[0]
+
+def discard_upload(conn, image):
+    if not image or upload_refcount(conn, image) > 0:
+        return False
+    upload_folder = app.config['UPLOAD_FOLDER']
+    variants = [row[0] for row in conn.execute("SELECT filename FROM imagevariants WHERE image = ? AND filename != image;", (image,))]
+    for filename in [image] + variants:
+        if os.path.exists(os.path.join(upload_folder, filename)):
+            os.remove(os.path.join(upload_folder, filename))
+    conn.execute("DELETE FROM imagevariants WHERE image = ?;", (image,))
+    conn.commit()
+    return True
+
+def generate_image_variants(conn, image):
+    # writes resized avif/webp/original-format copies of an upload into UPLOAD_FOLDER/variants
+    if Image is None or not image:
+        return []
+    if conn.execute("SELECT 1 FROM imagevariants WHERE image = ? LIMIT 1;", (image,)).fetchone():
+        return [] # duplicate upload, variants already exist
+
+    upload_folder = app.config['UPLOAD_FOLDER']
+    os.makedirs(os.path.join(upload_folder, 'variants'), exist_ok=True)
+    stem, ext = os.path.splitext(image)
+    formats = [fmt for fmt in app.config['IMAGE_VARIANT_FORMATS'] if features.check(fmt)]
+
+    with Image.open(os.path.join(upload_folder, image)) as original:
+        original.load()
+        widths = [width for width in app.config['IMAGE_VARIANT_WIDTHS'] if width < original.width] + [original.width]
+        rows = [(image, original.width, 'img', image)] # the upload itself is the widest fallback candidate
+
+        for width in widths:
+            resized = original.copy()
+            resized.thumbnail((width, original.height), Image.LANCZOS)
+            if resized.mode not in ('RGB', 'RGBA'):
+                resized = resized.convert('RGBA')
+
+            for fmt in formats:
+                filename = f"variants/{stem}_{width}.{fmt}"
+                resized.save(os.path.join(upload_folder, filename), format=fmt.upper(), quality=80)
+                rows.append((image, width, fmt, filename))
+
+            if width < original.width:
+                filename = f"variants/{stem}_{width}{ext}"
+                fallback = resized.convert('RGB') if ext.lower() in ('.jpg', '.jpeg') else resized
+                fallback.save(os.path.join(upload_folder, filename))
+                rows.append((image, width, 'img', filename))
+
+    conn.executemany("INSERT OR REPLACE INTO imagevariants (image, width, format, filename) VALUES (?, ?, ?, ?);", rows)
+    return rows
+
+def get_image_srcsets(images):
+    # {image: {"avif": srcset, "webp": srcset, "img": srcset}} for every image that has variants
+    images = list({image for image in images if image})
+    if not images:
+        return {}
+
+    placeholders = ", ".join("?" * len(images))
+    cursor = get_db().cursor()
+    cursor.execute(f"SELECT image, width, format, filename FROM imagevariants WHERE image IN ({placeholders}) ORDER BY width;", images)
+
+    candidates = {}
+    for image, width, fmt, filename in cursor.fetchall():
+        url = url_for('static', filename=f"uploads/{filename}")
+        candidates.setdefault(image, {}).setdefault(fmt, []).append(f"{url} {width}w")
+    return {
+        image: {fmt: ", ".join(urls) for fmt, urls in formats.items()}
+        for image, formats in candidates.items()
+    }
         
-def get_total_cost():
-    conn = get_db_connection()
+@dataclass
+class BasketLine:
+    itemid: int
+    name: str
+    price: int
+    image: str
+    stock: int
+    quantity: int # already clamped to stock
+
+    @property
+    def total(self):
+        return self.price * self.quantity
+
+@dataclass
+class BasketSnapshot:
+    lines: list = field(default_factory=list)
+
+    @property
+    def total(self):
+        return sum(line.total for line in self.lines)
+
+    @property
+    def count(self):
+        return sum(line.quantity for line in self.lines)
+
+def load_basket(basket):
+    # resolves a {itemid: quantity} dict with a single query
+    wanted = {}
+    for itemid, quantity in basket.items():
+        try:
+            wanted[int(itemid)] = int(quantity)
+        except (TypeError, ValueError):
+            continue
+    wanted = {itemid: quantity for itemid, quantity in wanted.items() if quantity > 0}
+    if not wanted:
+        return BasketSnapshot()
+
+    placeholders = ", ".join("?" * len(wanted))
+    cursor = get_db().cursor()
+    cursor.execute(f"SELECT itemid, name, price, image FROM products WHERE itemid IN ({placeholders});", tuple(wanted))
+    rows = {row[0]: row for row in cursor.fetchall()}
+    available = stock_view.get(cursor, list(rows))
+
+    lines = []
+    for itemid, quantity in wanted.items(): # keep the order items were added in
+        row = rows.get(itemid)
+        if row:
+            stock = max(available.get(itemid, 0), 0)
+            lines.append(BasketLine(*row, stock, quantity=min(quantity, stock)))
+    return BasketSnapshot(lines)
+
+class CookieBasketStore:
+    # the original behaviour: the whole basket lives in the signed session cookie
+
+    def load(self, session):
+        return dict(session.get('basket', {}))
+
+    def save(self, session, items):
+        session['basket'] = items
+
+    def login(self, session, userid):
+        pass
+
+    def logout(self, session):
+        pass
+
+    def clear(self, session):
+        session['basket'] = {}
+
+class SqliteBasketStore:
+    # baskets table keyed by an opaque sid in the session, with an LRU of decoded baskets in front
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # sid -> (version, items)
+
+    def remember(self, sid, version, items):
+        with self.lock:
+            self.entries[sid] = (version, items)
+            self.entries.move_to_end(sid)
+            while len(self.entries) > app.config['BASKET_CACHE_ENTRIES']:
+                self.entries.popitem(last=False)
+
+    def forget(self, sid):
+        with self.lock:
+            self.entries.pop(sid, None)
+
+    def load(self, session):
+        sid = session.get('sid')
+        if not sid:
+            return {}
+        with self.lock:
+            cached = self.entries.get(sid)
+        # one primary key lookup; items only come back (and get decoded) if another worker changed the row
+        row = get_db().execute("SELECT version, CASE WHEN version = ? THEN NULL ELSE items END FROM baskets WHERE sid = ?;",
+                               (cached[0] if cached else None, sid)).fetchone()
+        if not row:
+            self.forget(sid)
+            return {}
+        if row[1] is None:
+            return dict(cached[1])
+        items = json.loads(row[1])
+        self.remember(sid, row[0], items)
+        return dict(items)
+
+    def save(self, session, items):
+        if 'sid' not in session:
+            session['sid'] = secrets.token_urlsafe(24)
+        conn = get_db()
+        version = conn.execute("""INSERT INTO baskets (sid, items) VALUES (?, ?)
+                                  ON CONFLICT(sid) DO UPDATE SET items = excluded.items, version = version + 1, updated_at = CURRENT_TIMESTAMP
+                                  RETURNING version;""", (session['sid'], json.dumps(items))).fetchone()[0]
+        conn.commit()
+        self.remember(session['sid'], version, dict(items))
+
+    def login(self, session, userid):
+        # folds this visit's basket into the user's saved one under a fresh sid, so the basket survives login
+        items = self.load(session)
+        old_sid = session.pop('sid', None)
+        conn = get_db()
+        for (saved,) in conn.execute("SELECT items FROM baskets WHERE userid = ?;", (userid,)).fetchall():
+            for itemid, quantity in json.loads(saved).items():
+                items.setdefault(itemid, quantity)
+        conn.execute("DELETE FROM baskets WHERE userid = ? OR sid = ?;", (userid, old_sid))
+        session['sid'] = secrets.token_urlsafe(24)
+        conn.execute("INSERT INTO baskets (sid, userid, items) VALUES (?, ?, ?);", (session['sid'], userid, json.dumps(items)))
+        conn.commit()
+        if old_sid:
+            self.forget(old_sid)
+        self.remember(session['sid'], 1, items)
+
+    def logout(self, session):
+        # the row stays with the user for their next login, this browser starts a new anonymous basket
+        sid = session.pop('sid', None)
+        if sid:
+            self.forget(sid)
+
+    def clear(self, session):
+        if session.get('sid'):
+            self.save(session, {})
+
+    def reset(self):
+        with self.lock:
+            self.entries.clear()
+
+basket_stores = {'cookie': CookieBasketStore(), 'sqlite': SqliteBasketStore()}
+
+def get_basket_store():
+    return basket_stores[app.config['BASKET_STORE']]
+
+def get_basket():
+    # computed once per request and shared by basket(), checkout() and get_total_cost()
+    if 'basket' not in g:
+        store = get_basket_store()
+        items = store.load(session)
+        g.basket = load_basket(items)
+        synced = {str(line.itemid): line.quantity for line in g.basket.lines if line.quantity > 0}
+        if synced != items:
+            store.save(session, synced) # drop removed/missing items and clamp to stock
+    return g.basket
+
+def spool_upload(file):
+    # validates and parks an upload in UPLOAD_SPOOL_FOLDER for the upload workers, '' if unusable
+    if not file or file.filename == '':
+        return ''
+    file_ext = os.path.splitext(file.filename)[1]
+    if file_ext not in app.config['UPLOAD_EXTENSIONS']:
+        return ''
+    os.makedirs(app.config['UPLOAD_SPOOL_FOLDER'], exist_ok=True)
+    spooled = ''.join(random.choice(string.ascii_lowercase) for i in range(24)) + file_ext
+    file.save(spool_path(spooled))
+    return spooled
+
+def spool_path(spooled):
+    # jobs queued before the spool moved out of static/ still name incoming/<file> under UPLOAD_FOLDER
+    if spooled.startswith('incoming/'):
+        return os.path.join(app.config['UPLOAD_FOLDER'], spooled)
+    return os.path.join(app.config['UPLOAD_SPOOL_FOLDER'], spooled)
+
+def claim_upload_job(conn):
+    # atomically takes the oldest queued job, or a running one whose worker died
+    lease = f"-{app.config['UPLOAD_JOB_LEASE']} seconds"
+    cursor = conn.execute("""UPDATE uploadjobs SET status = 'running', claimed_at = CURRENT_TIMESTAMP, attempts = attempts + 1
+                             WHERE jobid = (SELECT jobid FROM uploadjobs
+                                            WHERE status = 'queued' OR (status = 'running' AND claimed_at < datetime('now', ?))
+                                            ORDER BY jobid LIMIT 1)
+                             RETURNING jobid, itemid, upload, attempts;""", (lease,))
+    job = cursor.fetchone()
+    conn.commit()
+    return job
+
+def process_upload_job(conn, job):
+    jobid, itemid, upload, attempts = job
+    spooled = spool_path(upload)
+    imagename = ''
+    try:
+        with open(spooled, 'rb') as stream:
+            imagename = check_uploaded_file(FileStorage(stream=stream, filename=upload))
+        try:
+            generate_image_variants(conn, imagename)
+        except OSError as e: # e.g. Pillow can't decode it, the original is still served
+            print("Image Error:", e)
+        cursor = conn.cursor()
+        cursor.execute("UPDATE products SET image = ?, status = 'active' WHERE itemid = ?;", (imagename, itemid))
+        cursor.execute("UPDATE uploadjobs SET status = 'done', error = NULL WHERE jobid = ?;", (jobid,))
+        bump_catalog_version(cursor)
+        conn.commit()
+        catalog_cache.invalidate()
+        product_fragments.discard([itemid])
+    except (OSError, sqlite3.Error) as e:
+        print("Upload Job Error:", e)
+        conn.rollback()
+        try:
+            discard_upload(conn, imagename) # unless another product already shares the file
+        except (OSError, sqlite3.Error) as cleanup_error:
+            print("Upload Cleanup Error:", cleanup_error)
+        failed = attempts >= app.config['UPLOAD_JOB_ATTEMPTS']
+        conn.execute("UPDATE uploadjobs SET status = ?, error = ? WHERE jobid = ?;", ('failed' if failed else 'queued', str(e), jobid))
+        if failed:
+            conn.execute("UPDATE products SET status = 'failed' WHERE itemid = ?;", (itemid,))
+        conn.commit()
+        if failed and os.path.exists(spooled):
+            os.remove(spooled) # no retry is coming for it
+        return
+
+    if os.path.exists(spooled):
+        os.remove(spooled)
+
+class UploadWorkers:
+    # up to UPLOAD_WORKERS threads drain the uploadjobs table then exit; state lives in the db so jobs survive restarts
+
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.running = 0
+        self.wakeups = 0
+
+    def notify(self):
+        with self.lock:
+            self.wakeups += 1
+            if self.running < app.config['UPLOAD_WORKERS']:
+                self.running += 1
+                threading.Thread(target=self.run, name=f"upload-worker-{self.running}", daemon=True).start()
+
+    def run(self):
+        try:
+            while True:
+                with self.lock:
+                    self.wakeups = 0
+                conn = db_pool.acquire()
+                try:
+                    job = claim_upload_job(conn)
+                    if job:
+                        process_upload_job(conn, job)
+                finally:
+                    db_pool.release(conn)
+                if job is None:
+                    with self.lock:
+                        if self.wakeups == 0: # nothing new was queued while we looked
+                            return
+        except sqlite3.Error as e:
+            print("Upload Worker Error:", e)
+        finally:
+            with self.lock:
+                self.running -= 1
+                self.lock.notify_all()
+
+    def drain(self, timeout=None):
+        with self.lock:
+            return self.lock.wait_for(lambda: self.running == 0, timeout)
+
+upload_workers = UploadWorkers()
+upload_workers_resumed = False
+
+def read_import_rows(stream, fmt):
+    # yields (line number, row dict or None if unparseable) from a binary csv/ndjson stream, one row at a time
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='' if fmt == 'csv' else None)
+    try:
+        if fmt == 'csv':
+            reader = csv.DictReader(text)
+            for row in reader:
+                yield reader.line_num, row
+        else:
+            for number, line in enumerate(text, 1):
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    row = None
+                yield number, row if isinstance(row, dict) else None
+    finally:
+        text.detach() # the caller owns the stream
+
+def validate_import_row(row):
+    # -> (name, description, price, stock, image member or ''), ValueError with a message otherwise
+    if row is None:
+        raise ValueError("not a valid record")
+    name = str(row.get('name') or '').strip()
+    if not name:
+        raise ValueError("name is required")
+    try:
+        price = int(row.get('price'))
+        stock = int(row.get('stock'))
+    except (TypeError, ValueError):
+        raise ValueError("price and stock must be integers")
+    if price < 0 or stock < 0:
+        raise ValueError("price and stock can't be negative")
+    image = str(row.get('image') or '').strip()
+    if image and os.path.splitext(image)[1] not in app.config['UPLOAD_EXTENSIONS']:
+        raise ValueError(f"image must be one of {', '.join(app.config['UPLOAD_EXTENSIONS'])}")
+    return name, str(row.get('description') or ''), price, stock, image
+
+def spool_archive_image(archive, member):
+    # copies one archive member into the upload spool, the upload workers apply check_uploaded_file() to it
+    try:
+        info = archive.getinfo(member)
+    except KeyError:
+        raise ValueError(f"{member} is not in the image archive")
+    if info.file_size > app.config['IMPORT_MAX_IMAGE_SIZE']:
+        raise ValueError(f"{member} is larger than {app.config['IMPORT_MAX_IMAGE_SIZE']} bytes")
+    with archive.open(info) as stream:
+        return spool_upload(FileStorage(stream=stream, filename=os.path.basename(member)))
+
+def insert_import_batch(cursor, batch):
+    # batch is [(values, spooled image)]; AUTOINCREMENT ids are consecutive while we hold the write lock
+    start = cursor.execute("SELECT COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'products'), (SELECT MAX(itemid) FROM products), 0);").fetchone()[0]
+    cursor.executemany("INSERT INTO products (name, description, price, stock, image, status) VALUES (?, ?, ?, ?, '', ?);",
+                       [values + ('processing' if spooled else 'active',) for values, spooled in batch])
+    jobs = [(start + offset + 1, spooled) for offset, (values, spooled) in enumerate(batch) if spooled]
+    cursor.executemany("INSERT INTO uploadjobs (itemid, upload) VALUES (?, ?);", jobs)
+    return len(jobs)
+
+def import_products(conn, stream, fmt, archive=None):
+    # generator: validates rows as they stream in, inserts them in executemany batches inside one transaction
+    # and yields a progress record per batch, then a summary; nothing is committed unless the whole file is read
+    summary = {"rows": 0, "imported": 0, "failed": 0, "images": 0, "errors": []}
+    spooled_files = []
+    batch = []
     cursor = conn.cursor()
 
-    totalcost = 0
+    def fail(number, message):
+        summary["failed"] += 1
+        if len(summary["errors"]) < app.config['IMPORT_MAX_ERRORS']:
+            summary["errors"].append({"line": number, "error": message})
 
-    for item in session['basket'].items():
-        cursor.execute(f"SELECT price FROM products WHERE itemid = {item[0]} LIMIT 1;")
-        resp = cursor.fetchone()
-        totalcost += (int(resp[0]) * item[1])
-    
-    return totalcost
+    cursor.execute("BEGIN IMMEDIATE;")
+    try:
+        for number, row in read_import_rows(stream, fmt):
+            summary["rows"] += 1
+            try:
+                name, description, price, stock, image = validate_import_row(row)
+                spooled = ''
+                if image:
+                    if archive is None:
+                        raise ValueError("rows with an image need an image archive")
+                    spooled = spool_archive_image(archive, image)
+                    spooled_files.append(spooled)
+            except (ValueError, zipfile.BadZipFile) as e:
+                fail(number, str(e))
+                continue
+            batch.append(((name, description, price, stock), spooled))
+            if len(batch) >= app.config['IMPORT_BATCH_SIZE']:
+                summary["images"] += insert_import_batch(cursor, batch)
+                summary["imported"] += len(batch)
+                batch = []
+                yield {"rows": summary["rows"], "imported": summary["imported"], "failed": summary["failed"]}
+        if batch:
+            summary["images"] += insert_import_batch(cursor, batch)
+            summary["imported"] += len(batch)
+        bump_catalog_version(cursor)
+        conn.commit()
+    except BaseException: # includes GeneratorExit if the client goes away mid-import
+        conn.rollback()
+        for spooled in spooled_files:
+            path = spool_path(spooled)
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+
+    catalog_cache.invalidate()
+    for _ in range(min(summary["images"], app.config['UPLOAD_WORKERS'])):
+        upload_workers.notify() # images are hashed and resized in parallel by the upload workers
+    summary["done"] = True
+    yield summary
+
+def import_format(filename, requested=None):
+    fmt = requested or {'.csv': 'csv', '.ndjson': 'ndjson', '.jsonl': 'ndjson'}.get(os.path.splitext(filename or '')[1].lower())
+    if fmt not in ('csv', 'ndjson'):
+        raise ValueError("format must be csv or ndjson")
+    return fmt
+
+class OutOfStock(Exception):
+    def __init__(self, lines):
+        super().__init__(", ".join(line.name for line in lines))
+        self.lines = lines
+
+STOCK_AVAILABLE = "p.stock + COALESCE((SELECT SUM(m.quantity) FROM stockmovements m WHERE m.itemid = p.itemid AND m.moveid > c.moveid), 0)" # over products p, stockcompaction c
+
+def stock_levels(cursor, itemids):
+    # available stock: the compacted products.stock plus every ledger movement after the watermark
+    placeholders = ", ".join("?" * len(itemids))
+    cursor.execute(f"""SELECT p.itemid, {STOCK_AVAILABLE}
+                       FROM products p, stockcompaction c WHERE p.itemid IN ({placeholders});""", list(itemids))
+    return dict(cursor.fetchall())
+
+def place_order(cursor, userid, address, lines):
+    # called inside run_transaction() or a checkout_commits batch; stock is only taken if every line can be fulfilled
+    cost = sum(line.total for line in lines)
+    cursor.execute("INSERT INTO orders (userid, address, cost, status) VALUES (?, ?, ?, ?) RETURNING orderid, placed_at;", (userid, address, cost, "ORDERED"))
+    orderid, placed_at = cursor.fetchone()
+
+    # we hold the write lock, so nothing can change stock between the check and taking it
+    if lines and app.config['STOCK_LEDGER']: # the products rows, and every cache keyed on them, are left alone until compaction
+        # the check rides in the insert: a line's movement only goes in if that much is available
+        cursor.executemany(f"""INSERT INTO stockmovements (itemid, quantity, kind, orderid)
+                               SELECT p.itemid, ?, 'sale', ? FROM products p, stockcompaction c WHERE p.itemid = ? AND {STOCK_AVAILABLE} >= ?;""",
+                           [(-line.quantity, orderid, line.itemid, line.quantity) for line in lines])
+        if cursor.rowcount != len(lines):
+            cursor.execute("SELECT itemid FROM stockmovements WHERE orderid = ?;", (orderid,))
+            taken = {row[0] for row in cursor.fetchall()}
+            raise OutOfStock([line for line in lines if line.itemid not in taken])
+    elif lines:
+        stock = stock_levels(cursor, [line.itemid for line in lines])
+        short = [line for line in lines if stock.get(line.itemid, 0) < line.quantity]
+        if short:
+            raise OutOfStock(short)
+        cursor.executemany("UPDATE products SET stock = stock - ? WHERE itemid = ? AND stock >= ?;", [(line.quantity, line.itemid, line.quantity) for line in lines])
+        if cursor.rowcount != len(lines):
+            raise OutOfStock(lines)
+        bump_catalog_version(cursor)
+
+    cursor.executemany("INSERT INTO orderitems (orderid, productid, quantity, price) VALUES (?, ?, ?, ?)", [(orderid, line.itemid, line.quantity, line.price) for line in lines])
+    cursor.execute("INSERT INTO orderjobs (orderid) VALUES (?);", (orderid,)) # payment and fulfilment happen in flask fulfil-orders
+    record_sales(cursor, userid, placed_at, cost, [(line.itemid, line.quantity, line.price) for line in lines])
+    record_copurchases(cursor, [line.itemid for line in lines])
+    return orderid
+
+def copurchase_pairs(itemids):
+    # every ordered pair of distinct products in one order, none for orders over RELATED_ORDER_LINES_MAX
+    itemids = sorted(set(itemids))
+    if len(itemids) > app.config['RELATED_ORDER_LINES_MAX']:
+        return []
+    return [(a, b) for a in itemids for b in itemids if a != b]
+
+def record_copurchases(cursor, itemids, sign=1):
+    pairs = copurchase_pairs(itemids)
+    if not pairs: # single-line orders, no statement at all
+        return
+    cursor.executemany("""INSERT INTO copurchases (productid, relatedid, orders) VALUES (?, ?, ?)
+                          ON CONFLICT(productid, relatedid) DO UPDATE SET orders = orders + excluded.orders;""",
+                       [(a, b, sign) for a, b in pairs])
+
+def rebuild_copurchases(conn):
+    # one pass over orderitems in primary key order, with pair counts flushed every RELATED_REBUILD_BATCH so memory stays bounded
+    def flush(cursor, counts):
+        cursor.executemany("""INSERT INTO copurchases (productid, relatedid, orders) VALUES (?, ?, ?)
+                              ON CONFLICT(productid, relatedid) DO UPDATE SET orders = orders + excluded.orders;""",
+                           [(a, b, count) for (a, b), count in counts.items()])
+        counts.clear()
+
+    def rebuild(cursor):
+        cursor.execute("DELETE FROM copurchases;")
+        reader = conn.cursor()
+        reader.execute(f"""SELECT oi.orderid, oi.productid FROM orderitems oi JOIN orders o ON o.orderid = oi.orderid
+                           WHERE {SALES_COUNTED} ORDER BY oi.orderid;""")
+        counts, orders, current, itemids = {}, 0, None, []
+        for orderid, productid in itertools.chain(iter_rows(reader), [(None, None)]): # the sentinel closes the last order
+            if orderid != current:
+                for pair in copurchase_pairs(itemids):
+                    counts[pair] = counts.get(pair, 0) + 1
+                if len(counts) >= app.config['RELATED_REBUILD_BATCH']:
+                    flush(cursor, counts)
+                orders += current is not None
+                current, itemids = orderid, []
+            itemids.append(productid)
+        flush(cursor, counts)
+        return orders
+
+    orders = run_transaction(conn, rebuild)
+    related_cache.invalidate()
+    return orders
+
+def record_sales(cursor, userid, placed_at, cost, items, sign=1):
+    # adds one order to the sales summaries inside its writing transaction, sign=-1 takes it back out; items are (productid, quantity, unit price)
+    day = placed_at[:10]
+    cursor.executemany("""INSERT INTO productsalesdays (productid, day, orders, units, revenue) VALUES (?, ?, ?, ?, ?)
+                          ON CONFLICT(productid, day) DO UPDATE SET orders = orders + excluded.orders, units = units + excluded.units, revenue = revenue + excluded.revenue;""",
+                       [(productid, day, sign, sign * quantity, sign * quantity * price) for productid, quantity, price in items])
+    cursor.executemany("""INSERT INTO productsales (productid, orders, units, revenue) VALUES (?, ?, ?, ?)
+                          ON CONFLICT(productid) DO UPDATE SET orders = orders + excluded.orders, units = units + excluded.units, revenue = revenue + excluded.revenue;""",
+                       [(productid, sign, sign * quantity, sign * quantity * price) for productid, quantity, price in items])
+    cursor.execute("""INSERT INTO salesdays (day, orders, units, revenue) VALUES (?, ?, ?, ?)
+                      ON CONFLICT(day) DO UPDATE SET orders = orders + excluded.orders, units = units + excluded.units, revenue = revenue + excluded.revenue;""",
+                   (day, sign, sign * sum(quantity for _, quantity, _ in items), sign * cost))
+    cursor.execute("""INSERT INTO usersales (userid, orders, spent, last_order_at) VALUES (?, ?, ?, ?)
+                      ON CONFLICT(userid) DO UPDATE SET orders = orders + excluded.orders, spent = spent + excluded.spent,
+                                                        last_order_at = CASE WHEN excluded.orders > 0 THEN MAX(COALESCE(last_order_at, ''), excluded.last_order_at) ELSE last_order_at END;""",
+                   (userid, sign, sign * cost, placed_at))
+
+SALES_COUNTED = "o.status != 'PAYMENT_FAILED'" # orders the summaries include, process_order_jobs() takes failed payments back out
+
+def rebuild_sales(conn):
+    # recomputes every summary from orders in one transaction; orders from before orderitems.price existed count at today's price
+    def rebuild(cursor):
+        for table in ('productsalesdays', 'productsales', 'salesdays', 'usersales'):
+            cursor.execute(f"DELETE FROM {table};")
+        cursor.execute(f"""INSERT INTO productsalesdays (productid, day, orders, units, revenue)
+                           SELECT oi.productid, date(o.placed_at), COUNT(DISTINCT o.orderid), SUM(oi.quantity), SUM(oi.quantity * COALESCE(oi.price, p.price, 0))
+                           FROM orders o JOIN orderitems oi ON oi.orderid = o.orderid LEFT JOIN products p ON p.itemid = oi.productid
+                           WHERE {SALES_COUNTED}
+                           GROUP BY oi.productid, date(o.placed_at);""")
+        cursor.execute("""INSERT INTO productsales (productid, orders, units, revenue)
+                          SELECT productid, SUM(orders), SUM(units), SUM(revenue) FROM productsalesdays GROUP BY productid;""")
+        cursor.execute(f"""INSERT INTO salesdays (day, orders, units, revenue)
+                           SELECT date(o.placed_at), COUNT(*), COALESCE(SUM(i.units), 0), SUM(o.cost)
+                           FROM orders o LEFT JOIN (SELECT orderid, SUM(quantity) AS units FROM orderitems GROUP BY orderid) i ON i.orderid = o.orderid
+                           WHERE {SALES_COUNTED}
+                           GROUP BY date(o.placed_at);""")
+        cursor.execute(f"""INSERT INTO usersales (userid, orders, spent, last_order_at)
+                           SELECT o.userid, COUNT(*), SUM(o.cost), MAX(o.placed_at) FROM orders o WHERE {SALES_COUNTED} GROUP BY o.userid;""")
+        return cursor.execute("SELECT COUNT(*), COALESCE(SUM(orders), 0) FROM salesdays;").fetchone()
+    return run_transaction(conn, rebuild)
+
+class StockView:
+    # this worker's copy of available stock for basket clamping, each level reread after STOCK_VIEW_TTL
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # itemid -> (expires, level)
+
+    def get(self, cursor, itemids):
+        now = time.monotonic()
+        levels, missing = {}, []
+        with self.lock:
+            for itemid in itemids:
+                entry = self.entries.get(itemid)
+                if entry and entry[0] > now:
+                    levels[itemid] = entry[1]
+                else:
+                    missing.append(itemid)
+        if missing:
+            fresh = stock_levels(cursor, missing)
+            expires = now + app.config['STOCK_VIEW_TTL']
+            with self.lock:
+                for itemid, level in fresh.items():
+                    self.entries[itemid] = (expires, level)
+                    self.entries.move_to_end(itemid)
+                while len(self.entries) > app.config['STOCK_VIEW_ENTRIES']:
+                    self.entries.popitem(last=False)
+            levels.update(fresh)
+        return levels
+
+    def apply(self, deltas):
+        # this worker's own sales show up straight away, other workers' once the entry expires
+        with self.lock:
+            for itemid, delta in deltas.items():
+                if itemid in self.entries:
+                    expires, level = self.entries[itemid]
+                    self.entries[itemid] = (expires, level + delta)
+
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+
+stock_view = StockView()
+
+class GroupCommit:
+    # checkouts queue their work; whichever request finds no commit running takes everything queued (up to STOCK_COMMIT_BATCH)
+    # and runs it as one BEGIN IMMEDIATE, each under its own savepoint, so N buyers of a hot item share one write lock and commit
+
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.pending = []
+        self.leading = False
+        self.metrics = {"commits": 0, "transactions": 0}
+
+    def submit(self, conn, work):
+        # work(cursor) runs on whichever thread leads, so it mustn't touch request, session or g
+        entry = {"work": work, "done": False, "result": None, "error": None}
+        with self.lock:
+            self.pending.append(entry)
+        while True:
+            with self.lock:
+                self.lock.wait_for(lambda: entry["done"] or not self.leading)
+                if entry["done"]:
+                    break
+                self.leading = True
+                batch = self.pending[:app.config['STOCK_COMMIT_BATCH']]
+                del self.pending[:len(batch)]
+            try:
+                self.commit(conn, batch)
+            finally:
+                with self.lock:
+                    self.leading = False
+                    self.lock.notify_all()
+        if entry["error"] is not None:
+            raise entry["error"]
+        return entry["result"]
+
+    def commit(self, conn, batch):
+        def work(cursor):
+            if len(batch) == 1: # nothing to keep apart, a failure rolls back the whole transaction instead of a savepoint
+                batch[0]["error"] = None
+                batch[0]["result"] = batch[0]["work"](cursor)
+                return
+            for entry in batch:
+                entry["error"] = None
+                cursor.execute("SAVEPOINT checkout;")
+                try:
+                    entry["result"] = entry["work"](cursor)
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO checkout;") # only this entry's writes are undone
+                    entry["error"] = e
+                cursor.execute("RELEASE checkout;")
+        try:
+            run_transaction(conn, work)
+        except BaseException as e:
+            for entry in batch:
+                entry["error"] = e
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            with self.lock:
+                for entry in batch:
+                    entry["done"] = True
+                self.metrics["commits"] += 1
+                self.metrics["transactions"] += len(batch)
+
+checkout_commits = GroupCommit()
+
+def compact_stock(conn):
+    # folds ledger movements past the watermark into products.stock in one transaction -> itemids whose stock changed
+    def fold(cursor):
+        watermark, latest = cursor.execute("SELECT moveid, (SELECT COALESCE(MAX(moveid), 0) FROM stockmovements) FROM stockcompaction WHERE id = 1;").fetchone()
+        if latest == watermark:
+            return []
+        cursor.execute("""UPDATE products SET stock = stock + moved.quantity
+                          FROM (SELECT itemid, SUM(quantity) AS quantity FROM stockmovements WHERE moveid > ? AND moveid <= ? GROUP BY itemid) AS moved
+                          WHERE products.itemid = moved.itemid AND moved.quantity != 0
+                          RETURNING products.itemid;""", (watermark, latest))
+        changed = [row[0] for row in cursor.fetchall()]
+        cursor.execute("UPDATE stockcompaction SET moveid = ?, compacted_at = CURRENT_TIMESTAMP WHERE id = 1;", (latest,))
+        if changed:
+            bump_catalog_version(cursor)
+        return changed
+
+    changed = run_transaction(conn, fold)
+    if changed:
+        catalog_cache.invalidate()
+        product_fragments.discard(changed)
+    return changed
+
+stock_compaction = {"lock": threading.Lock(), "last": 0.0, "timer": None}
+
+def maybe_compact_stock(conn):
+    # at most once per STOCK_COMPACT_INTERVAL per process; the watermark makes overlapping runs from other processes harmless
+    now = time.monotonic()
+    with stock_compaction["lock"]:
+        wait = stock_compaction["last"] + app.config['STOCK_COMPACT_INTERVAL'] - now
+        if wait > 0:
+            # too soon, so a timer folds these sales in once the interval is up rather than waiting on the next checkout
+            if stock_compaction["timer"] is None:
+                stock_compaction["timer"] = threading.Timer(wait, compact_stock_later)
+                stock_compaction["timer"].daemon = True
+                stock_compaction["timer"].start()
+            return []
+        stock_compaction["last"] = now
+    try:
+        return compact_stock(conn)
+    except sqlite3.Error as e:
+        print("Stock Compaction Error:", e)
+        return []
+
+def compact_stock_later():
+    # runs on the timer thread, outside any request, so it brings its own connection
+    with stock_compaction["lock"]:
+        stock_compaction["timer"] = None
+    try:
+        conn = get_db_connection()
+    except sqlite3.Error as e:
+        print("Stock Compaction Error:", e)
+        return
+    try:
+        maybe_compact_stock(conn)
+    finally:
+        conn.close()
+
+def cancel_stock_compaction():
+    with stock_compaction["lock"]:
+        timer, stock_compaction["timer"] = stock_compaction["timer"], None
+    if timer:
+        timer.cancel()
+
+ORDER_STEPS = { # order status -> (processor step, status once it succeeds, status once it's given up on)
+    'ORDERED': ('payment', 'PAID', 'PAYMENT_FAILED'),
+    'PAID': ('fulfilment', 'DISPATCHED', 'FULFILMENT_FAILED'),
+}
+
+class OrderDeclined(Exception):
+    pass # the step failed for good, e.g. a declined card; any other exception is retried
+
+class StubOrderProcessor:
+    # stands in for a payment gateway and warehouse; a real processor should key each call on (step, orderid) since a retried step may run twice
+
+    def step(self, name, order):
+        if app.config['STUB_PROCESSOR_DELAY']:
+            time.sleep(app.config['STUB_PROCESSOR_DELAY'])
+        if random.random() < app.config['STUB_PROCESSOR_FAILURE_RATE']:
+            raise ConnectionError(f"stub {name} timed out")
+
+    def payment(self, order):
+        self.step('payment', order)
+        limit = app.config['STUB_PAYMENT_LIMIT']
+        if limit is not None and order['cost'] > limit:
+            raise OrderDeclined("payment declined")
+
+    def fulfilment(self, order):
+        self.step('fulfilment', order)
+
+order_processors = {'stub': StubOrderProcessor()}
+
+def claim_order_jobs(conn, limit):
+    # atomically takes up to limit due jobs, plus running ones whose worker died -> {orderid: attempts}
+    lease = f"-{app.config['ORDER_JOB_LEASE']} seconds"
+    cursor = conn.execute("""UPDATE orderjobs SET status = 'running', claimed_at = CURRENT_TIMESTAMP, attempts = attempts + 1
+                             WHERE orderid IN (SELECT orderid FROM orderjobs
+                                               WHERE (status = 'queued' AND run_after <= CURRENT_TIMESTAMP)
+                                                  OR (status = 'running' AND claimed_at < datetime('now', ?))
+                                               ORDER BY run_after, orderid LIMIT ?)
+                             RETURNING orderid, attempts;""", (lease, limit))
+    jobs = dict(cursor.fetchall())
+    conn.commit()
+    return jobs
+
+def load_orders(conn, orderids):
+    placeholders = ", ".join("?" * len(orderids))
+    cursor = conn.execute(f"""SELECT o.orderid, o.userid, o.address, o.cost, o.status, o.placed_at,
+                                     json_group_array(json_object('itemid', oi.productid, 'quantity', oi.quantity, 'price', COALESCE(oi.price, p.price, 0))) FILTER (WHERE oi.orderid IS NOT NULL)
+                              FROM orders o LEFT JOIN orderitems oi ON oi.orderid = o.orderid LEFT JOIN products p ON p.itemid = oi.productid
+                              WHERE o.orderid IN ({placeholders})
+                              GROUP BY o.orderid;""", list(orderids))
+    return [
+        {"orderid": row[0], "userid": row[1], "address": row[2], "cost": row[3], "status": row[4], "placed_at": row[5], "items": json.loads(row[6])}
+        for row in cursor.fetchall()
+    ]
+
+def process_order_jobs(conn, limit=None):
+    # one worker round: claim a batch, run each order's next step outside any transaction, then commit every outcome at once
+    jobs = claim_order_jobs(conn, limit or app.config['ORDER_JOB_BATCH'])
+    if not jobs:
+        return {}
+    processor = order_processors[app.config['ORDER_PROCESSOR']]
+    outcomes = {orderid: (None, None, "order not found") for orderid in jobs} # orderid -> (status read, new status, error)
+    orders = {order['orderid']: order for order in load_orders(conn, jobs)}
+    for order in orders.values():
+        orderid, status = order['orderid'], order['status']
+        if status not in ORDER_STEPS: # already finished, or changed by hand since it was queued
+            outcomes[orderid] = (status, None, None)
+            continue
+        step, succeeded, gave_up = ORDER_STEPS[status]
+        try:
+            getattr(processor, step)(order)
+            outcomes[orderid] = (status, succeeded, None)
+        except OrderDeclined as e:
+            outcomes[orderid] = (status, gave_up, str(e))
+        except Exception as e:
+            print("Order Job Error:", e)
+            outcomes[orderid] = (status, gave_up if jobs[orderid] >= app.config['ORDER_JOB_ATTEMPTS'] else None, str(e))
+
+    failures = {gave_up for _, _, gave_up in ORDER_STEPS.values()}
+    def record(cursor):
+        counts = {}
+        for orderid, (status, target, error) in outcomes.items():
+            if target is not None:
+                cursor.execute("UPDATE orders SET status = ? WHERE orderid = ? AND status = ?;", (target, orderid, status))
+                if cursor.rowcount == 0: # changed underneath us, look at it again next round
+                    target, error = None, "status changed while processing"
+            if target == 'PAYMENT_FAILED': # nothing was charged, so the stock goes back on sale and the sale comes out of the reports
+                cursor.execute("INSERT INTO stockmovements (itemid, quantity, kind, orderid) SELECT productid, quantity, 'release', orderid FROM orderitems WHERE orderid = ?;", (orderid,))
+                order = orders[orderid]
+                record_sales(cursor, order['userid'], order['placed_at'], order['cost'], [(item['itemid'], item['quantity'], item['price']) for item in order['items']], sign=-1)
+                record_copurchases(cursor, [item['itemid'] for item in order['items']], sign=-1)
+
+            if target is None and error is not None and status is not None:
+                backoff = app.config['ORDER_JOB_BACKOFF'] * 2 ** (jobs[orderid] - 1)
+                cursor.execute("UPDATE orderjobs SET status = 'queued', error = ?, run_after = datetime('now', ?) WHERE orderid = ?;", (error, f"+{backoff} seconds", orderid))
+                key = 'retrying'
+            elif target in ORDER_STEPS: # on to the next step straight away
+                cursor.execute("UPDATE orderjobs SET status = 'queued', attempts = 0, error = NULL, run_after = CURRENT_TIMESTAMP WHERE orderid = ?;", (orderid,))
+                key = target
+            else:
+                cursor.execute("UPDATE orderjobs SET status = ?, error = ? WHERE orderid = ?;", ('failed' if target in failures or status is None else 'done', error, orderid))
+                key = target or 'skipped'
+            counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    counts = run_transaction(conn, record)
+    maybe_compact_stock(conn)
+    return counts
+
+def encode_cursor(*values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    return json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+
+def is_order_cursor(after):
+    # [placed_at, orderid] as load_order_page wrote it
+    return (isinstance(after, list) and len(after) == 2 and isinstance(after[0], str)
+            and isinstance(after[1], int) and not isinstance(after[1], bool))
+
+def is_search_cursor(after):
+    # [score, itemid] as encode_cursor wrote it; anything else would reach the cache key and the query
+    if not isinstance(after, list) or len(after) != 2:
+        return False
+    score, itemid = after
+    return (isinstance(score, (int, float)) and not isinstance(score, bool) and math.isfinite(score)
+            and isinstance(itemid, int) and not isinstance(itemid, bool))
+
+def load_order_page(username, after=None, limit=10):
+    # one query per page: keyset on (placed_at, orderid), items grouped into each order by SQLite
+    keyset, params = "", [username]
+    if after:
+        keyset, params = "AND (placed_at, orderid) < (?, ?)", params + list(after)
+    cursor = get_db().cursor()
+    cursor.execute(f"""SELECT o.orderid, o.placed_at, o.address, o.cost, o.status,
+                              json_group_array(json_object('productid', oi.productid, 'quantity', oi.quantity,
+                                                           'name', p.name, 'price', COALESCE(oi.price, p.price), 'image', p.image))
+                                  FILTER (WHERE oi.productid IS NOT NULL)
+                       FROM (SELECT orderid, placed_at, address, cost, status FROM orders
+                             WHERE userid = (SELECT userid FROM users WHERE username = ?) {keyset}
+                             ORDER BY placed_at DESC, orderid DESC
+                             LIMIT ?) AS o
+                       LEFT JOIN orderitems AS oi ON oi.orderid = o.orderid
+                       LEFT JOIN products AS p ON p.itemid = oi.productid
+                       GROUP BY o.orderid
+                       ORDER BY o.placed_at DESC, o.orderid DESC;""", params + [limit + 1])
+    rows = cursor.fetchall()
+
+    next_cursor = None
+    if len(rows) > limit: # the extra row only tells us there is another page
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][1], rows[-1][0])
+    orders = [
+        {"orderid": row[0], "placed_at": row[1], "address": row[2], "cost": row[3], "status": row[4], "items": json.loads(row[5])}
+        for row in rows
+    ]
+    return orders, next_cursor
+
+def get_total_cost():
+    return get_basket().total
+
+
+
+class RequestMetrics:
+    # per-worker latency histograms and query totals by endpoint, exposed in Prometheus text format
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.latency = {} # endpoint -> [bucket counts..., sum, count]
+            self.requests = {} # (endpoint, method, status) -> count
+            self.queries = {} # endpoint -> [statements, seconds]
+
+    def observe(self, endpoint, method, status, elapsed, queries, query_time):
+        buckets = app.config['LATENCY_BUCKETS']
+        with self.lock:
+            latency = self.latency.setdefault(endpoint, [0] * len(buckets) + [0.0, 0])
+            for i, bound in enumerate(buckets):
+                if elapsed <= bound:
+                    latency[i] += 1
+            latency[-2] += elapsed
+            latency[-1] += 1
+            key = (endpoint, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            totals = self.queries.setdefault(endpoint, [0, 0.0])
+            totals[0] += queries
+            totals[1] += query_time
+
+    def render(self):
+        buckets = app.config['LATENCY_BUCKETS']
+        lines = ["# HELP store_request_duration_seconds Request latency by endpoint.", "# TYPE store_request_duration_seconds histogram"]
+        with self.lock:
+            for endpoint, latency in sorted(self.latency.items()):
+                for bound, count in zip(buckets, latency):
+                    lines.append(f'store_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} {count}')
+                lines.append(f'store_request_duration_seconds_bucket{{endpoint="{endpoint}",le="+Inf"}} {latency[-1]}')
+                lines.append(f'store_request_duration_seconds_sum{{endpoint="{endpoint}"}} {latency[-2]:.6f}')
+                lines.append(f'store_request_duration_seconds_count{{endpoint="{endpoint}"}} {latency[-1]}')
+            lines += ["# HELP store_requests_total Requests by endpoint, method and status.", "# TYPE store_requests_total counter"]
+            for (endpoint, method, status), count in sorted(self.requests.items()):
+                lines.append(f'store_requests_total{{endpoint="{endpoint}",method="{method}",status="{status}"}} {count}')
+            lines += ["# HELP store_sql_queries_total SQL statements executed by endpoint.", "# TYPE store_sql_queries_total counter"]
+            lines += [f'store_sql_queries_total{{endpoint="{endpoint}"}} {totals[0]}' for endpoint, totals in sorted(self.queries.items())]
+            lines += ["# HELP store_sql_query_seconds_total Time spent executing SQL by endpoint.", "# TYPE store_sql_query_seconds_total counter"]
+            lines += [f'store_sql_query_seconds_total{{endpoint="{endpoint}"}} {totals[1]:.6f}' for endpoint, totals in sorted(self.queries.items())]
+        lines += ["# HELP store_db_pool Connection pool counters and gauges.", "# TYPE store_db_pool gauge"]
+        lines += [f'store_db_pool{{stat="{stat}"}} {value}' for stat, value in sorted(db_pool.stats().items())]
+        return "\n".join(lines) + "\n"
+
+request_metrics = RequestMetrics()
 
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.query_count = 0
+    g.query_time = 0.0
+    g.profiler = None
+    if app.config['PROFILE_SAMPLE_RATE'] and random.random() < app.config['PROFILE_SAMPLE_RATE']:
+        g.profiler = cProfile.Profile() # only sees this thread, so not the executor in async mode
+        try:
+            g.profiler.enable()
+        except ValueError: # 3.12+ allows one active profiler per process, skip this sample
+            g.profiler = None
 
+@app.after_request
+def record_request_metrics(response):
+    elapsed = time.perf_counter() - g.request_started
+    endpoint = request.endpoint or 'unmatched'
+    request_metrics.observe(endpoint, request.method, response.status_code, elapsed, g.query_count, g.query_time)
+    response.headers['Server-Timing'] = f"app;dur={elapsed * 1000:.1f}, db;dur={g.query_time * 1000:.1f};desc=\"{g.query_count} queries\""
+
+    profiler = g.pop('profiler', None)
+    if profiler:
+        profiler.disable()
+        if elapsed >= app.config['PROFILE_THRESHOLD']:
+            os.makedirs(app.config['PROFILE_FOLDER'], exist_ok=True)
+            profiler.dump_stats(os.path.join(app.config['PROFILE_FOLDER'], f"{endpoint}-{int(time.time())}-{elapsed * 1000:.0f}ms.prof"))
+    return response
 
 @app.before_request
-def initialize_session():
-    if "basket" not in session:
-        session["basket"] = {}
+def resume_upload_jobs():
+    # picks up jobs left queued or running by a previous process, once per process
+    global upload_workers_resumed
+    if not upload_workers_resumed:
+        upload_workers_resumed = True
+        upload_workers.notify()
+
+@app.teardown_request
+def forget_basket(exception):
+    g.pop('basket', None)
+
+@app.teardown_appcontext
+def release_db(exception):
+    conn = g.pop('db', None)
+    if conn is not None:
+        db_pool.release(conn)
+
+TEMPLATE_RELEASE = max((entry.stat().st_mtime_ns for entry in os.scandir(os.path.join(app.root_path, app.template_folder))), default=0) # changes when templates are deployed
+
+def compress(data, encoding, levels):
+    if encoding == 'br':
+        return brotli.compress(data, quality=levels['br'])
+    return gzip.compress(data, compresslevel=levels['gzip'], mtime=0)
+
+def negotiate_encoding():
+    if brotli and request.accept_encodings['br']:
+        return 'br'
+    if request.accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+def page_etag(*versions):
+    # weak validator for an HTML page: the data versions it shows plus what the header shows this visitor
+    header = (session.get('username'), session.get('privilege'), sum(get_basket_store().load(session).values()))
+    return hashlib.sha256(repr((TEMPLATE_RELEASE,) + versions + header).encode()).hexdigest()[:32]
+
+def not_modified(etag):
+    # checked before rendering; also matches the -gzip/-br tags compress_response hands out
+    tags = request.if_none_match
+    return any(tags.contains_weak(tag) for tag in (etag, f"{etag}-gzip", f"{etag}-br"))
+
+def not_modified_response(etag):
+    response = app.response_class(status=304)
+    response.set_etag(etag, weak=True)
+    return response
+
+class CompressedAssets:
+    # pre-compressed static files keyed by (path, encoding), rebuilt when the file changes
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, path, encoding):
+        stat = os.stat(path)
+        key = (path, encoding)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] == (stat.st_mtime_ns, stat.st_size):
+                self.entries.move_to_end(key)
+                return entry[1]
+        with open(path, 'rb') as f:
+            data = compress(f.read(), encoding, app.config['STATIC_COMPRESS_LEVELS'])
+        with self.lock:
+            self.entries[key] = ((stat.st_mtime_ns, stat.st_size), data)
+            while len(self.entries) > app.config['STATIC_COMPRESSED_ENTRIES']:
+                self.entries.popitem(last=False)
+        return data
+
+    def invalidate(self):
+        with self.lock:
+            self.entries = OrderedDict()
+
+compressed_assets = CompressedAssets()
+
+@app.after_request
+def compress_response(response):
+    if response.mimetype not in app.config['COMPRESS_MIMETYPES'] or 'Content-Encoding' in response.headers:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding()
+    if not encoding or response.status_code != 200:
+        return response
+
+    path = None
+    if request.endpoint == 'static':
+        path = safe_join(app.static_folder, request.view_args['filename'])
+    elif response.is_streamed or response.calculate_content_length() < app.config['COMPRESS_MIN_SIZE']:
+        return response
+
+    # each encoding is a different representation, so it gets its own validator
+    tag, weak = response.get_etag()
+    if tag:
+        response.set_etag(f"{tag}-{encoding}", weak=weak)
+        response.make_conditional(request)
+        if response.status_code == 304:
+            return response
+
+    if path:
+        data = compressed_assets.get(path, encoding)
+        response.close() # the uncompressed file handle from send_file
+        response.direct_passthrough = False
+    else:
+        data = compress(response.get_data(), encoding, app.config['COMPRESS_LEVELS'])
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    return response
 
 @app.after_request
 def add_headers(response):
@@ -64,15 +1990,39 @@ def add_headers(response):
         "frame-ancestors 'none';"
     )
     response.headers['X-Content-Type-Options'] = 'nosniff'
+    if response.status_code in (200, 304):
+        if request.path.startswith('/static/uploads/'):
+            response.headers['Cache-Control'] = app.config['UPLOAD_CACHE_CONTROL']
+        elif request.endpoint in app.config['CACHE_POLICIES']:
+            response.headers['Cache-Control'] = app.config['CACHE_POLICIES'][request.endpoint]
     return response
 
 @app.context_processor
 def inject_session():
     return dict(session=session)
 
+@app.context_processor
+def inject_basket_count():
+    # a callable so pages that don't render the header never touch the basket store
+    return {'basket_count': lambda: sum(get_basket_store().load(session).values())}
+
 @app.route('/')
+@storefront_view
 def index():
-    return render_template('home.html')
+    # the first grid page is rendered in, so products show without waiting on script.js and /api/products
+    try:
+        body, catalog_etag, headers = product_page('newest', PRODUCT_GRID_FIELDS, app.config['HOME_PAGE_SIZE'], None)
+    except sqlite3.Error as e:
+        print("Database Error:", e)
+        body, catalog_etag, headers = b"[]", None, {} # the script fetches the grid instead
+    etag = page_etag('index', catalog_etag)
+    if not_modified(etag):
+        return not_modified_response(etag)
+    products = json.loads(body)
+    response = app.make_response(render_template('home.html', products=products, next_cursor=headers.get('X-Next-Cursor'),
+                                                  rendered=catalog_etag is not None, preload=app.config['HOME_PRELOAD_IMAGES']))
+    response.set_etag(etag, weak=True)
+    return response
 
 @app.route('/admin/uploadShopItem', methods=['GET','POST'])
 def uploadItem():
@@ -86,109 +2036,198 @@ def uploadItem():
         stock = int(request.form.get('stock'))
         image_data = request.files.get('image')
 
-        imagename = check_uploaded_file(image_data)
-
-        conn = get_db_connection()
+        conn = get_db()
         cursor = conn.cursor()
 
         try:
-            cursor.execute("INSERT INTO products(name, description, price, stock, image) VALUES (?, ?, ?, ?, ?);", (name, description, price, stock, imagename))
+            spooled = spool_upload(image_data)
+            status = 'processing' if spooled else 'active'
+            cursor.execute("INSERT INTO products(name, description, price, stock, image, status) VALUES (?, ?, ?, ?, ?, ?);", (name, description, price, stock, '', status))
+            itemid = cursor.lastrowid
+            if spooled:
+                cursor.execute("INSERT INTO uploadjobs (itemid, upload) VALUES (?, ?);", (itemid, spooled))
+                jobid = cursor.lastrowid
+            bump_catalog_version(cursor)
             conn.commit()
+            catalog_cache.invalidate()
+            product_fragments.discard([itemid]) # rowids of deleted products can be reused
         except sqlite3.Error as e:
             print("Database Error:", e)
-        finally:
-            conn.close()
+            return render_template('addProduct.html', msg="Error: product could not be added")
+        except OSError as e:
+            print("Image Error:", e)
+            return render_template('addProduct.html', msg="Error: image could not be saved")
+
+        if spooled:
+            upload_workers.notify()
+            return render_template('addProduct.html', jobid=jobid), 202
+        return render_template('addProduct.html', msg="Product added")
 
     return render_template('addProduct.html')
 
+@app.route('/admin/uploadShopItem/<int:jobid>', methods=['GET'])
+def uploadStatus(jobid):
+    if not is_admin():
+        return jsonify({"error": "forbidden"}), 403
+    cursor = get_db().cursor()
+    cursor.execute("SELECT jobid, itemid, status, attempts, error FROM uploadjobs WHERE jobid = ?;", (jobid,))
+    resp = cursor.fetchone()
+    if not resp:
+        return jsonify({"error": "no such job"}), 404
+    return jsonify({"jobid": resp[0], "itemid": resp[1], "status": resp[2], "attempts": resp[3], "error": resp[4]})
+
 @app.route('/api/products', methods=['GET'])
+@storefront_view
 def getProducts():
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    sort = request.args.get('sort', 'newest')
+    fields = tuple(request.args['fields'].split(',')) if 'fields' in request.args else PRODUCT_GRID_FIELDS
+    try:
+        limit = int(request.args.get('limit', app.config['PRODUCTS_PAGE_DEFAULT']))
+        after = int(request.args['after']) if request.args.get('after') else None
+    except ValueError:
+        return jsonify({"error": "limit and after must be integers"}), 400
+    if sort not in PRODUCT_SORTS:
+        return jsonify({"error": f"sort must be one of {', '.join(PRODUCT_SORTS)}"}), 400
+    if not set(fields) <= set(PRODUCT_FIELDS):
+        return jsonify({"error": f"fields must be a subset of {', '.join(PRODUCT_FIELDS)}"}), 400
+    limit = max(1, min(limit, app.config['PRODUCTS_PAGE_MAX']))
+
+    if request.args.get('stream') == '1' or wants_ndjson():
+        # whole catalog from the cursor onwards, fetched in batches rather than cached
+        query, params, columns = product_query(sort, fields, after, None)
+        try:
+            cursor = get_db().cursor()
+            cursor.execute(query, params)
+        except sqlite3.Error as e:
+            print("Database Error:", e)
+            return None
+        records = ({field: value for field, value in zip(columns, row) if field in fields} for row in iter_rows(cursor))
+        return stream_json(records, ndjson=wants_ndjson())
 
     try:
-        cursor.execute("SELECT itemid, name, price, image FROM products;")
-        products = [
-            {"itemid": row[0], "name": row[1], "price": row[2], "image": row[3]}
-            for row in cursor.fetchall()
-        ]
-        products.reverse()
-        return jsonify(products)
+        body, etag, headers = product_page(sort, fields, limit, after)
     except sqlite3.Error as e:
         print("Database Error:", e)
-    finally:
-        conn.close()
-    
-    return None
+        return None
+
+    response = app.response_class(body, mimetype='application/json', headers=headers)
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+@app.route('/api/search', methods=['GET'])
+@storefront_view
+def searchProducts():
+    match = search_match(request.args.get('q', ''))
+    if match is None:
+        return jsonify({"error": "q must contain at least one word"}), 400
+    try:
+        limit = int(request.args.get('limit', app.config['SEARCH_PAGE_DEFAULT']))
+        after = decode_cursor(request.args['after']) if request.args.get('after') else None
+        if after is not None and not is_search_cursor(after):
+            raise ValueError
+    except (ValueError, TypeError):
+        return jsonify({"error": "invalid after or limit"}), 400
+    limit = max(1, min(limit, app.config['SEARCH_PAGE_MAX']))
+
+    def build():
+        params = list(app.config['SEARCH_WEIGHTS']) + [match] + (list(after) if after else [])
+        rows = get_db().execute(search_query(after, limit + 1), params).fetchall()
+        headers = {}
+        if len(rows) > limit:
+            rows = rows[:limit]
+            headers['X-Next-Cursor'] = encode_cursor(rows[-1][4], rows[-1][0])
+        products = [{"itemid": row[0], "name": row[1], "price": row[2], "image": row[3]} for row in rows]
+        add_srcsets(products)
+        return products, headers
+
+    try:
+        # hot queries share the catalog cache, so every catalog write invalidates them too
+        body, etag, headers = catalog_cache.get(("search", match, limit, tuple(after or ())), build)
+    except sqlite3.Error as e:
+        print("Database Error:", e)
+        return jsonify({"error": "invalid search"}), 400
+
+    response = app.response_class(body, mimetype='application/json', headers=headers)
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+@app.route('/api/products/<int:id>/related', methods=['GET'])
+@storefront_view
+def relatedProducts(id):
+    def build():
+        rows = get_db().execute("""SELECT p.itemid, p.name, p.price, p.image
+                                   FROM copurchases c JOIN products p ON p.itemid = c.relatedid AND p.status = 'active'
+                                   WHERE c.productid = ? AND c.orders > 0
+                                   ORDER BY c.orders DESC, c.relatedid LIMIT ?;""", (id, app.config['RELATED_TOP_K'])).fetchall()
+        products = [{"itemid": row[0], "name": row[1], "price": row[2], "image": row[3]} for row in rows]
+        add_srcsets(products)
+        return products, {}
+
+    try:
+        body, etag, headers = related_cache.get(id, build)
+    except sqlite3.Error as e:
+        print("Database Error:", e)
+        return jsonify({"error": "could not load related products"}), 500
+
+    response = app.response_class(body, mimetype='application/json', headers=headers)
+    response.set_etag(etag)
+    return response.make_conditional(request)
 
 @app.route('/product', methods=['GET'])
+@storefront_view
 def displayProduct():
     id = request.args.get('id')
 
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor()
 
     try:
-        cursor.execute(f"SELECT * FROM products WHERE itemid = ? LIMIT 1;", (id,))
+        cursor.execute(f"SELECT itemid, name, description, price, stock, image, version FROM products WHERE itemid = ? AND status = 'active' LIMIT 1;", (id,))
         resp = cursor.fetchone()
         if resp:
-            return render_template('product.html',
+            etag = page_etag('product', resp[0], resp[6])
+            if not_modified(etag):
+                return not_modified_response(etag)
+            details = product_fragments.get((resp[0], resp[6]), lambda: render_template('productDetails.html',
                                 id=resp[0],
                                 name=resp[1],
                                 description=resp[2],
                                 price="{:0.2f}".format(resp[3]/100),
                                 stock=resp[4],
-                                image=resp[5])
+                                image=resp[5],
+                                srcset=get_image_srcsets([resp[5]]).get(resp[5], {})))
+            response = app.make_response(render_template('product.html', id=resp[0], name=resp[1], details=details))
+            response.set_etag(etag, weak=True)
+            return response
         else:
             return redirect('/')
     except sqlite3.Error as e:
         print("Database Error:", e)
         return redirect('/')
-    finally:
-        conn.close()
 
 
 
 @app.route('/basket', methods=["GET", "POST"])
+@storefront_view
 def basket():
     if request.method == "POST":
         itemid = request.form.get('itemid')
         quantity = request.form.get('quantity', None)
+        store = get_basket_store()
+        items = store.load(session)
         if not quantity:
             new_quantity = request.form.get('new_quantity', None)
             if new_quantity:
-                session['basket'][itemid] = int(new_quantity)
+                items[itemid] = int(new_quantity)
         else:
-            session['basket'][itemid] = session['basket'].get(itemid, 0) + int(quantity)
-
-        session.modified = True
-
+            items[itemid] = items.get(itemid, 0) + int(quantity)
+        store.save(session, items)
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    basketItems = []
-    currentBasket = session['basket'].copy() # allows for deletion in the method below
-    
-    try:
-        for item in currentBasket.items():
-            if int(item[1]) < 1:
-                session['basket'].pop(item[0])
-            else:
-                cursor.execute(f"SELECT name, price, image, itemid, stock FROM products WHERE itemid={item[0]} LIMIT 1;")
-                resp = cursor.fetchone()
-                if int(item[1]) > resp[4]:
-                    final = resp[4]
-                    session['basket'][item[0]] = final
-                else:
-                    final = int(item[1])
-                basketItems.append((*resp, final))
-    except sqlite3.Error as e:
-        print("Database Error:", e)
-    finally:
-        conn.close()
 
-    cost = get_total_cost()
+    snapshot = get_basket()
+    srcsets = get_image_srcsets(line.image for line in snapshot.lines)
+    basketItems = [(line.name, line.price, line.image, line.itemid, line.stock, line.quantity, srcsets.get(line.image, {})) for line in snapshot.lines]
+    cost = snapshot.total
 
     return render_template('basket.html', items=json.dumps(basketItems), cost=cost)
 
@@ -200,27 +2239,37 @@ def login():
         username = request.form.get('username')
         password = request.form.get('password')
 
-        conn = get_db_connection()
+        if not login_allowed(username):
+            return render_template('login.html', msg="Error: too many attempts, please try again later"), 429
+
+        conn = get_db()
         cursor = conn.cursor()
 
         try:
-            cursor.execute("SELECT hash, privilege FROM users WHERE username = ?;", (username,))
+            cursor.execute("SELECT hash, privilege, userid FROM users WHERE username = ?;", (username,))
             resp = cursor.fetchone()
             if not resp:
                 return render_template('login.html', msg="Error: incorrect username or password")
-            pswdBytes = password.encode('utf-8')
-            result = bcrypt.checkpw(pswdBytes, resp[0])
+            result = password_pool.check(password, resp[0])
             if not result:
                 return render_template('login.html', msg="Error: Incorrect Username or Password")
             else:
+                if bcrypt_rounds(resp[0]) != app.config['BCRYPT_ROUNDS']: # work factor changed since it was hashed
+                    try:
+                        cursor.execute("UPDATE users SET hash = ? WHERE username = ?;", (password_pool.hash(password), username))
+                        conn.commit()
+                    except (PasswordBusy, sqlite3.Error) as e: # best effort, the next login tries again
+                        conn.rollback()
+                        print("Rehash Skipped:", e)
                 session['privilege'] = resp[1]
                 session['username'] = username
+                get_basket_store().login(session, resp[2])
                 return redirect('/')
+        except PasswordBusy:
+            return render_template('login.html', msg="Error: the server is busy, please try again"), 503
         except sqlite3.Error as e:
             print("Database Error:", e)
             return render_template('login.html', msg="Error: incorrect username or password")
-        finally:
-            conn.close()
 
     return render_template('login.html')
 
@@ -234,8 +2283,10 @@ def register():
         cpassword = request.form.get('cpassword')
         if password != cpassword:
             return render_template('register.html', msg="Error: passwords do not match")
+        elif not login_allowed():
+            return render_template('register.html', msg="Error: too many attempts, please try again later"), 429
         else:
-            conn = get_db_connection()
+            conn = get_db()
             cursor = conn.cursor()
             try:
                 cursor.execute(f"SELECT 1 FROM users WHERE username = ? LIMIT 1;", (username,))
@@ -243,16 +2294,14 @@ def register():
                 if resp:
                     return render_template('register.html', msg="Error: username already exists")
                 else:
-                    pswdBytes = password.encode('utf-8')
-                    salt = bcrypt.gensalt()
-                    hash = bcrypt.hashpw(pswdBytes, salt) 
+                    hash = password_pool.hash(password)
                     cursor.execute(f"INSERT INTO users (username, hash, privilege) VALUES (?, ?, ?);", (username, hash, "user"))
                     conn.commit()
-                    conn.close()
                     return render_template('register.html', msg="Account successfully created! Please log in")
+            except PasswordBusy:
+                return render_template('register.html', msg="Error: the server is busy, please try again"), 503
             except sqlite3.Error as e:
                 print("Database Error:", e)
-                conn.close()
                 return render_template('register.html', msg="Error: incorrect username or password")
     return render_template('register.html')  
 
@@ -260,6 +2309,7 @@ def register():
 def logout():
     session.pop('username', None)
     session.pop('privilege', None)
+    get_basket_store().logout(session)
     return redirect('/')
 
 @app.route('/checkout', methods=["GET", "POST"])
@@ -267,8 +2317,10 @@ def checkout():
     if 'username' not in session or 'privilege' not in session:
         return redirect('/login')
 
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor()
+    snapshot = get_basket()
+    msg = None
 
     if request.method == "POST":
 
@@ -283,81 +2335,274 @@ def checkout():
         payment_exp = request.form.get("payment_exp", "")
         payment_cvv = request.form.get("payment_cvv", "")
 
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        if request.form.get('save_address') == "on":
-            addr_save = 1
-            cursor.execute("UPDATE users SET addr_l1 = ?, addr_l2 = ?, addr_l3 = ?, addr_city = ?, addr_county = ?, addr_postcode = ?, addr_save = 1 WHERE username = ?;", (addr_l1, addr_l2, addr_l3, addr_city, addr_county, addr_postcode, session['username']))
-            # save address
-
-        if request.form.get('save_payment') == "on":
-            payment_save = 1
-            cursor.execute("UPDATE users SET payment_num = ?, payment_exp = ?, payment_save = 1 WHERE username = ?;", (payment_num, payment_exp, session['username']))
-            # save payment details, except cvv
-
-
-        # this is where you would process the payment on an actual e-commerce store
-
-        # add to orders database
-        cursor.execute("SELECT userid FROM users WHERE username = ? LIMIT 1;", (session['username'],))
-        
-        resp = cursor.fetchone()
-        userid = resp[0]
-
-        cost = get_total_cost()
-
         address_parts = [value for key, value in request.form.items() if key.startswith("addr_") and value.strip()]
         address =  ", ".join(address_parts)
 
-        cursor.execute("INSERT INTO orders (userid, address, cost, status) VALUES (?, ?, ?, ?)", (userid, address, cost, "ORDERED"))
-        resp = cursor.lastrowid
-
+        username = session['username']
+        save_address = request.form.get('save_address') == "on"
+        save_payment = request.form.get('save_payment') == "on"
 
-        # add to orderitems
-        for item in session['basket'].items():
-            cursor.execute("INSERT INTO orderitems (orderid, productid, quantity) VALUES (?, ?, ?)", (str(resp), item[0], item[1]))
-            cursor.execute("UPDATE products SET stock = stock - ? WHERE itemid = ?;", (item[1], item[0]))
-
-        conn.commit()
+        def write(cursor): # may run on another checkout's thread, so everything it needs is captured above
+            if save_address:
+                cursor.execute("UPDATE users SET addr_l1 = ?, addr_l2 = ?, addr_l3 = ?, addr_city = ?, addr_county = ?, addr_postcode = ?, addr_save = 1 WHERE username = ?;", (addr_l1, addr_l2, addr_l3, addr_city, addr_county, addr_postcode, username))
+                # save address
 
-    basketItems = []
+            if save_payment:
+                cursor.execute("UPDATE users SET payment_num = ?, payment_exp = ?, payment_save = 1 WHERE username = ?;", (payment_num, payment_exp, username))
+                # save payment details, except cvv
 
+            # payment and fulfilment run later in flask fulfil-orders, so they never hold up this request
 
-    for item in session['basket'].items():
-        cursor.execute(f"SELECT itemid, name, price, image, stock FROM products WHERE itemid={item[0]} LIMIT 1;")
-        row = cursor.fetchone()
+            # add to orders database
+            cursor.execute("SELECT userid FROM users WHERE username = ? LIMIT 1;", (username,))
+            userid = cursor.fetchone()[0]
+            return place_order(cursor, userid, address, lines)
 
-        basketItems.append({"itemid": row[0], "name": row[1], "price": row[2], "image": row[3], "stock": row[4], "quantity": item[1]})
+        lines = [line for line in snapshot.lines if line.quantity > 0] # clamped to 0 once sold out
+        try:
+            if not lines:
+                raise OutOfStock(snapshot.lines)
+            if app.config['STOCK_LEDGER']:
+                checkout_commits.submit(conn, write)
+                maybe_compact_stock(conn)
+            else:
+                run_transaction(conn, write)
+                catalog_cache.invalidate()
+                product_fragments.discard(line.itemid for line in lines)
+            stock_view.apply({line.itemid: -line.quantity for line in lines})
+        except OutOfStock as e:
+            msg = f"Error: not enough stock left for {e}" if e.lines else "Error: your basket is empty"
+        except sqlite3.Error as e:
+            print("Database Error:", e)
+            msg = "Error: your order could not be placed, please try again"
 
-    cursor.execute(f"SELECT addr_l1, addr_l2, addr_l3, addr_city, addr_county, addr_postcode, addr_save, payment_num, payment_exp, payment_save FROM users WHERE username = '{session['username']}' LIMIT 1;")
+    cursor.execute("SELECT addr_l1, addr_l2, addr_l3, addr_city, addr_county, addr_postcode, addr_save, payment_num, payment_exp, payment_save FROM users WHERE username = ? LIMIT 1;", (session['username'],))
     resp = cursor.fetchone()
     resp = tuple("" if value is None else value for value in resp) if resp else None
     
     
-    subtotal = "{:0.2f}".format(get_total_cost()/100)
+    subtotal = "{:0.2f}".format(snapshot.total/100)
 
-    conn.close()
-
-    if request.method == "POST":
-        session['basket'] = {}
+    if request.method == "POST" and not msg:
+        get_basket_store().clear(session)
         state = "confirmed"
     else:
         state = "unconfirmed"
 
-    return render_template('checkout.html', addr_l1=resp[0], addr_l2=resp[1], addr_l3=resp[2], addr_city=resp[3], addr_county=resp[4], addr_postcode=resp[5], addr_save=resp[6], payment_num=resp[7], payment_exp=resp[8], payment_save=resp[9], basketItems=basketItems, subtotal=subtotal, state=state)
+    return render_template('checkout.html', addr_l1=resp[0], addr_l2=resp[1], addr_l3=resp[2], addr_city=resp[3], addr_county=resp[4], addr_postcode=resp[5], addr_save=resp[6], payment_num=resp[7], payment_exp=resp[8], payment_save=resp[9], basketItems=snapshot.lines, subtotal=subtotal, state=state, msg=msg)
 
 @app.route('/account', methods=["GET"])
 def account():
-    
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    if 'username' not in session or 'privilege' not in session:
+        return redirect('/login')
 
-    orders = [
-            {"orderid": row[0], "placed_at": row[1], "address": row[2], "cost": row[3], "status": row[4], }
-            for row in cursor.fetchall()
-        ]
+    try:
+        orders, next_cursor = load_order_page(session['username'], limit=app.config['ORDERS_PAGE_SIZE'])
+    except sqlite3.Error as e:
+        print("Database Error:", e)
+        orders, next_cursor = [], None
 
+    return render_template('account.html', orders=orders, next_cursor=next_cursor)
+
+@app.route('/api/account/orders', methods=["GET"])
+def getAccountOrders():
+    if 'username' not in session or 'privilege' not in session:
+        return jsonify({"error": "not logged in"}), 401
+
+    try:
+        after = decode_cursor(request.args['after']) if request.args.get('after') else None
+        if after is not None and not is_order_cursor(after):
+            raise ValueError
+        limit = int(request.args.get('limit', app.config['ORDERS_PAGE_SIZE']))
+    except (ValueError, TypeError):
+        return jsonify({"error": "invalid after or limit"}), 400
+    limit = max(1, min(limit, 100))
+
+    try:
+        orders, next_cursor = load_order_page(session['username'], after, limit)
+    except sqlite3.Error as e:
+        print("Database Error:", e)
+        return jsonify({"error": "could not load orders"}), 500
+    return jsonify({"orders": orders, "next": next_cursor})
+
+@app.route('/admin/export/orders', methods=["GET"])
+def exportOrders():
+    if not is_admin():
+        return jsonify({"error": "forbidden"}), 403
+
+    try:
+        cursor = get_db().cursor()
+        cursor.execute("""SELECT o.orderid, o.userid, o.placed_at, o.address, o.cost, o.status, oi.productid, oi.quantity
+                          FROM orders AS o LEFT JOIN orderitems AS oi ON oi.orderid = o.orderid
+                          ORDER BY o.orderid;""")
+    except sqlite3.Error as e:
+        print("Database Error:", e)
+        return jsonify({"error": "export failed"}), 500
+
+    def orders():
+        # rows arrive sorted by orderid, so each order is complete once the id changes
+        order = None
+        for row in iter_rows(cursor):
+            if order is None or order["orderid"] != row[0]:
+                if order is not None:
+                    yield order
+                order = {"orderid": row[0], "userid": row[1], "placed_at": row[2], "address": row[3], "cost": row[4], "status": row[5], "items": []}
+            if row[6] is not None:
+                order["items"].append({"productid": row[6], "quantity": row[7]})
+        if order is not None:
+            yield order
+
+    return stream_json(orders(), ndjson=wants_ndjson())
+
+def report_args():
+    # -> (days, limit) from the query string, ValueError if either isn't a number
+    days = int(request.args.get('days', app.config['REPORT_DAYS_DEFAULT']))
+    limit = int(request.args.get('limit', app.config['REPORT_TOP_DEFAULT']))
+    return max(1, min(days, app.config['REPORT_DAYS_MAX'])), max(1, min(limit, app.config['REPORT_TOP_MAX']))
+
+@app.route('/admin/reports/sales', methods=["GET"])
+def salesReport():
+    # one row per day from salesdays, however many orders each day had
+    if not is_admin():
+        return jsonify({"error": "forbidden"}), 403
+    try:
+        days, _ = report_args()
+    except ValueError:
+        return jsonify({"error": "invalid days"}), 400
+
+    try:
+        rows = get_db().execute("SELECT day, orders, units, revenue FROM salesdays WHERE day > date('now', ?) ORDER BY day;", (f"-{days} days",)).fetchall()
+    except sqlite3.Error as e:
+        print("Database Error:", e)
+        return jsonify({"error": "could not load report"}), 500
+    daily = [{"day": row[0], "orders": row[1], "units": row[2], "revenue": row[3]} for row in rows]
+    totals = {key: sum(day[key] for day in daily) for key in ("orders", "units", "revenue")}
+    return jsonify({"days": days, "totals": totals, "daily": daily})
+
+@app.route('/admin/reports/products/<int:id>', methods=["GET"])
+def productSalesReport(id):
+    if not is_admin():
+        return jsonify({"error": "forbidden"}), 403
+    try:
+        days, _ = report_args()
+    except ValueError:
+        return jsonify({"error": "invalid days"}), 400
+
+    try:
+        conn = get_db()
+        total = conn.execute("SELECT orders, units, revenue FROM productsales WHERE productid = ?;", (id,)).fetchone() or (0, 0, 0)
+        rows = conn.execute("SELECT day, orders, units, revenue FROM productsalesdays WHERE productid = ? AND day > date('now', ?) ORDER BY day;",
+                            (id, f"-{days} days")).fetchall()
+    except sqlite3.Error as e:
+        print("Database Error:", e)
+        return jsonify({"error": "could not load report"}), 500
+    return jsonify({
+        "productid": id,
+        "totals": {"orders": total[0], "units": total[1], "revenue": total[2]},
+        "daily": [{"day": row[0], "orders": row[1], "units": row[2], "revenue": row[3]} for row in rows],
+    })
+
+@app.route('/admin/reports/top-sellers', methods=["GET"])
+def topSellersReport():
+    # walks the first `limit` entries of idx_productsales_units/_revenue
+    if not is_admin():
+        return jsonify({"error": "forbidden"}), 403
+    by = request.args.get('by', 'units')
+    try:
+        _, limit = report_args()
+        if by not in ('units', 'revenue'):
+            raise ValueError
+    except ValueError:
+        return jsonify({"error": "invalid by or limit"}), 400
+
+    try:
+        rows = get_db().execute(f"""SELECT s.productid, p.name, s.orders, s.units, s.revenue
+                                   FROM productsales s LEFT JOIN products p ON p.itemid = s.productid
+                                   ORDER BY s.{by} DESC, s.productid LIMIT ?;""", (limit,)).fetchall()
+    except sqlite3.Error as e:
+        print("Database Error:", e)
+        return jsonify({"error": "could not load report"}), 500
+    return jsonify([{"productid": row[0], "name": row[1], "orders": row[2], "units": row[3], "revenue": row[4]} for row in rows])
+
+@app.route('/admin/reports/customers', methods=["GET"])
+def topCustomersReport():
+    if not is_admin():
+        return jsonify({"error": "forbidden"}), 403
+    try:
+        _, limit = report_args()
+    except ValueError:
+        return jsonify({"error": "invalid limit"}), 400
+
+    try:
+        rows = get_db().execute("""SELECT s.userid, u.username, s.orders, s.spent, s.last_order_at
+                                   FROM usersales s LEFT JOIN users u ON u.userid = s.userid
+                                   ORDER BY s.spent DESC, s.userid LIMIT ?;""", (limit,)).fetchall()
+    except sqlite3.Error as e:
+        print("Database Error:", e)
+        return jsonify({"error": "could not load report"}), 500
+    return jsonify([{"userid": row[0], "username": row[1], "orders": row[2], "spent": row[3], "last_order_at": row[4]} for row in rows])
+
+@app.route('/admin/import', methods=["POST"])
+def importProducts():
+    if not is_admin():
+        return jsonify({"error": "forbidden"}), 403
+    catalog = request.files.get('catalog')
+    if not catalog or catalog.filename == '':
+        return jsonify({"error": "catalog file is required"}), 400
+    # request files are closed once the view returns, before a streamed body runs, so the import reads its own copies
+    owned = []
+    try:
+        fmt = import_format(catalog.filename, request.form.get('format'))
+        for upload in (catalog, request.files.get('images')):
+            if upload and upload.filename:
+                copy = tempfile.TemporaryFile()
+                shutil.copyfileobj(upload.stream, copy)
+                copy.seek(0)
+                owned.append(copy)
+        archive = zipfile.ZipFile(owned[1]) if len(owned) > 1 else None
+    except (ValueError, zipfile.BadZipFile) as e:
+        for copy in owned:
+            copy.close()
+        return jsonify({"error": str(e)}), 400
+
+    def progress():
+        try:
+            yield from import_products(get_db(), owned[0], fmt, archive)
+        finally:
+            for copy in owned:
+                copy.close()
+
+    # progress lines while the import runs, the last line is the summary with row errors
+    return stream_json(progress(), ndjson=True)
+
+@app.route('/admin/passwordpool', methods=["GET"])
+def passwordPoolStats():
+    if not is_admin():
+        return jsonify({"error": "forbidden"}), 403
+    return jsonify(password_pool.stats())
+
+@app.route('/admin/dbpool', methods=["GET"])
+def dbPoolStats():
+    if not is_admin():
+        return jsonify({"error": "forbidden"}), 403
+    return jsonify(db_pool.stats())
+
+def metrics_allowed():
+    token = app.config['METRICS_TOKEN']
+    if token and secrets.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}"):
+        return True
+    if app.config['METRICS_TRUST_LOOPBACK'] and request.remote_addr in ('127.0.0.1', '::1'):
+        return True
+    return is_admin()
+
+@app.route('/metrics', methods=["GET"])
+def metrics():
+    if not metrics_allowed():
+        return jsonify({"error": "forbidden"}), 403
+    return app.response_class(request_metrics.render(), mimetype='text/plain; version=0.0.4')
 
 if __name__ == "__main__":
+    conn = get_db_connection()
+    migrate(conn)
+    conn.close()
     app.run()
\ No newline at end of file
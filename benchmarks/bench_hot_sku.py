@@ -0,0 +1,114 @@
+# Checkouts/s when every buyer wants the same product, with STOCK_LEDGER off (UPDATE products per checkout) and on.
+#   python -m benchmarks.bench_hot_sku [--buyers 16] [--seconds 5] [--driver testclient|gunicorn]
+import argparse
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+import app as app_module
+from benchmarks.drivers import Recorder, TestClientDriver, HttpDriver, gunicorn_server
+from benchmarks.flows import bench_config
+from benchmarks.run import percentile
+from benchmarks.seed import PASSWORD, seed_database
+
+ROUNDS = 4
+
+def drive(make_driver, buyers, seconds):
+    # each buyer puts the hot item in their basket and checks out, over and over, while one client browses the catalog
+    recorder = Recorder()
+    stop = []
+    barrier = threading.Barrier(buyers + 1, action=lambda: stop.append(time.perf_counter() + seconds)) # the clock starts once everyone is logged in
+    placed = []
+
+    def buyer(number):
+        driver = make_driver(recorder)
+        driver.request('login', 'POST', '/login', {'username': f"bench{number}", 'password': PASSWORD})
+        barrier.wait()
+        while time.perf_counter() < stop[0]:
+            driver.request('basket', 'POST', '/basket', {'itemid': 1, 'quantity': 1})
+            _, _, body = driver.request('checkout', 'POST', '/checkout', {'addr_l1': '1 Hot Street', 'addr_city': 'Bench', 'addr_postcode': 'BE1 1CH'})
+            placed.append(b"Error:" not in body)
+
+    def browser():
+        driver = make_driver(recorder)
+        barrier.wait()
+        while time.perf_counter() < stop[0]:
+            driver.request('getProducts', 'GET', '/api/products?limit=24')
+            driver.request('displayProduct', 'GET', '/product?id=1')
+
+    threads = [threading.Thread(target=buyer, args=(number,)) for number in range(buyers)] + [threading.Thread(target=browser)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    latencies = [elapsed for elapsed, _, _ in recorder.samples.get('checkout', [])]
+    return {
+        "checkouts/s": sum(placed) / seconds,
+        "failed": len(placed) - sum(placed),
+        "p50 ms": percentile(latencies, 50) * 1000,
+        "p95 ms": percentile(latencies, 95) * 1000,
+        "browse/s": len(recorder.samples.get('getProducts', [])) / seconds,
+    }
+
+def run_testclient(database, config, buyers, seconds):
+    app_module.app.config.update(bench_config(database, ROUNDS), **config)
+    app_module.db_pool.size = buyers + 1 # a connection per thread, like a gthread worker sized to DB_POOL_SIZE
+    app_module.db_pool.close_all()
+    commits = dict(app_module.checkout_commits.metrics)
+    try:
+        result = drive(lambda recorder: TestClientDriver(app_module.app, recorder), buyers, seconds)
+    finally:
+        app_module.cancel_stock_compaction() # the timer would otherwise fire after the database is copied over or deleted
+        app_module.db_pool.close_all()
+        app_module.catalog_cache.invalidate()
+        app_module.product_fragments.invalidate()
+        app_module.stock_view.invalidate()
+    batches = app_module.checkout_commits.metrics["commits"] - commits["commits"]
+    grouped = app_module.checkout_commits.metrics["transactions"] - commits["transactions"]
+    result["per commit"] = f"{grouped / batches:.1f}" if batches else "1.0"
+    return result
+
+def run_gunicorn(database, config, buyers, seconds, workers):
+    with gunicorn_server(database, ROUNDS, workers=workers, threads=max(1, buyers // workers), config=config) as base_url:
+        result = drive(lambda recorder: HttpDriver(base_url, recorder), buyers, seconds)
+    result["per commit"] = "-" # batches are counted inside the workers
+    return result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--buyers', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--driver', choices=['testclient', 'gunicorn'], default='testclient')
+    parser.add_argument('--workers', type=int, default=4, help="gunicorn worker processes")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_hot_sku_')
+    try:
+        seeded = os.path.join(workdir, 'seed.db')
+        seed_database(seeded, 2000, users=args.buyers, orders=0, rounds=ROUNDS)
+        conn = sqlite3.connect(seeded)
+        conn.execute("UPDATE products SET stock = 1000000000 WHERE itemid = 1;") # never sells out
+        conn.commit()
+        conn.close()
+
+        print(f"{args.buyers} buyers of one product, {args.seconds:g}s each, {args.driver}\n")
+        print(f"{'':<14}{'checkouts/s':>12}{'failed':>8}{'p50 ms':>9}{'p95 ms':>9}{'browse/s':>10}{'per commit':>12}")
+        for name, ledger in (("products row", False), ("stock ledger", True)):
+            database = os.path.join(workdir, f"{name.replace(' ', '_')}.db")
+            shutil.copy(seeded, database)
+            config = {'STOCK_LEDGER': ledger, 'BASKET_STORE': 'cookie'} # cookie baskets, so the checkouts are the only writes
+            if args.driver == 'gunicorn':
+                result = run_gunicorn(database, config, args.buyers, args.seconds, args.workers)
+            else:
+                result = run_testclient(database, config, args.buyers, args.seconds)
+            print(f"{name:<14}{result['checkouts/s']:>12.1f}{result['failed']:>8}{result['p50 ms']:>9.1f}{result['p95 ms']:>9.1f}"
+                  f"{result['browse/s']:>10.1f}{result['per commit']:>12}")
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+# /api/search (FTS5 + bm25) against a ranked LIKE '%term%' scan, on a seeded catalog.
+#   python -m benchmarks.bench_search [--products 100000]
+import argparse
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+import app as app_module
+from benchmarks.flows import bench_config
+from benchmarks.seed import seed_database
+
+TERMS = ("oak", "walnut", "cera", "linen brass", "kaloren", "zelqui", "item 4242") # common to rare
+
+def timed(run, repeat=20):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        run()
+    return (time.perf_counter() - start) / repeat * 1000
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--products', type=int, default=100000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_search_')
+    try:
+        database = os.path.join(workdir, 'bench.db')
+        start = time.perf_counter()
+        seed_database(database, args.products, users=1, orders=0)
+        print(f"seeded {args.products} products (with FTS triggers) in {time.perf_counter() - start:.1f}s\n")
+
+        conn = sqlite3.connect(database)
+        limit = app_module.app.config['SEARCH_PAGE_DEFAULT']
+        print(f"{'query':<18}{'LIKE ms':>10}{'FTS5 ms':>10}{'cached ms':>11}")
+        app_module.app.config.update(bench_config(database, 4))
+        with app_module.app.test_client() as client:
+            for term in TERMS:
+                words = term.split()
+                like = " AND ".join("(name LIKE ? OR description LIKE ?)" for _ in words)
+                like_params = [f"%{word}%" for word in words for _ in range(2)]
+                # name matches first, like the bm25 weights; the ORDER BY makes it scan every row, as ranking must
+                like_ms = timed(lambda: conn.execute(f"SELECT itemid, name, price, image FROM products WHERE status = 'active' AND {like} ORDER BY name LIKE ? DESC, itemid LIMIT {limit};",
+                                                     like_params + [f"%{words[0]}%"]).fetchall())
+
+                match = app_module.search_match(term)
+                fts_ms = timed(lambda: conn.execute(app_module.search_query(None, limit), list(app_module.app.config['SEARCH_WEIGHTS']) + [match]).fetchall())
+
+                client.get('/api/search', query_string={'q': term}) # fills the cache
+                cached_ms = timed(lambda: client.get('/api/search', query_string={'q': term}))
+                print(f"{term:<18}{like_ms:>10.2f}{fts_ms:>10.2f}{cached_ms:>11.2f}")
+        conn.close()
+    finally:
+        app_module.db_pool.close_all()
+        shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+# Product page renders/second with and without the fragment cache, and cold template load time
+# with and without the on-disk bytecode cache.
+#   python benchmarks/bench_templates.py [--products 1000] [--requests 5000]
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+import app as app_module
+
+def seed(path, products):
+    conn = sqlite3.connect(path)
+    app_module.migrate(conn)
+    conn.executemany("INSERT INTO products (name, description, price, stock, image) VALUES (?, ?, ?, ?, '');",
+                     [(f"Product {i}", "A reasonably long product description. " * 8, 100 + i, 50) for i in range(products)])
+    conn.commit()
+    conn.close()
+
+def product_renders(products, requests, fragment_entries):
+    app_module.app.config['PRODUCT_FRAGMENT_ENTRIES'] = fragment_entries
+    app_module.product_fragments.invalidate()
+    ids = [random.randint(1, products) for _ in range(requests)]
+    with app_module.app.test_client() as client:
+        start = time.perf_counter()
+        for itemid in ids:
+            client.get(f'/product?id={itemid}')
+        elapsed = time.perf_counter() - start
+    return requests / elapsed
+
+def cold_load(cache_folder):
+    # a fresh Environment is what a newly started worker has
+    env = Environment(loader=FileSystemLoader(app_module.app.template_folder),
+                      bytecode_cache=FileSystemBytecodeCache(cache_folder) if cache_folder else None)
+    start = time.perf_counter()
+    for name in env.list_templates():
+        env.get_template(name)
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--products', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=5000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_templates_')
+    try:
+        app_module.app.config['DATABASE'] = os.path.join(workdir, 'bench.db')
+        seed(app_module.app.config['DATABASE'], args.products)
+
+        product_renders(args.products, 200, 0) # warm up the pool and jinja's in-memory template cache
+        before = product_renders(args.products, args.requests, 0)
+        after = product_renders(args.products, args.requests, app_module.app.config['PRODUCT_FRAGMENT_ENTRIES'] or 1024)
+        print(f"/product renders/s: {before:,.0f} without fragment cache, {after:,.0f} with ({after / before:.2f}x)")
+
+        cache_folder = os.path.join(workdir, 'jinja')
+        os.makedirs(cache_folder)
+        cold_load(cache_folder) # first worker compiles and writes the bytecode
+        uncached = min(cold_load(None) for _ in range(5))
+        cached = min(cold_load(cache_folder) for _ in range(5))
+        print(f"cold template load: {uncached * 1000:.1f} ms compiling, {cached * 1000:.1f} ms from bytecode cache")
+    finally:
+        app_module.db_pool.close_all()
+        shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    main()
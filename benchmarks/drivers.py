@@ -0,0 +1,94 @@
+# Ways of sending the flows' requests: the in-process Flask test client, or HTTP against a spawned gunicorn.
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from contextlib import contextmanager
+from http.cookiejar import CookieJar
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+QUERIES = re.compile(r'desc="(\d+) queries"')
+
+class Recorder:
+    # (seconds, sql statements, status) samples per route, shared by all virtual users
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+
+    def add(self, route, elapsed, server_timing, status):
+        match = QUERIES.search(server_timing or '')
+        with self.lock:
+            self.samples.setdefault(route, []).append((elapsed, int(match.group(1)) if match else 0, status))
+
+class TestClientDriver:
+    # one per virtual user, so each has its own cookie jar
+
+    def __init__(self, app, recorder):
+        self.client = app.test_client()
+        self.recorder = recorder
+
+    def request(self, route, method, path, data=None):
+        start = time.perf_counter()
+        response = self.client.open(path, method=method, data=data)
+        body = response.get_data()
+        self.recorder.add(route, time.perf_counter() - start, response.headers.get('Server-Timing'), response.status_code)
+        response.close()
+        return response.status_code, response.headers, body
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None # time the redirect itself, not the page it points at
+
+class HttpDriver:
+
+    def __init__(self, base_url, recorder):
+        self.base_url = base_url
+        self.recorder = recorder
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()), NoRedirect)
+
+    def request(self, route, method, path, data=None):
+        body = urllib.parse.urlencode(data).encode('ascii') if data is not None else None
+        start = time.perf_counter()
+        try:
+            with self.opener.open(urllib.request.Request(self.base_url + path, data=body, method=method)) as response:
+                status, headers, payload = response.status, response.headers, response.read()
+        except urllib.error.HTTPError as e: # 3xx/4xx/5xx are results too
+            status, headers, payload = e.code, e.headers, e.read()
+        self.recorder.add(route, time.perf_counter() - start, headers.get('Server-Timing'), status)
+        return status, headers, payload
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+@contextmanager
+def gunicorn_server(database, rounds, workers=2, threads=4, timeout=30, config=None):
+    # config: extra app.config values for the workers, e.g. {'STOCK_LEDGER': False}
+    port = free_port()
+    env = dict(os.environ, BENCH_DATABASE=database, BENCH_BCRYPT_ROUNDS=str(rounds), BENCH_CONFIG=json.dumps(config or {}))
+    proc = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-w', str(workers), '-k', 'gthread', '--threads', str(threads),
+                             '-b', f'127.0.0.1:{port}', 'benchmarks.server:create_app()'],
+                            cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                if proc.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError("gunicorn did not start")
+                time.sleep(0.1)
+        yield f'http://127.0.0.1:{port}'
+    finally:
+        proc.terminate()
+        proc.wait(timeout=timeout)
@@ -0,0 +1,43 @@
+# The storefront journeys a virtual user repeats, and the config a benchmark run needs.
+from benchmarks.seed import PASSWORD
+
+def bench_config(database, rounds):
+    # seeded hashes use `rounds`, so logins don't rehash; the limiters would only measure 429s
+    return {
+        'DATABASE': database,
+        'BCRYPT_ROUNDS': rounds,
+        'LOGIN_RATE_IP': (10 ** 9, 10 ** 9),
+        'LOGIN_RATE_USERNAME': (10 ** 9, 10 ** 9),
+    }
+
+def browse(driver, rng, catalog):
+    # home grid -> next grid page -> product -> basket add/update
+    driver.request('index', 'GET', '/')
+    _, headers, _ = driver.request('getProducts', 'GET', '/api/products?limit=24')
+    if headers.get('X-Next-Cursor'):
+        driver.request('getProducts', 'GET', f"/api/products?limit=24&after={headers['X-Next-Cursor']}")
+    itemid = rng.randint(1, catalog['products'])
+    driver.request('displayProduct', 'GET', f'/product?id={itemid}')
+    driver.request('basket', 'POST', '/basket', {'itemid': itemid, 'quantity': 1})
+    driver.request('basket', 'POST', '/basket', {'itemid': itemid, 'new_quantity': rng.randint(1, 3)})
+    return itemid
+
+def login(driver, rng, catalog):
+    driver.request('login', 'POST', '/login', {'username': f"bench{rng.randrange(catalog['users'])}", 'password': PASSWORD})
+
+def checkout(driver, rng, catalog):
+    browse(driver, rng, catalog)
+    driver.request('checkout', 'GET', '/checkout')
+    driver.request('checkout', 'POST', '/checkout', {'addr_l1': '1 Benchmark Road', 'addr_city': 'Bench', 'addr_postcode': 'BE1 1CH',
+                                                     'payment_num': '4111111111111111', 'payment_exp': '12/30', 'payment_cvv': '123'})
+    driver.request('account', 'GET', '/account')
+
+def login_burst(driver, rng, catalog):
+    login(driver, rng, catalog)
+    driver.request('logout', 'GET', '/logout')
+
+FLOWS = { # name -> (flow, weight, needs a logged in user)
+    'browse': (browse, 6, False),
+    'checkout': (checkout, 3, True),
+    'login_burst': (login_burst, 1, False),
+}
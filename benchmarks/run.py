@@ -0,0 +1,181 @@
+# Storefront benchmark: seeds a synthetic database, drives the flows and reports latency per route.
+#   python -m benchmarks.run --products 100000 --driver both
+#   python -m benchmarks.run --smoke --baseline benchmarks/baseline.json          # exit 1 on regressions
+#   python -m benchmarks.run --smoke --baseline benchmarks/baseline.json --write-baseline
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import app as app_module
+from benchmarks.drivers import Recorder, TestClientDriver, HttpDriver, gunicorn_server
+from benchmarks.flows import FLOWS, bench_config, login
+from benchmarks.seed import seed_database
+
+SMOKE = {"products": 2000, "users": 20, "orders": 200, "vus": 4, "iterations": 10} # the sizes baseline.json and the benchmark marker use
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def run_flows(make_driver, catalog, users=8, iterations=25, seed=0):
+    # each virtual user repeats weighted random flows; returns per-route stats
+    recorder = Recorder()
+    names = list(FLOWS)
+    weights = [FLOWS[name][1] for name in names]
+
+    def virtual_user(number):
+        rng = random.Random(seed * 1000 + number)
+        driver = make_driver(recorder)
+        logged_in = False
+        for _ in range(iterations):
+            flow, _, needs_login = FLOWS[rng.choices(names, weights)[0]]
+            if needs_login and not logged_in:
+                login(driver, rng, catalog)
+                logged_in = True
+            flow(driver, rng, catalog)
+            if flow.__name__ == 'login_burst':
+                logged_in = False
+
+    threads = [threading.Thread(target=virtual_user, args=(i,)) for i in range(users)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+    return summarise(recorder.samples, wall)
+
+def summarise(samples, wall):
+    routes = {}
+    for route, rows in sorted(samples.items()):
+        latencies = [row[0] * 1000 for row in rows]
+        routes[route] = {
+            "count": len(rows),
+            "p50_ms": round(percentile(latencies, 50), 3),
+            "p95_ms": round(percentile(latencies, 95), 3),
+            "p99_ms": round(percentile(latencies, 99), 3),
+            "rps": round(len(rows) / wall, 1),
+            "queries": round(sum(row[1] for row in rows) / len(rows), 2),
+            "errors": sum(1 for row in rows if row[2] >= 500),
+        }
+    total = sum(route["count"] for route in routes.values())
+    return {"wall_s": round(wall, 3), "requests": total, "rps": round(total / wall, 1), "routes": routes}
+
+def compare(results, baseline, tolerance):
+    # p95 may grow by `tolerance` plus 5ms of scheduler jitter, query counts by 10% (they only vary with the random product mix)
+    regressions = []
+    for route, base in baseline["routes"].items():
+        current = results["routes"].get(route)
+        if not current:
+            continue
+        if current["p95_ms"] > base["p95_ms"] * (1 + tolerance) + 5:
+            regressions.append(f"{route}: p95 {current['p95_ms']}ms vs baseline {base['p95_ms']}ms")
+        if current["queries"] > base["queries"] * 1.1 + 0.5:
+            regressions.append(f"{route}: {current['queries']} queries/request vs baseline {base['queries']}")
+        if current["errors"]:
+            regressions.append(f"{route}: {current['errors']} server errors")
+    return regressions
+
+def worst_of(runs):
+    # a baseline from several runs, keeping each route's slowest percentiles
+    worst = json.loads(json.dumps(runs[0]))
+    for run in runs[1:]:
+        for route, stats in run["routes"].items():
+            kept = worst["routes"].setdefault(route, stats)
+            for key in ("p50_ms", "p95_ms", "p99_ms", "queries"):
+                kept[key] = max(kept[key], stats[key])
+    return worst
+
+def print_report(name, results):
+    print(f"\n{name}: {results['requests']} requests in {results['wall_s']}s, {results['rps']} req/s")
+    print(f"{'route':<16}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>9}{'queries':>9}")
+    for route, stats in results["routes"].items():
+        print(f"{route:<16}{stats['count']:>7}{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}{stats['rps']:>9}{stats['queries']:>9}")
+
+def run_testclient(database, rounds, catalog, users, iterations, seed=0):
+    saved = {key: app_module.app.config[key] for key in bench_config(database, rounds)}
+    app_module.app.config.update(bench_config(database, rounds))
+    app_module.db_pool.close_all() # connections may point at another database
+    try:
+        make_driver = lambda recorder: TestClientDriver(app_module.app, recorder)
+        run_flows(make_driver, catalog, users, 2, seed + 1) # warm up the pools, caches and bcrypt processes
+        return run_flows(make_driver, catalog, users, iterations, seed)
+    finally:
+        app_module.db_pool.close_all()
+        app_module.catalog_cache.invalidate()
+        app_module.product_fragments.invalidate()
+        app_module.app.config.update(saved)
+
+def run_gunicorn(database, rounds, catalog, users, iterations, workers, seed=0):
+    with gunicorn_server(database, rounds, workers) as base_url:
+        make_driver = lambda recorder: HttpDriver(base_url, recorder)
+        run_flows(make_driver, catalog, users, 2, seed + 1)
+        return run_flows(make_driver, catalog, users, iterations, seed)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--products', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=100, help="seeded accounts")
+    parser.add_argument('--orders', type=int, default=1000)
+    parser.add_argument('--vus', type=int, default=8, help="concurrent virtual users")
+    parser.add_argument('--iterations', type=int, default=25, help="flows per virtual user")
+    parser.add_argument('--bcrypt-rounds', type=int, default=4)
+    parser.add_argument('--smoke', action='store_true', help="use the SMOKE sizes, as the pytest benchmark marker does")
+    parser.add_argument('--driver', choices=('testclient', 'gunicorn', 'both'), default='testclient')
+    parser.add_argument('--workers', type=int, default=2, help="gunicorn workers")
+    parser.add_argument('--database', help="reuse a database seeded by an earlier run (sizes must match)")
+    parser.add_argument('--baseline', help="JSON baseline to compare against or write")
+    parser.add_argument('--write-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=float(os.environ.get('BENCH_TOLERANCE', 1.0)))
+    parser.add_argument('--repeat', type=int, help="runs per driver, the worst is kept (default 3 with --write-baseline, else 1)")
+    parser.add_argument('--json', help="also write the results here")
+    args = parser.parse_args()
+    if args.smoke:
+        for key, value in SMOKE.items():
+            setattr(args, key, value)
+
+    workdir = tempfile.mkdtemp(prefix='bench_')
+    try:
+        database = args.database or os.path.join(workdir, 'bench.db')
+        if not args.database:
+            start = time.perf_counter()
+            seed_database(database, args.products, args.users, args.orders, args.bcrypt_rounds)
+            print(f"seeded {args.products} products, {args.users} users, {args.orders} orders in {time.perf_counter() - start:.1f}s")
+        catalog = {"products": args.products, "users": args.users}
+
+        repeat = args.repeat or (3 if args.write_baseline else 1)
+        results = {}
+        if args.driver in ('testclient', 'both'):
+            results['testclient'] = worst_of([run_testclient(database, args.bcrypt_rounds, catalog, args.vus, args.iterations, seed) for seed in range(repeat)])
+        if args.driver in ('gunicorn', 'both'):
+            results['gunicorn'] = worst_of([run_gunicorn(database, args.bcrypt_rounds, catalog, args.vus, args.iterations, args.workers, seed) for seed in range(repeat)])
+        for name, result in results.items():
+            print_report(name, result)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=2)
+
+        if args.baseline and args.write_baseline:
+            with open(args.baseline, 'w') as f:
+                json.dump(results, f, indent=2)
+            print(f"\nbaseline written to {args.baseline}")
+        elif args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+            regressions = [f"{name} {problem}" for name, result in results.items() if name in baseline
+                           for problem in compare(result, baseline[name], args.tolerance)]
+            for problem in regressions:
+                print("REGRESSION", problem)
+            sys.exit(1 if regressions else 0)
+    finally:
+        shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    main()
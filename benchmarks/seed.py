@@ -0,0 +1,71 @@
+# Synthetic storefront database: products, users sharing one known password, and order history.
+import bisect
+import itertools
+import random
+import sqlite3
+
+import bcrypt
+
+import app as app_module
+
+PASSWORD = "benchmark"
+WORDS = ("oak", "linen", "walnut", "brass", "cotton", "ceramic", "wool", "steel", "glass", "bamboo", "leather", "copper")
+SYLLABLES = ("ka", "lo", "mi", "ren", "tas", "vo", "qui", "zel", "dor", "fen", "par", "sil")
+BATCH = 10000
+
+def vocabulary(size=5000):
+    # WORDS first so they are the common ones, then made-up words for a long tail
+    words = list(WORDS)
+    for a in SYLLABLES:
+        for b in SYLLABLES:
+            for c in SYLLABLES:
+                words.append(a + b + c)
+    return words[:size]
+
+def batched(rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def seed_database(path, products=10000, users=100, orders=1000, rounds=4, seed=0):
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    app_module.migrate(conn)
+    conn.execute("PRAGMA journal_mode = WAL;")
+    conn.execute("PRAGMA synchronous = OFF;") # bulk load only, the app reopens with its own pragmas
+
+    vocab = vocabulary()
+    cum_weights = list(itertools.accumulate(1 / (rank + 10) for rank in range(1, len(vocab) + 1))) # zipf-mandelbrot: the top word is ~2% of all text
+    def word():
+        return vocab[bisect.bisect(cum_weights, rng.random() * cum_weights[-1])]
+
+    def product_rows():
+        for i in range(products):
+            yield (f"{word().title()} {word()} item {i}", " ".join(word() for _ in range(30)), rng.randint(100, 50000), 1000000, '')
+    for batch in batched(product_rows()):
+        conn.executemany("INSERT INTO products (name, description, price, stock, image) VALUES (?, ?, ?, ?, ?);", batch)
+
+    hash = bcrypt.hashpw(PASSWORD.encode('utf-8'), bcrypt.gensalt(rounds)) # one hash for everyone, seeding stays fast
+    conn.executemany("INSERT INTO users (username, hash, privilege) VALUES (?, ?, 'user');", [(f"bench{i}", hash) for i in range(users)])
+
+    prices = dict(conn.execute("SELECT itemid, price FROM products;")) if orders else {}
+    itemids = list(prices)
+    for start in range(0, orders, BATCH):
+        order_rows, item_rows = [], []
+        for orderid in range(start + 1, min(start + BATCH, orders) + 1):
+            lines = {itemid: rng.randint(1, 3) for itemid in rng.sample(itemids, rng.randint(1, 4))}
+            cost = sum(prices[itemid] * quantity for itemid, quantity in lines.items())
+            order_rows.append((orderid, rng.randint(1, users), "1 Benchmark Road", cost, "ORDERED", f"-{orders - orderid} minutes"))
+            item_rows += [(orderid, itemid, quantity) for itemid, quantity in lines.items()]
+        conn.executemany("INSERT INTO orders (orderid, userid, address, cost, status, placed_at) VALUES (?, ?, ?, ?, ?, datetime('now', ?));", order_rows)
+        conn.executemany("INSERT INTO orderitems (orderid, productid, quantity) VALUES (?, ?, ?);", item_rows)
+
+    conn.commit()
+    conn.execute("ANALYZE;")
+    conn.close()
+    return {"products": products, "users": users, "orders": orders}
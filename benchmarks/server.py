@@ -0,0 +1,12 @@
+# gunicorn entry point for the HTTP driver: gunicorn 'benchmarks.server:create_app()'
+# a factory, so importing this module (e.g. pytest --doctest-modules) doesn't need the BENCH_* variables
+import json
+import os
+
+from app import app
+from benchmarks.flows import bench_config
+
+def create_app():
+    app.config.update(bench_config(os.environ['BENCH_DATABASE'], int(os.environ['BENCH_BCRYPT_ROUNDS'])))
+    app.config.update(json.loads(os.environ.get('BENCH_CONFIG', '{}')))
+    return app
@@ -0,0 +1,28 @@
+# Opt-in regression gate: python -m pytest --benchmark benchmarks/
+# BENCH_TOLERANCE (default 1.0, i.e. twice as slow, plus 5ms of jitter) is how much slower than baseline.json a route's p95 may get.
+import json
+import os
+
+import pytest
+
+from benchmarks.run import SMOKE, BASELINE, run_testclient, compare
+from benchmarks.seed import seed_database
+
+pytestmark = pytest.mark.benchmark
+
+@pytest.fixture(scope="module")
+def seeded(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("bench") / "bench.db")
+    seed_database(path, SMOKE["products"], SMOKE["users"], SMOKE["orders"])
+    return path
+
+class TestBenchmarks:
+
+    def test_storefront_flows_within_baseline(self, seeded):
+        """Test that no route's p95 latency or query count regressed past the baseline."""
+        catalog = {"products": SMOKE["products"], "users": SMOKE["users"]}
+        results = run_testclient(seeded, 4, catalog, SMOKE["vus"], SMOKE["iterations"])
+        with open(BASELINE) as f:
+            baseline = json.load(f)["testclient"]
+        regressions = compare(results, baseline, float(os.environ.get('BENCH_TOLERANCE', 1.0)))
+        assert not regressions, "\n".join(regressions)
@@ -1,10 +1,25 @@
 # conftest.py
 import pytest
-from app import app
+from app import app, db_pool, request_metrics, InstrumentedConnection, catalog_cache, product_fragments, compressed_assets, migrate, upload_workers, login_limiter, basket_stores, stock_view, related_cache, cancel_stock_compaction
 import sqlite3
 from unittest.mock import patch
 import os
 import tempfile # Import tempfile for temporary file creation
+import shutil
+
+def pytest_addoption(parser):
+    parser.addoption("--benchmark", action="store_true", help="run the benchmark regression suite in benchmarks/")
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "benchmark: slow throughput/latency regression checks, skipped without --benchmark")
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--benchmark"):
+        return
+    skip = pytest.mark.skip(reason="needs --benchmark")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
 
 # Define a global variable to store the path to the temporary test database file.
 # This will be set dynamically by the 'client' fixture.
@@ -22,11 +37,13 @@ def client():
     fd, path = tempfile.mkstemp(suffix=".db", prefix="test_db_")
     os.close(fd) # Close the file descriptor immediately
     TEST_DB_PATH = path # Store the generated path globally
+    original_spool = app.config['UPLOAD_SPOOL_FOLDER']
+    app.config['UPLOAD_SPOOL_FOLDER'] = tempfile.mkdtemp(prefix="test_spool_") # keep queued uploads out of the repo
 
     # Define the mock function that will replace app.get_db_connection.
     # This function will now connect to the physical test database file.
     def mock_get_db_connection():
-        return sqlite3.connect(TEST_DB_PATH, check_same_thread=False)
+        return sqlite3.connect(TEST_DB_PATH, check_same_thread=False, factory=InstrumentedConnection)
 
     # IMPORTANT: Monkey-patch the Flask app instance's 'get_db_connection' attribute first.
     original_get_db_conn_attribute = getattr(app, 'get_db_connection', None)
@@ -39,58 +56,8 @@ def client():
         initial_conn = sqlite3.connect(TEST_DB_PATH, check_same_thread=False)
         with app.test_client() as test_client:
             with app.app_context():
-                # Setup schema using the initial connection
-                cursor = initial_conn.cursor()
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS products (
-                        itemid INTEGER PRIMARY KEY AUTOINCREMENT,
-                        name TEXT NOT NULL,
-                        description TEXT,
-                        price INTEGER NOT NULL,
-                        stock INTEGER NOT NULL,
-                        image TEXT
-                    );
-                """)
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS users (
-                        userid INTEGER PRIMARY KEY AUTOINCREMENT,
-                        username TEXT NOT NULL UNIQUE,
-                        hash TEXT NOT NULL,
-                        privilege TEXT NOT NULL,
-                        addr_l1 TEXT,
-                        addr_l2 TEXT,
-                        addr_l3 TEXT,
-                        addr_city TEXT,
-                        addr_county TEXT,
-                        addr_postcode TEXT,
-                        addr_save INTEGER DEFAULT 0,
-                        payment_num TEXT,
-                        payment_exp TEXT,
-                        payment_save INTEGER DEFAULT 0
-                    );
-                """)
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS orders (
-                        orderid INTEGER PRIMARY KEY AUTOINCREMENT,
-                        userid INTEGER NOT NULL,
-                        placed_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                        address TEXT NOT NULL,
-                        cost INTEGER NOT NULL,
-                        status TEXT NOT NULL,
-                        FOREIGN KEY(userid) REFERENCES users(userid)
-                    );
-                """)
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS orderitems (
-                        orderitemid INTEGER PRIMARY KEY AUTOINCREMENT,
-                        orderid INTEGER NOT NULL,
-                        productid INTEGER NOT NULL,
-                        quantity INTEGER NOT NULL,
-                        FOREIGN KEY(orderid) REFERENCES orders(orderid),
-                        FOREIGN KEY(productid) REFERENCES products(itemid)
-                    );
-                """)
-                initial_conn.commit()
+                # Setup schema using the same migrations that production runs
+                migrate(initial_conn)
 
                 # Clear tables before each test to ensure test isolation.
                 # We open a separate connection for clearing, just like the app would,
@@ -106,6 +73,10 @@ def client():
 
             yield test_client # Yield the test client for the test function to use
 
+            # Let any background upload jobs finish while the test database is still patched in.
+            upload_workers.drain(timeout=10)
+            cancel_stock_compaction() # a pending timer would otherwise compact whichever database the next test patches in
+
     # Clean up after all tests using this fixture:
     # 1. Restore the original app.get_db_connection if it was set.
     if original_get_db_conn_attribute is not None:
@@ -115,8 +86,20 @@ def client():
         if hasattr(app, 'get_db_connection'):
             del app.get_db_connection
     
-    # 2. Close the initial connection to the test database.
+    # 2. Close the initial connection and any pooled connections to the test database.
     initial_conn.close()
+    db_pool.close_all()
+    catalog_cache.invalidate()
+    product_fragments.invalidate()
+    compressed_assets.invalidate()
+    login_limiter.reset()
+    request_metrics.reset()
+    basket_stores['sqlite'].reset()
+    stock_view.invalidate()
+    related_cache.invalidate()
+
+    shutil.rmtree(app.config['UPLOAD_SPOOL_FOLDER'], ignore_errors=True)
+    app.config['UPLOAD_SPOOL_FOLDER'] = original_spool
 
     # 3. Delete the temporary database file.
     # This ensures that no residual test database files are left behind.
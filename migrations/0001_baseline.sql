@@ -0,0 +1,45 @@
+-- schema as shipped in app.db before migrations existed
+CREATE TABLE IF NOT EXISTS "products" (
+    `itemid` INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    `name` TEXT NOT NULL,
+    `description` TEXT,
+    `price` INTEGER NOT NULL,
+    `stock` INTEGER NOT NULL,
+    "image" TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS "users"(
+    userid INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    username TEXT NOT NULL,
+    hash BLOB NOT NULL,
+    privilege INTEGER NOT NULL,
+    name TEXT,
+    profile_image TEXT,
+    addr_l1 TEXT,
+    addr_l2 TEXT,
+    addr_l3 TEXT,
+    addr_city TEXT,
+    addr_county TEXT,
+    addr_postcode TEXT, `addr_save` INTEGER,
+    payment_num TEXT,
+    payment_exp TEXT,
+    `payment_save` INTEGER);
+
+CREATE TABLE IF NOT EXISTS "orders"(
+    orderid INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    placed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    userid int NOT NULL,
+    address TEXT NOT NULL,
+    cost int NOT NULL,
+    status TEXT NOT NULL,
+    FOREIGN KEY (userid) REFERENCES users(userid)
+);
+
+CREATE TABLE IF NOT EXISTS orderitems(
+    orderid int NOT NULL,
+    productid int NOT NULL,
+    quantity int NOT NULL,
+    PRIMARY KEY (orderid, productid),
+    FOREIGN KEY (orderid) REFERENCES orders(orderid),
+    FOREIGN KEY (productid) REFERENCES products(itemid)
+);
@@ -0,0 +1,7 @@
+-- /api/products price sorts and the cross-worker catalog cache version
+CREATE INDEX idx_products_price ON products (price, itemid);
+
+CREATE TABLE catalog_version (
+    name TEXT PRIMARY KEY NOT NULL,
+    version INTEGER NOT NULL
+);
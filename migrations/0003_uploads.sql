@@ -0,0 +1,25 @@
+-- image variants, background upload jobs and content-addressed upload refcounts
+ALTER TABLE products ADD COLUMN status TEXT NOT NULL DEFAULT 'active'; -- 'processing' until its upload job finishes
+
+CREATE TABLE imagevariants (
+    image TEXT NOT NULL,
+    width INTEGER NOT NULL,
+    format TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    PRIMARY KEY (image, width, format)
+);
+
+CREATE TABLE uploadjobs (
+    jobid INTEGER PRIMARY KEY AUTOINCREMENT,
+    itemid INTEGER NOT NULL,
+    upload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    claimed_at DATETIME,
+    FOREIGN KEY (itemid) REFERENCES products(itemid)
+);
+
+CREATE INDEX idx_uploadjobs_status ON uploadjobs (status, jobid);
+CREATE INDEX idx_products_image ON products (image);
@@ -0,0 +1,4 @@
+-- login/register/checkout look users up by name, order history joins orders -> orderitems -> products
+CREATE UNIQUE INDEX idx_users_username ON users (username);
+CREATE INDEX idx_orders_userid ON orders (userid);
+CREATE INDEX idx_orderitems_productid ON orderitems (productid);
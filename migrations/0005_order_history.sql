@@ -0,0 +1,3 @@
+-- /api/account/orders pages a user's orders by (placed_at, orderid); this index also covers userid lookups
+CREATE INDEX idx_orders_user_placed ON orders (userid, placed_at, orderid);
+DROP INDEX idx_orders_userid;
@@ -0,0 +1,10 @@
+-- server-side baskets; the session cookie only carries the sid
+CREATE TABLE baskets (
+    sid TEXT PRIMARY KEY NOT NULL,
+    userid INTEGER REFERENCES users(userid),
+    items TEXT NOT NULL DEFAULT '{}',
+    version INTEGER NOT NULL DEFAULT 1,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX idx_baskets_userid ON baskets (userid);
+CREATE INDEX idx_baskets_updated ON baskets (updated_at) WHERE userid IS NULL;
@@ -0,0 +1,7 @@
+-- per-row version for the product page fragment cache, bumped by any change a page shows
+ALTER TABLE products ADD COLUMN version INTEGER NOT NULL DEFAULT 1;
+
+CREATE TRIGGER products_version AFTER UPDATE OF name, description, price, stock, image, status ON products
+BEGIN
+    UPDATE products SET version = version + 1 WHERE itemid = NEW.itemid;
+END;
@@ -0,0 +1,22 @@
+-- full-text index over product names and descriptions for /api/search
+CREATE VIRTUAL TABLE products_fts USING fts5(
+    name, description,
+    content='products', content_rowid='itemid',
+    tokenize='unicode61 remove_diacritics 2',
+    prefix='2 3'
+);
+
+CREATE TRIGGER products_fts_insert AFTER INSERT ON products BEGIN
+    INSERT INTO products_fts (rowid, name, description) VALUES (NEW.itemid, NEW.name, NEW.description);
+END;
+
+CREATE TRIGGER products_fts_delete AFTER DELETE ON products BEGIN
+    INSERT INTO products_fts (products_fts, rowid, name, description) VALUES ('delete', OLD.itemid, OLD.name, OLD.description);
+END;
+
+CREATE TRIGGER products_fts_update AFTER UPDATE OF name, description ON products BEGIN
+    INSERT INTO products_fts (products_fts, rowid, name, description) VALUES ('delete', OLD.itemid, OLD.name, OLD.description);
+    INSERT INTO products_fts (rowid, name, description) VALUES (NEW.itemid, NEW.name, NEW.description);
+END;
+
+INSERT INTO products_fts (products_fts) VALUES ('rebuild');
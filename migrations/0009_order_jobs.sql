@@ -0,0 +1,15 @@
+-- durable queue driving orders through payment and fulfilment, drained by flask fulfil-orders
+CREATE TABLE orderjobs (
+    orderid INTEGER PRIMARY KEY,
+    status TEXT NOT NULL DEFAULT 'queued', -- queued, running, done or failed
+    attempts INTEGER NOT NULL DEFAULT 0, -- tries at the order's current step
+    error TEXT,
+    run_after DATETIME DEFAULT CURRENT_TIMESTAMP, -- pushed back after a failed try
+    claimed_at DATETIME,
+    FOREIGN KEY (orderid) REFERENCES orders(orderid)
+);
+
+CREATE INDEX idx_orderjobs_ready ON orderjobs (status, run_after);
+
+-- orders placed before the queue existed still need processing
+INSERT INTO orderjobs (orderid) SELECT orderid FROM orders WHERE status = 'ORDERED';
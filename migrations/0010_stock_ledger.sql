@@ -0,0 +1,20 @@
+-- append-only stock ledger; products.stock becomes a snapshot that compact_stock() folds movements into
+CREATE TABLE stockmovements (
+    moveid INTEGER PRIMARY KEY AUTOINCREMENT, -- never reused, so the compaction watermark only moves forward
+    itemid INTEGER NOT NULL,
+    quantity INTEGER NOT NULL, -- negative takes stock, positive puts it back
+    kind TEXT NOT NULL, -- 'sale' (held from checkout), 'release' (payment failed) or 'restock'
+    orderid INTEGER,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (itemid) REFERENCES products(itemid)
+);
+
+CREATE INDEX idx_stockmovements_item ON stockmovements (itemid, moveid);
+
+CREATE TABLE stockcompaction (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    moveid INTEGER NOT NULL, -- products.stock includes every movement up to and including this one
+    compacted_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT INTO stockcompaction (id, moveid) VALUES (1, 0);
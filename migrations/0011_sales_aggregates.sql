@@ -0,0 +1,37 @@
+-- sales summaries kept up to date by place_order(), backfill existing orders with flask rebuild-sales
+ALTER TABLE orderitems ADD COLUMN price INTEGER; -- unit price paid, NULL for orders placed before this migration
+
+CREATE TABLE salesdays (
+    day TEXT PRIMARY KEY, -- YYYY-MM-DD of orders.placed_at
+    orders INTEGER NOT NULL DEFAULT 0,
+    units INTEGER NOT NULL DEFAULT 0,
+    revenue INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+
+CREATE TABLE productsalesdays (
+    productid INTEGER NOT NULL,
+    day TEXT NOT NULL,
+    orders INTEGER NOT NULL DEFAULT 0,
+    units INTEGER NOT NULL DEFAULT 0,
+    revenue INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (productid, day)
+) WITHOUT ROWID;
+
+CREATE TABLE productsales (
+    productid INTEGER PRIMARY KEY,
+    orders INTEGER NOT NULL DEFAULT 0,
+    units INTEGER NOT NULL DEFAULT 0,
+    revenue INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE usersales (
+    userid INTEGER PRIMARY KEY,
+    orders INTEGER NOT NULL DEFAULT 0,
+    spent INTEGER NOT NULL DEFAULT 0,
+    last_order_at DATETIME
+);
+
+-- top sellers and top customers read the first rows of these
+CREATE INDEX idx_productsales_units ON productsales (units DESC, productid);
+CREATE INDEX idx_productsales_revenue ON productsales (revenue DESC, productid);
+CREATE INDEX idx_usersales_spent ON usersales (spent DESC, userid);
@@ -0,0 +1,10 @@
+-- "frequently bought together": how many orders contained both products, stored in both directions
+CREATE TABLE copurchases (
+    productid INTEGER NOT NULL,
+    relatedid INTEGER NOT NULL,
+    orders INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (productid, relatedid)
+) WITHOUT ROWID;
+
+-- a product's top neighbours are the first rows of its range
+CREATE INDEX idx_copurchases_top ON copurchases (productid, orders DESC, relatedid);
@@ -1,42 +1,186 @@
-function loadProductGrid() {
-    fetch("/api/products")
-        .then(response => response.json())
-        .then(data => {
-            if (!Array.isArray(data)) {
-                throw new Error("Invalid data format: Expected an array");
-            }
+const PRODUCT_PAGE_SIZE = 24;
+const SEARCH_DEBOUNCE_MS = 200;
+const IMAGE_SOURCE_FORMATS = ["avif", "webp"];
+
+// <picture> with avif/webp sources when the upload has variants, otherwise a plain <img>
+function renderPicture(image, srcset, alt, sizes) {
+    const picture = document.createElement("picture");
+    srcset = srcset || {};
+
+    IMAGE_SOURCE_FORMATS.forEach(format => {
+        if (srcset[format]) {
+            const source = document.createElement("source");
+            source.type = `image/${format}`;
+            source.srcset = srcset[format];
+            source.sizes = sizes;
+            picture.appendChild(source);
+        }
+    });
+
+    const img = document.createElement("img");
+    img.src = `../static/uploads/${encodeURIComponent(image)}`;
+    if (srcset.img) {
+        img.srcset = srcset.img;
+        img.sizes = sizes;
+    }
+    img.alt = alt;
+    picture.appendChild(img);
 
-            const container = document.getElementById("productContainer");
-            container.innerHTML = "";
+    return picture;
+}
 
-            data.forEach(product => {
-                const card = document.createElement("div");
-                card.className = "product-card";
-                card.id = product.itemid;
+function renderProductCard(product) {
+    const card = document.createElement("div");
+    card.className = "product-card";
+    card.id = product.itemid;
 
-                card.addEventListener("click", () => openProductPage(product.itemid));
+    card.addEventListener("click", () => openProductPage(product.itemid));
 
-                const img = document.createElement("img");
-                img.src = `../static/uploads/${encodeURIComponent(product.image)}`;
-                img.alt = product.name;
+    const picture = renderPicture(product.image, product.srcset, product.name, "(max-width: 768px) 60vw, 20vw");
+    picture.querySelector("img").loading = "lazy";
 
-                const title = document.createElement("h3");
-                title.textContent = product.name;
+    const title = document.createElement("h3");
+    title.textContent = product.name;
 
-                const price = document.createElement("h5");
-                price.style.float = "right";
-                price.textContent = `£${(product.price / 100).toFixed(2)}`;
+    const price = document.createElement("h5");
+    price.style.float = "right";
+    price.textContent = `£${(product.price / 100).toFixed(2)}`;
 
-                card.appendChild(img);
-                card.appendChild(title);
-                card.appendChild(price);
+    card.appendChild(picture);
+    card.appendChild(title);
+    card.appendChild(price);
+
+    return card;
+}
+
+let productGridObserver = null;
+let productGridGeneration = 0;
+
+// with a query the grid pages through /api/search instead of the whole catalog
+function loadProductGrid(query) {
+    const container = document.getElementById("productContainer");
+
+    // index() renders the first catalog page; keep those cards and carry on from its cursor
+    const hydrate = !query && "rendered" in container.dataset;
+    if (hydrate) {
+        delete container.dataset.rendered; // a later search or reset rebuilds from scratch
+        container.querySelectorAll(".product-card").forEach(card => {
+            card.addEventListener("click", () => openProductPage(card.id));
+        });
+    } else {
+        container.innerHTML = "";
+    }
 
-                container.appendChild(card);
+    // a newer search replaces this grid; its late responses are ignored
+    const generation = ++productGridGeneration;
+    if (productGridObserver) {
+        productGridObserver.disconnect();
+    }
+    const previous = document.getElementById("productSentinel");
+    if (previous) {
+        previous.remove();
+    }
+
+    // sentinel sits after the grid; when it scrolls into view the next page is fetched
+    const sentinel = document.createElement("div");
+    sentinel.id = "productSentinel";
+    container.after(sentinel);
+
+    let cursor = hydrate ? container.dataset.nextCursor || null : null;
+    let loading = false;
+    let finished = hydrate && cursor === null;
+
+    function loadNextPage() {
+        if (loading || finished) {
+            return;
+        }
+        loading = true;
+
+        const params = new URLSearchParams({ limit: PRODUCT_PAGE_SIZE });
+        if (query) {
+            params.set("q", query);
+        }
+        if (cursor !== null) {
+            params.set("after", cursor);
+        }
+
+        fetch(`${query ? "/api/search" : "/api/products"}?${params}`)
+            .then(response => {
+                cursor = response.headers.get("X-Next-Cursor");
+                return response.json();
+            })
+            .then(data => {
+                if (generation !== productGridGeneration) {
+                    return;
+                }
+                if (!Array.isArray(data)) {
+                    throw new Error("Invalid data format: Expected an array");
+                }
+
+                data.forEach(product => container.appendChild(renderProductCard(product)));
+
+                if (cursor === null) {
+                    finished = true;
+                    observer.disconnect();
+                    sentinel.remove();
+                }
+            })
+            .catch(error => {
+                finished = true; // don't keep retrying from the observer
+                console.error("Error loading products:", error);
+            })
+            .finally(() => {
+                loading = false;
+                if (!finished) {
+                    // re-observing re-checks the sentinel in case it is still on screen
+                    observer.unobserve(sentinel);
+                    observer.observe(sentinel);
+                }
             });
-        })
-        .catch(error => console.error("Error loading products:", error));
+    }
+
+    const observer = new IntersectionObserver(entries => {
+        if (entries.some(entry => entry.isIntersecting)) {
+            loadNextPage();
+        }
+    }, { rootMargin: "400px" });
+    productGridObserver = observer;
+
+    if (finished) {
+        sentinel.remove(); // the rendered page was the whole catalog
+        return;
+    }
+    observer.observe(sentinel);
+    if (!hydrate) {
+        loadNextPage(); // a hydrated grid waits for the sentinel instead
+    }
 }
 
+function attachProductSearch() {
+    const input = document.getElementById("productSearch");
+    let timer = null;
+
+    input.addEventListener("input", () => {
+        clearTimeout(timer);
+        timer = setTimeout(() => loadProductGrid(input.value.trim()), SEARCH_DEBOUNCE_MS);
+    });
+}
+
+
+// "frequently bought together" cards under a product; the section stays hidden when there are none
+function loadRelatedProducts(itemid) {
+    fetch(`/api/products/${itemid}/related`)
+        .then(response => response.json())
+        .then(products => {
+            if (!Array.isArray(products) || products.length == 0) {
+                return;
+            }
+            const container = document.getElementById("relatedContainer");
+            products.forEach(product => container.appendChild(renderProductCard(product)));
+            document.getElementById("relatedSection").hidden = false;
+        })
+        .catch(error => console.error("Error loading related products:", error));
+}
 
 function openProductPage(id){
     window.location.href = "/product?id=" + id;
@@ -51,7 +195,6 @@ function renderBasket(basketItems, total) {
         itemDiv.classList.add("basket-item");
 
         itemDiv.innerHTML = `
-            <img src="../static/uploads/${item[2]}" alt="${item[0]}">
             <div class="item-details">
                 <strong>${item[0]}</strong><br>
                 Price: £${((item[1])/100).toFixed(2)}<br>
@@ -62,6 +205,7 @@ function renderBasket(basketItems, total) {
                 </form>
             </div>
         `;
+        itemDiv.prepend(renderPicture(item[2], item[6], item[0], "80px"));
         
         container.appendChild(itemDiv);
     });
@@ -89,4 +233,69 @@ function renderBasket(basketItems, total) {
 
 function updateBasketQuantity(id){
     document.getElementById("quantityForm"+id).submit();
-}
\ No newline at end of file
+}
+
+function pollUploadJob(jobid) {
+    const status = document.getElementById("uploadStatus");
+
+    fetch(`/admin/uploadShopItem/${jobid}`)
+        .then(response => response.json())
+        .then(job => {
+            if (job.status == "done") {
+                status.textContent = "Product added";
+            } else if (job.status == "failed") {
+                status.textContent = `Error: image could not be processed (${job.error})`;
+            } else {
+                setTimeout(() => pollUploadJob(jobid), 1000);
+            }
+        })
+        .catch(error => console.error("Error checking upload:", error));
+}
+
+function renderOrders(orders, next) {
+    const container = document.getElementById("orderContainer");
+    const button = document.getElementById("moreOrdersBtn");
+
+    if (orders.length == 0 && container.children.length == 0) {
+        const empty = document.createElement("p");
+        empty.textContent = "You haven't placed any orders yet.";
+        container.appendChild(empty);
+    }
+
+    orders.forEach(order => {
+        const card = document.createElement("div");
+        card.className = "card mb-3";
+
+        const heading = document.createElement("div");
+        heading.className = "card-header d-flex justify-content-between";
+        heading.textContent = `Order #${order.orderid} - ${order.placed_at} - ${order.status}`;
+
+        const body = document.createElement("ul");
+        body.className = "list-group list-group-flush";
+        order.items.forEach(item => {
+            const line = document.createElement("li");
+            line.className = "list-group-item";
+            line.textContent = `${item.name} (x${item.quantity}) £${((item.price * item.quantity) / 100).toFixed(2)}`;
+            body.appendChild(line);
+        });
+
+        const total = document.createElement("div");
+        total.className = "card-footer";
+        total.textContent = `Total: £${(order.cost / 100).toFixed(2)} - ${order.address}`;
+
+        card.appendChild(heading);
+        card.appendChild(body);
+        card.appendChild(total);
+        container.appendChild(card);
+    });
+
+    button.style.display = next ? "block" : "none";
+    button.onclick = () => {
+        button.disabled = true;
+        fetch(`/api/account/orders?after=${encodeURIComponent(next)}`)
+            .then(response => response.json())
+            .then(data => renderOrders(data.orders, data.next))
+            .catch(error => console.error("Error loading orders:", error))
+            .finally(() => { button.disabled = false; });
+    };
+}
@@ -3,7 +3,17 @@ import pytest
 import os
 import bcrypt
 from unittest.mock import patch, MagicMock
+from werkzeug.datastructures import FileStorage
+import io
+import hashlib
+import sqlite3
+import threading
+import time
+import json
+import secrets
 from flask import url_for # Ensure url_for is imported
+import app as app_module
+from app import ConnectionPool, PoolTimeout
 
 # Helper function to add a product to the test database
 def add_product(db_conn, name, description, price, stock, image):
@@ -24,6 +34,18 @@ def add_user(db_conn, username, password, privilege="user"):
     db_conn.commit()
     return cursor.lastrowid
 
+# Helpers to seed and read the server-side basket behind a test client's session
+def set_basket(db_conn, sess, basket):
+    sess['sid'] = secrets.token_urlsafe(8)
+    db_conn.execute("INSERT OR REPLACE INTO baskets (sid, items) VALUES (?, ?);", (sess['sid'], json.dumps(basket)))
+    db_conn.commit()
+
+def saved_basket(client, db_conn):
+    with client.session_transaction() as sess:
+        sid = sess.get('sid')
+    row = db_conn.execute("SELECT items FROM baskets WHERE sid = ?;", (sid,)).fetchone()
+    return json.loads(row[0]) if row else {}
+
 class TestApp:
 
     def test_index_page(self, client):
@@ -50,6 +72,112 @@ class TestApp:
         assert products[0]['name'] == "Test Product 2" # Products are reversed
         assert products[1]['name'] == "Test Product 1"
 
+    def test_get_products_api_cached_with_etag(self, client, db_conn):
+        """Test that /api/products is served from cache and honours If-None-Match."""
+        add_product(db_conn, "Cached Product", "Desc", 1000, 10, "cached.jpg")
+        first = client.get('/api/products')
+        assert first.headers['ETag']
+
+        add_product(db_conn, "Uncached Product", "Desc", 1000, 10, "uncached.jpg") # bypasses invalidation
+        assert client.get('/api/products').data == first.data
+
+        response = client.get('/api/products', headers={'If-None-Match': first.headers['ETag']})
+        assert response.status_code == 304
+
+    def test_get_products_api_invalidated_by_stock_compaction(self, client, db_conn):
+        """Test that folding a checkout's stock movement into products invalidates the catalog cache."""
+        add_user(db_conn, "cacheuser", "password")
+        product_id = add_product(db_conn, "Stocked Product", "Desc", 1000, 10, "stocked.jpg")
+        first = client.get('/api/products')
+
+        add_product(db_conn, "Later Product", "Desc", 1000, 10, "later.jpg")
+        with client.session_transaction() as sess:
+            sess['username'] = 'cacheuser'
+            sess['privilege'] = 'user'
+            set_basket(db_conn, sess, {str(product_id): 1})
+        client.post('/checkout', data={'addr_l1': '1 Test St'})
+        app_module.compact_stock(db_conn) # no-op if the checkout already compacted
+
+        response = client.get('/api/products')
+        assert response.headers['ETag'] != first.headers['ETag']
+        assert len(response.json) == 2
+
+    def test_get_products_api_shared_version(self, client, db_conn):
+        """Test that a version bump from another worker invalidates the local cache."""
+        app_module.app.config['CATALOG_CACHE_SHARED'] = True
+        try:
+            add_product(db_conn, "Shared Product", "Desc", 1000, 10, "shared.jpg")
+            assert len(client.get('/api/products').json) == 1
+
+            # simulate another worker writing a product and bumping the version
+            cursor = db_conn.cursor()
+            add_product(db_conn, "Other Worker Product", "Desc", 1000, 10, "other.jpg")
+            app_module.bump_catalog_version(cursor)
+            db_conn.commit()
+
+            assert len(client.get('/api/products').json) == 2
+        finally:
+            app_module.app.config['CATALOG_CACHE_SHARED'] = False
+
+    def test_get_products_api_keyset_pagination(self, client, db_conn):
+        """Test walking /api/products page by page with the after cursor."""
+        ids = [add_product(db_conn, f"Page Product {i}", "Desc", 100, 1, "page.jpg") for i in range(5)]
+
+        first = client.get('/api/products?limit=2')
+        assert [p['itemid'] for p in first.json] == [ids[4], ids[3]]
+        assert first.headers['X-Next-Cursor'] == str(ids[3])
+
+        second = client.get(f"/api/products?limit=2&after={first.headers['X-Next-Cursor']}")
+        assert [p['itemid'] for p in second.json] == [ids[2], ids[1]]
+
+        last = client.get(f"/api/products?limit=2&after={second.headers['X-Next-Cursor']}")
+        assert [p['itemid'] for p in last.json] == [ids[0]]
+        assert 'X-Next-Cursor' not in last.headers
+
+    def test_get_products_api_price_sort_and_fields(self, client, db_conn):
+        """Test price ordering across pages and field selection."""
+        for price in (300, 100, 200, 100):
+            add_product(db_conn, f"Priced {price}", "Desc", price, 1, "priced.jpg")
+
+        first = client.get('/api/products?sort=price_asc&limit=2&fields=price')
+        assert [p['price'] for p in first.json] == [100, 100]
+        assert set(first.json[0]) == {"price"}
+
+        rest = client.get(f"/api/products?sort=price_asc&limit=2&fields=price&after={first.headers['X-Next-Cursor']}")
+        assert [p['price'] for p in rest.json] == [200, 300]
+
+        desc = client.get('/api/products?sort=price_desc&fields=itemid,price')
+        assert [p['price'] for p in desc.json] == [300, 200, 100, 100]
+
+    def test_get_products_api_rejects_bad_params(self, client):
+        """Test that unknown sorts, fields and non-integer cursors are rejected."""
+        assert client.get('/api/products?sort=random').status_code == 400
+        assert client.get('/api/products?fields=hash').status_code == 400
+        assert client.get('/api/products?after=abc').status_code == 400
+
+    def test_price_sort_uses_index(self, client, db_conn):
+        """Test that the price sort is served by an index rather than a temp b-tree."""
+        plan = db_conn.execute("EXPLAIN QUERY PLAN SELECT itemid, price FROM products ORDER BY price ASC, itemid ASC LIMIT 10;").fetchall()
+        assert any("idx_products_price" in row[-1] for row in plan)
+        assert not any("TEMP B-TREE" in row[-1] for row in plan)
+
+    def test_get_products_api_streaming(self, client, db_conn):
+        """Test streaming the whole catalog as a JSON array and as NDJSON."""
+        app_module.app.config['STREAM_BATCH_SIZE'] = 2
+        try:
+            ids = [add_product(db_conn, f"Stream {i}", "Desc", 100, 1, "stream.jpg") for i in range(5)]
+
+            response = client.get('/api/products?stream=1&limit=1')
+            assert response.is_streamed
+            assert [p['itemid'] for p in response.json] == ids[::-1]
+
+            response = client.get('/api/products?format=ndjson&fields=itemid')
+            assert response.mimetype == 'application/x-ndjson'
+            lines = response.data.decode().splitlines()
+            assert [json.loads(line) for line in lines] == [{"itemid": i} for i in ids[::-1]]
+        finally:
+            app_module.app.config['STREAM_BATCH_SIZE'] = 500
+
     def test_display_product_valid_id(self, client, db_conn):
         """Test displaying a single product with a valid ID."""
         product_id = add_product(db_conn, "Single Product", "Details", 1500, 20, "single.jpg")
@@ -58,6 +186,21 @@ class TestApp:
         assert b"Single Product" in response.data
         assert b"15.00" in response.data # Price formatting
 
+    def test_display_product_fragment_cached_per_version(self, client, db_conn):
+        """Test that the product body is rendered once per row version and re-rendered after a stock change."""
+        product_id = add_product(db_conn, "Fragment Product", "Details", 1500, 20, "fragment.jpg")
+        with patch('app.get_image_srcsets', wraps=app_module.get_image_srcsets) as srcsets:
+            client.get(f'/product?id={product_id}')
+            client.get(f'/product?id={product_id}')
+            assert srcsets.call_count == 1
+
+            db_conn.execute("UPDATE products SET stock = 7 WHERE itemid = ?;", (product_id,)) # e.g. another worker's checkout
+            db_conn.commit()
+            response = client.get(f'/product?id={product_id}')
+            assert srcsets.call_count == 2
+        assert b"Stock: 7" in response.data
+        assert b"Basket (0)" in response.data # header is still rendered per request
+
     def test_display_product_invalid_id(self, client):
         """Test displaying a single product with an invalid ID."""
         response = client.get('/product?id=99999')
@@ -67,46 +210,112 @@ class TestApp:
     def test_basket_add_item(self, client, db_conn):
         """Test adding an item to the basket."""
         product_id = add_product(db_conn, "Basket Item", "Desc", 500, 10, "basket.jpg")
-        with client.session_transaction() as sess:
-            sess["basket"] = {}
-        
         response = client.post('/basket', data={'itemid': product_id, 'quantity': 2})
         assert response.status_code == 200
-        with client.session_transaction() as sess:
-            assert sess["basket"][str(product_id)] == 2
+        assert saved_basket(client, db_conn)[str(product_id)] == 2
 
     def test_basket_update_quantity(self, client, db_conn):
         """Test updating an item's quantity in the basket."""
         product_id = add_product(db_conn, "Update Item", "Desc", 500, 10, "update.jpg")
         with client.session_transaction() as sess:
-            sess["basket"] = {str(product_id): 2}
+            set_basket(db_conn, sess, {str(product_id): 2})
         
         response = client.post('/basket', data={'itemid': product_id, 'new_quantity': 5})
         assert response.status_code == 200
-        with client.session_transaction() as sess:
-            assert sess["basket"][str(product_id)] == 5
+        assert saved_basket(client, db_conn)[str(product_id)] == 5
 
     def test_basket_remove_item(self, client, db_conn):
         """Test removing an item from the basket by setting quantity to 0."""
         product_id = add_product(db_conn, "Remove Item", "Desc", 500, 10, "remove.jpg")
         with client.session_transaction() as sess:
-            sess["basket"] = {str(product_id): 1}
+            set_basket(db_conn, sess, {str(product_id): 1})
         
         response = client.post('/basket', data={'itemid': product_id, 'new_quantity': 0})
         assert response.status_code == 200
-        with client.session_transaction() as sess:
-            assert str(product_id) not in sess["basket"]
+        assert str(product_id) not in saved_basket(client, db_conn)
 
     def test_basket_quantity_exceeds_stock(self, client, db_conn):
         """Test adding more items than available in stock."""
         product_id = add_product(db_conn, "Limited Stock", "Desc", 500, 3, "limited.jpg")
-        with client.session_transaction() as sess:
-            sess["basket"] = {}
-        
         response = client.post('/basket', data={'itemid': product_id, 'quantity': 5})
         assert response.status_code == 200
+        assert saved_basket(client, db_conn)[str(product_id)] == 3 # Should be limited to available stock
+
+    def test_basket_resolved_in_one_query(self, client, db_conn):
+        """Test that the whole basket is priced with a single products query once stock levels are in the view."""
+        ids = [add_product(db_conn, f"Item {i}", "Desc", 100 * (i + 1), 5, "item.jpg") for i in range(5)]
+        statements = []
+        with app_module.app.test_request_context('/basket'):
+            conn = app_module.get_db()
+            app_module.load_basket({str(itemid): 1 for itemid in ids}) # one extra query fills the stock view
+            conn.set_trace_callback(statements.append)
+            try:
+                snapshot = app_module.load_basket({str(itemid): 2 for itemid in ids})
+            finally:
+                conn.set_trace_callback(None)
+        assert len(statements) == 1
+        assert [line.itemid for line in snapshot.lines] == ids
+        assert snapshot.total == 2 * (100 + 200 + 300 + 400 + 500)
+
+    def test_basket_drops_missing_products(self, client, db_conn):
+        """Test that basket lines for deleted products are dropped and others clamped."""
+        product_id = add_product(db_conn, "Clamp Item", "Desc", 300, 2, "clamp.jpg")
+        with client.session_transaction() as sess:
+            set_basket(db_conn, sess, {str(product_id): 4, "99999": 1})
+
+        response = client.get('/basket')
+        assert response.status_code == 200
+        assert saved_basket(client, db_conn) == {str(product_id): 2}
+
+    def test_basket_cookie_carries_only_sid(self, client, db_conn):
+        """Test that a large basket stays server-side and the session cookie stays small."""
+        ids = [add_product(db_conn, f"Item {i}", "Desc", 100, 50, "item.jpg") for i in range(200)]
+        for itemid in ids:
+            client.post('/basket', data={'itemid': itemid, 'quantity': 1})
+        cookie = client.get_cookie('session')
+        assert len(cookie.value) < 200
+        assert len(saved_basket(client, db_conn)) == 200
+
+    def test_basket_revalidated_against_row_version(self, client, db_conn):
+        """Test that a basket changed by another worker is not served from the front cache."""
+        product_id = add_product(db_conn, "Shared Basket", "Desc", 100, 10, "shared.jpg")
+        client.post('/basket', data={'itemid': product_id, 'quantity': 1})
+        with client.session_transaction() as sess:
+            sid = sess['sid']
+        db_conn.execute("UPDATE baskets SET items = ?, version = version + 1 WHERE sid = ?;", (json.dumps({str(product_id): 4}), sid))
+        db_conn.commit()
+        assert b"Basket (4)" in client.get('/').data
+
+    def test_basket_survives_login(self, client, db_conn):
+        """Test that an anonymous basket is merged with the user's saved basket on login."""
+        user_id = add_user(db_conn, "shopper", "password")
+        saved = add_product(db_conn, "Saved", "Desc", 100, 10, "saved.jpg")
+        anonymous = add_product(db_conn, "Anonymous", "Desc", 100, 10, "anon.jpg")
+        db_conn.execute("INSERT INTO baskets (sid, userid, items) VALUES ('old-device', ?, ?);", (user_id, json.dumps({str(saved): 2})))
+        db_conn.commit()
+        client.post('/basket', data={'itemid': anonymous, 'quantity': 1})
+        with client.session_transaction() as sess:
+            anonymous_sid = sess['sid']
+
+        client.post('/login', data={'username': 'shopper', 'password': 'password'})
+        with client.session_transaction() as sess:
+            assert sess['sid'] != anonymous_sid # rotated on login
+        assert saved_basket(client, db_conn) == {str(anonymous): 1, str(saved): 2}
+        assert db_conn.execute("SELECT COUNT(*) FROM baskets WHERE userid = ?;", (user_id,)).fetchone()[0] == 1
+
+        client.get('/logout')
+        assert saved_basket(client, db_conn) == {}
+        client.post('/login', data={'username': 'shopper', 'password': 'password'})
+        assert saved_basket(client, db_conn) == {str(anonymous): 1, str(saved): 2}
+
+    def test_cookie_basket_store(self, client, db_conn, monkeypatch):
+        """Test that the cookie backend still keeps the basket in the session."""
+        monkeypatch.setitem(app_module.app.config, 'BASKET_STORE', 'cookie')
+        product_id = add_product(db_conn, "Cookie Item", "Desc", 500, 10, "cookie.jpg")
+        client.post('/basket', data={'itemid': product_id, 'quantity': 2})
         with client.session_transaction() as sess:
-            assert sess["basket"][str(product_id)] == 3 # Should be limited to available stock
+            assert sess['basket'] == {str(product_id): 2}
+        assert db_conn.execute("SELECT COUNT(*) FROM baskets;").fetchone()[0] == 0
 
     def test_register_successful(self, client, db_conn):
         """Test successful user registration."""
@@ -181,6 +390,88 @@ class TestApp:
         with client.session_transaction() as sess:
             assert 'username' not in sess
 
+    def test_login_rate_limited_per_username(self, client, db_conn, monkeypatch):
+        """Test that repeated logins for one username are rejected before hashing."""
+        monkeypatch.setitem(app_module.app.config, 'LOGIN_RATE_USERNAME', (2, 0))
+        add_user(db_conn, "limiteduser", "correctpassword")
+        for _ in range(2):
+            response = client.post('/login', data={'username': 'limiteduser', 'password': 'wrong'})
+            assert response.status_code == 200
+        checks = app_module.password_pool.stats()["checks"]
+
+        response = client.post('/login', data={'username': 'limiteduser', 'password': 'correctpassword'})
+        assert response.status_code == 429
+        assert app_module.password_pool.stats()["checks"] == checks # rejected without hashing
+
+    def test_login_rejected_when_hash_queue_full(self, client, db_conn, monkeypatch):
+        """Test that logins are turned away with 503 once the hashing queue is full."""
+        monkeypatch.setitem(app_module.app.config, 'PASSWORD_QUEUE_MAX', 0)
+        add_user(db_conn, "busyuser", "password")
+        response = client.post('/login', data={'username': 'busyuser', 'password': 'password'})
+        assert response.status_code == 503
+        with client.session_transaction() as sess:
+            assert 'username' not in sess
+
+    def test_login_rehashes_with_new_work_factor(self, client, db_conn, monkeypatch):
+        """Test that a successful login upgrades a hash made with an old work factor."""
+        monkeypatch.setitem(app_module.app.config, 'BCRYPT_ROUNDS', 4)
+        add_user(db_conn, "rehashuser", "password") # hashed with bcrypt's default of 12 rounds
+        response = client.post('/login', data={'username': 'rehashuser', 'password': 'password'})
+        assert response.status_code == 302
+
+        stored = db_conn.execute("SELECT hash FROM users WHERE username = 'rehashuser';").fetchone()[0]
+        assert app_module.bcrypt_rounds(stored) == 4
+        assert bcrypt.checkpw(b"password", stored)
+
+    def test_timed_out_hash_still_counts_against_queue(self, monkeypatch):
+        """Test that a hash we stopped waiting for keeps its queue slot until its worker finishes."""
+        from concurrent.futures import ThreadPoolExecutor
+        monkeypatch.setitem(app_module.app.config, 'PASSWORD_TIMEOUT', 0.05)
+        monkeypatch.setitem(app_module.app.config, 'PASSWORD_QUEUE_MAX', 1)
+        pool = app_module.PasswordPool()
+        pool.executor = ThreadPoolExecutor(1)
+        release = threading.Event()
+        slow = lambda: (release.wait(5), 0.0)
+
+        with pytest.raises(app_module.PasswordBusy):
+            pool.run("checks", slow)
+        assert pool.stats()["pending"] == 1
+        with pytest.raises(app_module.PasswordBusy):
+            pool.run("checks", slow) # still full, so turned away without queueing
+        assert pool.stats()["rejected"] == 1
+
+        release.set()
+        pool.executor.shutdown(wait=True)
+        assert pool.stats()["pending"] == 0
+
+    def test_login_succeeds_when_rehash_is_busy(self, client, db_conn, monkeypatch):
+        """Test that a verified password logs in even if the work-factor upgrade can't run."""
+        monkeypatch.setitem(app_module.app.config, 'BCRYPT_ROUNDS', 4)
+        add_user(db_conn, "busyrehash", "password")
+        def busy(password):
+            raise app_module.PasswordBusy()
+        monkeypatch.setattr(app_module.password_pool, 'hash', busy)
+
+        response = client.post('/login', data={'username': 'busyrehash', 'password': 'password'})
+        assert response.status_code == 302
+        with client.session_transaction() as sess:
+            assert sess['username'] == 'busyrehash'
+        stored = db_conn.execute("SELECT hash FROM users WHERE username = 'busyrehash';").fetchone()[0]
+        assert app_module.bcrypt_rounds(stored) == 12 # upgraded on a later login
+
+    def test_password_pool_metrics(self, client, db_conn):
+        """Test that hashing runs through the pool and reports queue wait and hash time."""
+        before = app_module.password_pool.stats()
+        client.post('/register', data={'username': 'pooluser', 'password': 'pw', 'cpassword': 'pw'})
+
+        with client.session_transaction() as sess:
+            sess['username'] = 'admin'
+            sess['privilege'] = 'admin'
+        stats = client.get('/admin/passwordpool').json
+        assert stats["hashes"] == before["hashes"] + 1
+        assert stats["hash_time"] > before["hash_time"]
+        assert stats["queue_wait"] >= 0
+
     def test_logout(self, client, db_conn):
         """Test user logout functionality."""
         add_user(db_conn, "logoutuser", "password")
@@ -207,7 +498,7 @@ class TestApp:
         with client.session_transaction() as sess:
             sess['username'] = 'checkoutuser'
             sess['privilege'] = 'user'
-            sess['basket'] = {}
+            set_basket(db_conn, sess, {})
 
         response = client.get('/checkout')
         assert response.status_code == 200
@@ -222,7 +513,7 @@ class TestApp:
         with client.session_transaction() as sess:
             sess['username'] = 'checkouttest'
             sess['privilege'] = 'user'
-            sess['basket'] = {str(product_id): 2}
+            set_basket(db_conn, sess, {str(product_id): 2})
 
         response = client.post('/checkout', data={
             'addr_l1': '123 Test St',
@@ -247,10 +538,1140 @@ class TestApp:
         assert order[1] == 5000
         assert order[2] == "ORDERED"
 
+    def test_export_orders_streams_grouped_items(self, client, db_conn):
+        """Test the admin order export nests order items under their order."""
+        user_id = add_user(db_conn, "exportuser", "password")
+        cursor = db_conn.cursor()
+        cursor.execute("INSERT INTO orders (userid, address, cost, status) VALUES (?, 'a', 300, 'ORDERED');", (user_id,))
+        first = cursor.lastrowid
+        cursor.executemany("INSERT INTO orderitems (orderid, productid, quantity) VALUES (?, ?, ?);", [(first, 1, 1), (first, 2, 2)])
+        cursor.execute("INSERT INTO orders (userid, address, cost, status) VALUES (?, 'b', 0, 'ORDERED');", (user_id,))
+        db_conn.commit()
+
+        assert client.get('/admin/export/orders').status_code == 403
+
+        with client.session_transaction() as sess:
+            sess['username'] = 'admin'
+            sess['privilege'] = 'admin'
+        orders = client.get('/admin/export/orders').json
+        assert [o['orderid'] for o in orders] == [first, first + 1]
+        assert orders[0]['items'] == [{"productid": 1, "quantity": 1}, {"productid": 2, "quantity": 2}]
+        assert orders[1]['items'] == []
+
+        lines = client.get('/admin/export/orders?format=ndjson').data.decode().splitlines()
+        assert len(lines) == 2
+
+    def test_upload_generates_image_variants(self, client, db_conn, tmp_path, monkeypatch):
+        """Test that an upload is stored with thumbnails and modern-format variants."""
+        Image = pytest.importorskip("PIL.Image")
+        monkeypatch.setitem(app_module.app.config, 'UPLOAD_FOLDER', str(tmp_path))
+        image = io.BytesIO()
+        Image.new('RGB', (400, 300), 'red').save(image, 'PNG')
+        image.seek(0)
+
+        response = client.post('/admin/uploadShopItem', data={
+            'name': 'Variant Product', 'description': 'Desc', 'price': '100', 'stock': '1',
+            'image': (image, 'red.png'),
+        }, content_type='multipart/form-data')
+        assert response.status_code == 202
+        assert app_module.upload_workers.drain(timeout=10)
+
+        stored = db_conn.execute("SELECT image FROM products WHERE name = 'Variant Product';").fetchone()[0]
+        variants = db_conn.execute("SELECT width, format, filename FROM imagevariants WHERE image = ?;", (stored,)).fetchall()
+        assert (400, 'img', stored) in variants
+        assert {(160, 'img'), (320, 'img'), (400, 'webp')} <= {(w, f) for w, f, _ in variants}
+        for _, _, filename in variants:
+            assert (tmp_path / filename).exists()
+
+        product = client.get('/api/products').json[0]
+        assert "160w" in product['srcset']['img']
+        assert "/static/uploads/variants/" in product['srcset']['webp']
+
+        response = client.get(f"/product?id={product['itemid']}")
+        assert b'type="image/webp"' in response.data
+
+    def test_backfill_images_invalidates_cached_catalog(self, client, db_conn, tmp_path, monkeypatch):
+        """Test that flask backfill-images bumps the versions other workers cache grids and pages by."""
+        Image = pytest.importorskip("PIL.Image")
+        monkeypatch.setitem(app_module.app.config, 'UPLOAD_FOLDER', str(tmp_path))
+        monkeypatch.setitem(app_module.app.config, 'CATALOG_CACHE_SHARED', True)
+        Image.new('RGB', (400, 300), 'blue').save(tmp_path / "blue.png", 'PNG')
+        product_id = add_product(db_conn, "Backfilled", "Desc", 100, 5, "blue.png")
+        assert 'srcset' not in client.get('/api/products').json[0]
+        catalog_version = db_conn.execute("SELECT COALESCE(MAX(version), 0) FROM catalog_version;").fetchone()[0]
+
+        result = app_module.app.test_cli_runner().invoke(args=['backfill-images'])
+        assert result.exit_code == 0
+        assert db_conn.execute("SELECT version FROM products WHERE itemid = ?;", (product_id,)).fetchone()[0] == 2
+        assert db_conn.execute("SELECT MAX(version) FROM catalog_version;").fetchone()[0] == catalog_version + 1
+        assert "160w" in client.get('/api/products').json[0]['srcset']['img']
+
+    def test_upload_returns_before_processing(self, client, db_conn, tmp_path, monkeypatch):
+        """Test that an upload is queued as a job and the product stays hidden until it finishes."""
+        monkeypatch.setitem(app_module.app.config, 'UPLOAD_FOLDER', str(tmp_path))
+        monkeypatch.setattr(app_module.upload_workers, 'notify', lambda: None) # keep the job queued
+
+        response = client.post('/admin/uploadShopItem', data={
+            'name': 'Queued Product', 'description': 'Desc', 'price': '100', 'stock': '1',
+            'image': (io.BytesIO(b"not really a gif"), 'queued.gif'),
+        }, content_type='multipart/form-data')
+        assert response.status_code == 202
+
+        itemid, status = db_conn.execute("SELECT itemid, status FROM products WHERE name = 'Queued Product';").fetchone()
+        assert status == 'processing'
+        assert client.get('/api/products').json == []
+        assert client.get(f'/product?id={itemid}').status_code == 302
+
+        jobid, spooled = db_conn.execute("SELECT jobid, upload FROM uploadjobs WHERE itemid = ?;", (itemid,)).fetchone()
+        assert os.path.exists(os.path.join(app_module.app.config['UPLOAD_SPOOL_FOLDER'], spooled)) # not under static/ until checked
+        assert os.listdir(tmp_path) == []
+        assert client.get(f'/admin/uploadShopItem/{jobid}').status_code == 403
+        with client.session_transaction() as sess:
+            sess['username'] = 'admin'
+            sess['privilege'] = 'admin'
+        job = client.get(f'/admin/uploadShopItem/{jobid}').json
+        assert job['status'] == 'queued'
+        assert job['itemid'] == itemid
+
+    def test_upload_jobs_resume_from_table(self, client, db_conn, tmp_path, monkeypatch):
+        """Test that queued jobs left in the table by a previous process are processed."""
+        monkeypatch.setitem(app_module.app.config, 'UPLOAD_FOLDER', str(tmp_path))
+        (tmp_path / "incoming").mkdir()
+        (tmp_path / "incoming" / "leftover.gif").write_bytes(b"GIF89a")
+        cursor = db_conn.cursor()
+        cursor.execute("INSERT INTO products (name, description, price, stock, image, status) VALUES ('Leftover', 'Desc', 100, 1, '', 'processing');")
+        itemid = cursor.lastrowid
+        cursor.execute("INSERT INTO uploadjobs (itemid, upload) VALUES (?, 'incoming/leftover.gif');", (itemid,))
+        jobid = cursor.lastrowid
+        db_conn.commit()
+
+        app_module.upload_workers.notify()
+        assert app_module.upload_workers.drain(timeout=10)
+
+        image, status = db_conn.execute("SELECT image, status FROM products WHERE itemid = ?;", (itemid,)).fetchone()
+        assert status == 'active'
+        assert (tmp_path / image).read_bytes() == b"GIF89a"
+        assert not (tmp_path / "incoming" / "leftover.gif").exists()
+        with client.session_transaction() as sess:
+            sess['username'] = 'admin'
+            sess['privilege'] = 'admin'
+        assert client.get(f'/admin/uploadShopItem/{jobid}').json['status'] == 'done'
+
+    def test_failed_upload_job_removes_spooled_file(self, client, db_conn, tmp_path, monkeypatch):
+        """Test that a job out of attempts deletes its spooled upload and marks the product failed."""
+        monkeypatch.setitem(app_module.app.config, 'UPLOAD_FOLDER', str(tmp_path))
+        monkeypatch.setitem(app_module.app.config, 'UPLOAD_JOB_ATTEMPTS', 1)
+        def unreadable(file):
+            raise OSError("cannot identify image file")
+        monkeypatch.setattr(app_module, 'check_uploaded_file', unreadable)
+        spooled = app_module.spool_upload(FileStorage(stream=io.BytesIO(b"GIF89a"), filename="broken.gif"))
+        cursor = db_conn.cursor()
+        cursor.execute("INSERT INTO products (name, description, price, stock, image, status) VALUES ('Broken', 'Desc', 100, 1, '', 'processing');")
+        itemid = cursor.lastrowid
+        cursor.execute("INSERT INTO uploadjobs (itemid, upload) VALUES (?, ?);", (itemid, spooled))
+        db_conn.commit()
+
+        app_module.upload_workers.notify()
+        assert app_module.upload_workers.drain(timeout=10)
+        assert db_conn.execute("SELECT status FROM products WHERE itemid = ?;", (itemid,)).fetchone()[0] == 'failed'
+        assert not os.path.exists(app_module.spool_path(spooled))
+
+    def test_duplicate_uploads_share_one_file(self, client, db_conn, tmp_path, monkeypatch):
+        """Test that identical uploads are stored once under their content hash."""
+        monkeypatch.setitem(app_module.app.config, 'UPLOAD_FOLDER', str(tmp_path))
+        for name in ("First Copy", "Second Copy"):
+            client.post('/admin/uploadShopItem', data={
+                'name': name, 'description': 'Desc', 'price': '100', 'stock': '1',
+                'image': (io.BytesIO(b"GIF89a same bytes"), f'{name}.gif'),
+            }, content_type='multipart/form-data')
+            assert app_module.upload_workers.drain(timeout=10)
+
+        images = [row[0] for row in db_conn.execute("SELECT image FROM products ORDER BY itemid;")]
+        assert images[0] == images[1]
+        assert images[0] == hashlib.sha256(b"GIF89a same bytes").hexdigest()[:32] + ".gif"
+        assert sorted(p.name for p in tmp_path.glob("*.gif")) == [images[0]]
+
+        # still referenced by both products, so it must not be deleted
+        assert app_module.upload_refcount(db_conn, images[0]) == 2
+        assert not app_module.discard_upload(db_conn, images[0])
+        assert (tmp_path / images[0]).exists()
+
+    def test_uploads_served_with_immutable_cache_headers(self, client):
+        """Test that uploaded images are cacheable forever alongside the CSP headers."""
+        response = client.get('/static/uploads/bcgneimzhbplrodf.png')
+        assert response.status_code == 200
+        assert 'immutable' in response.headers['Cache-Control']
+        assert 'Content-Security-Policy' in response.headers
+        response.close()
+
+        response = client.get('/static/script.js')
+        assert 'immutable' not in response.headers.get('Cache-Control', '')
+        response.close()
+
+    def test_checkout_rejects_stock_shortfall(self, client, db_conn):
+        """Test that an order fails as a whole when any line is short of stock."""
+        add_user(db_conn, "shortuser", "password")
+        plenty = add_product(db_conn, "Plenty", "Desc", 100, 10, "plenty.jpg")
+        scarce = add_product(db_conn, "Scarce", "Desc", 100, 2, "scarce.jpg")
+        with client.session_transaction() as sess:
+            sess['username'] = 'shortuser'
+            sess['privilege'] = 'user'
+            set_basket(db_conn, sess, {str(plenty): 3, str(scarce): 2})
+
+        # another buyer takes the scarce stock after our basket was priced
+        snapshot = app_module.BasketSnapshot([app_module.BasketLine(scarce, "Scarce", 100, "scarce.jpg", 2, 2), app_module.BasketLine(plenty, "Plenty", 100, "plenty.jpg", 10, 3)])
+        db_conn.execute("UPDATE products SET stock = 1 WHERE itemid = ?;", (scarce,))
+        db_conn.commit()
+        with app_module.app.test_request_context('/checkout'):
+            with pytest.raises(app_module.OutOfStock) as error:
+                app_module.run_transaction(app_module.get_db(), lambda cursor: app_module.place_order(cursor, 1, "addr", snapshot.lines))
+        assert [line.itemid for line in error.value.lines] == [scarce]
+
+        assert db_conn.execute("SELECT stock FROM products WHERE itemid = ?;", (plenty,)).fetchone()[0] == 10
+        assert db_conn.execute("SELECT COUNT(*) FROM orders;").fetchone()[0] == 0
+        assert db_conn.execute("SELECT COUNT(*) FROM orderitems;").fetchone()[0] == 0
+
+    def test_checkout_database_error_is_not_reported_as_stock(self, client, db_conn, monkeypatch):
+        """Test that a failed write shows the retry message rather than blaming stock."""
+        monkeypatch.setitem(app_module.app.config, 'DB_BUSY_RETRIES', 0)
+        add_user(db_conn, "lockeduser", "password")
+        product_id = add_product(db_conn, "Locked Product", "Desc", 100, 10, "locked.jpg")
+        with client.session_transaction() as sess:
+            sess['username'] = 'lockeduser'
+            sess['privilege'] = 'user'
+            set_basket(db_conn, sess, {str(product_id): 1})
+
+        def locked(*args):
+            raise sqlite3.OperationalError("database is locked")
+        monkeypatch.setattr(app_module, 'place_order', locked)
+        response = client.post('/checkout', data={'addr_l1': '1 Test St', 'addr_city': 'Testville', 'addr_postcode': 'T3S T0ST'})
+        assert b"your order could not be placed, please try again" in response.data
+        assert b"not enough stock" not in response.data
+
+    def test_run_transaction_retries_when_busy(self, client, db_conn, monkeypatch):
+        """Test that a write blocked by another writer is retried rather than failing."""
+        monkeypatch.setitem(app_module.app.config, 'DB_BUSY_BACKOFF', 0.01)
+        attempts = []
+
+        def work(cursor):
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise sqlite3.OperationalError("database is locked")
+            cursor.execute("INSERT INTO users (username, hash, privilege) VALUES ('retried', 'x', 'user');")
+
+        with app_module.app.test_request_context('/checkout'):
+            app_module.run_transaction(app_module.get_db(), work)
+        assert len(attempts) == 3
+        assert db_conn.execute("SELECT COUNT(*) FROM users WHERE username = 'retried';").fetchone()[0] == 1
+
+    def test_search_ranks_name_matches_and_prefixes(self, client, db_conn):
+        """Test BM25 ranking with name matches first, and prefix matching on the last word."""
+        in_name = add_product(db_conn, "Walnut Desk", "A sturdy desk", 100, 5, "desk.jpg")
+        in_description = add_product(db_conn, "Office Chair", "Pairs with any walnut desk", 100, 5, "chair.jpg")
+        add_product(db_conn, "Brass Lamp", "Bright", 100, 5, "lamp.jpg")
+
+        response = client.get('/api/search?q=walnut')
+        assert [product['itemid'] for product in response.json] == [in_name, in_description]
+        assert [product['itemid'] for product in client.get('/api/search?q=wal').json] == [in_name, in_description]
+        assert [product['itemid'] for product in client.get('/api/search?q=desk+cha').json] == [in_description]
+        assert client.get('/api/search?q="); DROP TABLE products; --').status_code == 200
+        assert client.get('/api/search?q=%20').status_code == 400
+
+    def test_search_paginates_with_cursor(self, client, db_conn):
+        """Test that X-Next-Cursor walks every match exactly once."""
+        ids = {add_product(db_conn, f"Linen Towel {i}", "Soft", 100, 5, "towel.jpg") for i in range(7)}
+        seen, after = [], None
+        while True:
+            response = client.get('/api/search', query_string={'q': 'linen', 'limit': 3, **({'after': after} if after else {})})
+            seen += [product['itemid'] for product in response.json]
+            after = response.headers.get('X-Next-Cursor')
+            if not after:
+                break
+        assert sorted(seen) == sorted(ids)
+        assert client.get('/api/search?q=linen&after=notacursor').status_code == 400
+        for bad in ([{"a": 1}, 2], [-1.5, "2"], ["x", 2], [-1.5, True]):
+            assert client.get(f'/api/search?q=linen&after={app_module.encode_cursor(*bad)}').status_code == 400
+
+    def test_search_index_follows_product_writes(self, client, db_conn):
+        """Test that the triggers keep the index in sync with uploads, edits and deletes."""
+        add_user(db_conn, "searchadmin", "password", privilege="admin")
+        with client.session_transaction() as sess:
+            sess['username'] = 'searchadmin'
+            sess['privilege'] = 'admin'
+        client.post('/admin/uploadShopItem', data={'name': 'Copper Kettle', 'description': 'Whistles', 'price': '100', 'stock': '1'},
+                    content_type='multipart/form-data')
+        itemid = client.get('/api/search?q=kettle').json[0]['itemid']
+
+        db_conn.execute("UPDATE products SET name = 'Steel Kettle' WHERE itemid = ?;", (itemid,))
+        db_conn.commit()
+        app_module.catalog_cache.invalidate()
+        assert client.get('/api/search?q=copper').json == []
+        assert client.get('/api/search?q=steel').json[0]['itemid'] == itemid
+
+        db_conn.execute("UPDATE products SET status = 'processing' WHERE itemid = ?;", (itemid,))
+        db_conn.commit()
+        app_module.catalog_cache.invalidate()
+        assert client.get('/api/search?q=steel').json == [] # hidden like /api/products
+
+        db_conn.execute("DELETE FROM products WHERE itemid = ?;", (itemid,))
+        db_conn.commit()
+        assert db_conn.execute("SELECT COUNT(*) FROM products_fts WHERE products_fts MATCH 'kettle';").fetchone()[0] == 0
+
+    def test_bulk_import_csv_with_images(self, client, db_conn, tmp_path, monkeypatch):
+        """Test a streamed CSV import: batched inserts, per-row errors, and images handed to the upload workers."""
+        import zipfile
+        monkeypatch.setitem(app_module.app.config, 'UPLOAD_FOLDER', str(tmp_path))
+        monkeypatch.setitem(app_module.app.config, 'IMPORT_BATCH_SIZE', 2)
+        add_user(db_conn, "importer", "password", privilege="admin")
+        with client.session_transaction() as sess:
+            sess['username'] = 'importer'
+            sess['privilege'] = 'admin'
+
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w') as z:
+            z.writestr('photos/mug.png', b"mug bytes")
+            z.writestr('photos/bowl.png', b"mug bytes") # same content, stored once
+        archive.seek(0)
+        catalog = io.BytesIO(("name,description,price,stock,image\n"
+                              "Mug,Holds tea,500,10,photos/mug.png\n"
+                              ",No name,100,1,\n"
+                              "Bowl,Holds soup,700,3,photos/bowl.png\n"
+                              "Spoon,Stirs,abc,1,\n"
+                              "Plate,Flat,300,4,\n"
+                              "Cup,Small,200,2,photos/missing.png\n").encode())
+
+        response = client.post('/admin/import', data={'catalog': (catalog, 'catalog.csv'), 'images': (archive, 'images.zip')},
+                               content_type='multipart/form-data')
+        lines = [json.loads(line) for line in response.data.decode().splitlines()]
+        summary = lines[-1]
+        assert lines[0] == {"rows": 3, "imported": 2, "failed": 1}
+        assert summary["done"] and summary["imported"] == 3 and summary["images"] == 2
+        assert [(error["line"], error["error"]) for error in summary["errors"]] == [
+            (3, "name is required"), (5, "price and stock must be integers"), (7, "photos/missing.png is not in the image archive")]
+
+        assert app_module.upload_workers.drain(timeout=10)
+        rows = db_conn.execute("SELECT name, image, status FROM products ORDER BY itemid;").fetchall()
+        assert [(name, status) for name, _, status in rows] == [("Mug", "active"), ("Bowl", "active"), ("Plate", "active")]
+        assert rows[0][1] == rows[1][1] == hashlib.sha256(b"mug bytes").hexdigest()[:32] + ".png"
+        assert len(client.get('/api/search?q=holds').json) == 2
+
+    def test_bulk_import_ndjson_cli(self, client, db_conn, tmp_path):
+        """Test the import-products command with an NDJSON catalog and no images."""
+        path = tmp_path / "catalog.ndjson"
+        path.write_text('{"name": "Teapot", "price": 1500, "stock": 2}\n\nnot json\n{"name": "Kettle", "price": 2500, "stock": 1}\n')
+        result = app_module.app.test_cli_runner().invoke(args=['import-products', str(path)])
+        assert "2 imported, 1 failed" in result.output
+        assert "line 3: not a valid record" in result.output
+        assert db_conn.execute("SELECT COUNT(*) FROM products WHERE status = 'active';").fetchone()[0] == 2
+
+    def test_bulk_import_requires_admin(self, client):
+        """Test that only admins can import."""
+        response = client.post('/admin/import', data={'catalog': (io.BytesIO(b"name\n"), 'catalog.csv')}, content_type='multipart/form-data')
+        assert response.status_code == 403
+
+    def test_account_orders_paginated_and_grouped(self, client, db_conn):
+        """Test the order-history API groups items per order and pages by keyset."""
+        user_id = add_user(db_conn, "historyuser", "password")
+        other_id = add_user(db_conn, "otheruser", "password")
+        product_id = add_product(db_conn, "History Product", "Desc", 250, 10, "history.jpg")
+        cursor = db_conn.cursor()
+        order_ids = []
+        for day in (1, 2, 3):
+            cursor.execute("INSERT INTO orders (userid, placed_at, address, cost, status) VALUES (?, ?, 'addr', 500, 'ORDERED');", (user_id, f"2025-01-0{day} 12:00:00"))
+            order_ids.append(cursor.lastrowid)
+            cursor.execute("INSERT INTO orderitems (orderid, productid, quantity) VALUES (?, ?, 2);", (cursor.lastrowid, product_id))
+        cursor.execute("INSERT INTO orders (userid, address, cost, status) VALUES (?, 'addr', 1, 'ORDERED');", (other_id,))
+        db_conn.commit()
+
+        assert client.get('/api/account/orders').status_code == 401
+        with client.session_transaction() as sess:
+            sess['username'] = 'historyuser'
+            sess['privilege'] = 'user'
+
+        first = client.get('/api/account/orders?limit=2').json
+        assert [o['orderid'] for o in first['orders']] == [order_ids[2], order_ids[1]]
+        assert first['orders'][0]['items'] == [{"productid": product_id, "quantity": 2, "name": "History Product", "price": 250, "image": "history.jpg"}]
+
+        second = client.get(f"/api/account/orders?limit=2&after={first['next']}").json
+        assert [o['orderid'] for o in second['orders']] == [order_ids[0]]
+        assert second['next'] is None
+
+        assert client.get('/api/account/orders?after=not-a-cursor').status_code == 400
+        for bad in ([{"a": 1}, 2], [[1], 2], ["2025-01-01 12:00:00", "2"]):
+            assert client.get(f'/api/account/orders?after={app_module.encode_cursor(*bad)}').status_code == 400
+
+        response = client.get('/account')
+        assert response.status_code == 200
+        assert b"renderOrders(" in response.data
+
+    def test_account_orders_show_price_paid(self, client, db_conn):
+        """Test that order history keeps the unit price paid after the product is repriced."""
+        user_id = add_user(db_conn, "repriced", "password")
+        product_id = add_product(db_conn, "Repriced Product", "Desc", 250, 10, "repriced.jpg")
+        line = app_module.BasketLine(product_id, "Repriced Product", 250, "repriced.jpg", 10, 2)
+        app_module.run_transaction(db_conn, lambda cursor: app_module.place_order(cursor, user_id, "addr", [line]))
+        db_conn.execute("UPDATE products SET price = 999 WHERE itemid = ?;", (product_id,))
+        db_conn.commit()
+
+        with client.session_transaction() as sess:
+            sess['username'] = 'repriced'
+            sess['privilege'] = 'user'
+        order = client.get('/api/account/orders').json['orders'][0]
+        assert [item['price'] for item in order['items']] == [250]
+        assert sum(item['price'] * item['quantity'] for item in order['items']) == order['cost']
+
+    def test_account_orders_single_query_per_page(self, client, db_conn):
+        """Test that a page of order history costs one query and uses the index."""
+        add_user(db_conn, "planuser", "password")
+        statements = []
+        with app_module.app.test_request_context('/api/account/orders'):
+            conn = app_module.get_db()
+            conn.set_trace_callback(statements.append)
+            try:
+                app_module.load_order_page("planuser", ["2025-01-01 00:00:00", 5], 10)
+            finally:
+                conn.set_trace_callback(None)
+        assert len(statements) == 1
+        plan = " | ".join(row[-1] for row in db_conn.execute("EXPLAIN QUERY PLAN " + statements[0]))
+        assert "idx_orders_user_placed" in plan
+
+    def test_app_imports_from_another_directory(self, tmp_path):
+        """Test that module-level paths resolve against the app, not the working directory."""
+        import subprocess
+        import sys
+        env = dict(os.environ, PYTHONPATH=app_module.app.root_path)
+        result = subprocess.run([sys.executable, "-c", "import app"], cwd=tmp_path, env=env, capture_output=True, text=True)
+        assert result.returncode == 0, result.stderr
+
     # Test the add_headers security measures (basic check)
     def test_security_headers(self, client):
         response = client.get('/')
         assert 'Content-Security-Policy' in response.headers
         assert 'X-Content-Type-Options' in response.headers
         assert "default-src 'self'" in response.headers['Content-Security-Policy']
-        assert "nosniff" in response.headers['X-Content-Type-Options']
\ No newline at end of file
+        assert "nosniff" in response.headers['X-Content-Type-Options']
+
+    def test_product_page_not_modified_before_render(self, client, db_conn):
+        """Test that a product page revalidates to 304 without rendering, until the row changes."""
+        product_id = add_product(db_conn, "Conditional Product", "Details", 1500, 20, "conditional.jpg")
+        first = client.get(f'/product?id={product_id}')
+        etag = first.headers['ETag']
+        assert etag.startswith('W/')
+
+        with patch('app.render_template') as render:
+            response = client.get(f'/product?id={product_id}', headers={'If-None-Match': etag})
+            assert response.status_code == 304
+            assert not render.called
+
+        db_conn.execute("UPDATE products SET price = 1200 WHERE itemid = ?;", (product_id,))
+        db_conn.commit()
+        assert client.get(f'/product?id={product_id}', headers={'If-None-Match': etag}).status_code == 200
+
+    def test_dynamic_response_compressed(self, client, db_conn):
+        """Test that large JSON is gzipped with its own ETag, which then revalidates to 304."""
+        import gzip
+        for i in range(30):
+            add_product(db_conn, f"Compressible {i}", "Desc " * 20, 1000, 10, "c.jpg")
+        plain = client.get('/api/products')
+        response = client.get('/api/products', headers={'Accept-Encoding': 'gzip'})
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert 'Accept-Encoding' in response.headers['Vary']
+        assert gzip.decompress(response.data) == plain.data
+        assert response.headers['ETag'] != plain.headers['ETag']
+
+        again = client.get('/api/products', headers={'Accept-Encoding': 'gzip', 'If-None-Match': response.headers['ETag']})
+        assert again.status_code == 304
+
+    def test_static_asset_precompressed(self, client):
+        """Test that static assets are served pre-compressed from cache with a per-route Cache-Control."""
+        import gzip
+        plain = client.get('/static/script.js')
+        response = client.get('/static/script.js', headers={'Accept-Encoding': 'gzip'})
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert gzip.decompress(response.data) == plain.data
+        assert response.headers['Cache-Control'] == app_module.app.config['CACHE_POLICIES']['static']
+        path = os.path.join(app_module.app.static_folder, 'script.js')
+        assert (path, 'gzip') in app_module.compressed_assets.entries
+        plain.close()
+
+        again = client.get('/static/script.js', headers={'Accept-Encoding': 'gzip', 'If-None-Match': response.headers['ETag']})
+        assert again.status_code == 304
+
+    def test_brotli_preferred_when_available(self, client):
+        """Test that br is chosen over gzip when the client accepts both."""
+        if app_module.brotli is None:
+            pytest.skip("brotli not installed")
+        response = client.get('/static/styles.css', headers={'Accept-Encoding': 'gzip, br'})
+        assert response.headers['Content-Encoding'] == 'br'
+        assert app_module.brotli.decompress(response.data) == open(os.path.join(app_module.app.static_folder, 'styles.css'), 'rb').read()
+
+class TestInstrumentation:
+
+    def test_metrics_histogram_and_query_counts(self, client, db_conn, monkeypatch):
+        """Test that /metrics reports per-endpoint latency buckets and SQL statement totals."""
+        monkeypatch.setitem(app_module.app.config, 'METRICS_TRUST_LOOPBACK', True)
+        product_id = add_product(db_conn, "Metered", "Desc", 100, 5, "metered.jpg")
+        response = client.get(f'/product?id={product_id}')
+        assert 'db;dur=' in response.headers['Server-Timing']
+
+        body = client.get('/metrics').get_data(as_text=True)
+        assert 'store_request_duration_seconds_count{endpoint="displayProduct"} 1' in body
+        assert 'store_request_duration_seconds_bucket{endpoint="displayProduct",le="+Inf"} 1' in body
+        assert 'store_requests_total{endpoint="displayProduct",method="GET",status="200"} 1' in body
+        queries = [line for line in body.splitlines() if line.startswith('store_sql_queries_total{endpoint="displayProduct"}')]
+        assert int(queries[0].split()[-1]) >= 1
+
+    def test_metrics_requires_admin_or_token(self, client, monkeypatch):
+        """Test that remote scrapers need the bearer token."""
+        monkeypatch.setitem(app_module.app.config, 'METRICS_TOKEN', 'scrape-me')
+        remote = {'REMOTE_ADDR': '203.0.113.9'}
+        assert client.get('/metrics', environ_base=remote).status_code == 403
+        response = client.get('/metrics', environ_base=remote, headers={'Authorization': 'Bearer scrape-me'})
+        assert response.status_code == 200
+
+    def test_metrics_loopback_trust_is_opt_in(self, client, monkeypatch):
+        """Test that a same-host proxy's 127.0.0.1 doesn't open /metrics unless configured to."""
+        local = {'REMOTE_ADDR': '127.0.0.1'}
+        assert client.get('/metrics', environ_base=local).status_code == 403
+        monkeypatch.setitem(app_module.app.config, 'METRICS_TRUST_LOOPBACK', True)
+        assert client.get('/metrics', environ_base=local).status_code == 200
+
+    def test_slow_query_logged(self, client, db_conn, monkeypatch, caplog):
+        """Test that statements over the threshold are logged with their text."""
+        monkeypatch.setitem(app_module.app.config, 'SLOW_QUERY_SECONDS', 0)
+        with caplog.at_level('WARNING', logger=app_module.app.logger.name):
+            client.get('/api/products')
+        assert any("slow query" in record.message and "FROM products" in record.message for record in caplog.records)
+
+    def test_lock_wait_not_logged_as_slow_query(self, monkeypatch, caplog):
+        """Test that a slow BEGIN IMMEDIATE is reported as a lock wait, not a slow query."""
+        monkeypatch.setitem(app_module.app.config, 'SLOW_QUERY_SECONDS', 0)
+        with caplog.at_level('INFO', logger=app_module.app.logger.name):
+            app_module.record_query("BEGIN IMMEDIATE;", 0.2)
+            app_module.record_query("SAVEPOINT entry;", 0.2)
+        assert not any("slow query" in record.message for record in caplog.records)
+        assert any("lock wait (200.0 ms): BEGIN IMMEDIATE;" in record.message for record in caplog.records)
+
+    def test_sampled_profile_dumped_over_threshold(self, client, tmp_path, monkeypatch):
+        """Test that a sampled request slower than the threshold leaves a .prof file."""
+        monkeypatch.setitem(app_module.app.config, 'PROFILE_SAMPLE_RATE', 1.0)
+        monkeypatch.setitem(app_module.app.config, 'PROFILE_THRESHOLD', 0)
+        monkeypatch.setitem(app_module.app.config, 'PROFILE_FOLDER', str(tmp_path))
+        client.get('/')
+        assert [name for name in os.listdir(tmp_path) if name.startswith('index-') and name.endswith('.prof')]
+
+
+class TestAsyncViews:
+
+    def test_storefront_view_is_unchanged_in_sync_mode(self, monkeypatch):
+        """Test that WSGI deployments keep the plain view function."""
+        monkeypatch.setitem(app_module.app.config, 'ASYNC_VIEWS', False)
+        view = lambda: "ok"
+        assert app_module.storefront_view(view) is view
+
+    def test_storefront_view_runs_on_db_executor(self, monkeypatch):
+        """Test that async mode turns a view into a coroutine whose body runs on a db thread."""
+        import asyncio
+        import inspect
+        monkeypatch.setitem(app_module.app.config, 'ASYNC_VIEWS', True)
+        wrapped = app_module.storefront_view(lambda: threading.current_thread().name)
+        assert inspect.iscoroutinefunction(wrapped)
+        assert asyncio.run(wrapped()).startswith("db")
+
+    def test_asgi_requests_run_concurrently(self, client, monkeypatch):
+        """Test that slow requests through asgi.application overlap instead of queueing on one thread."""
+        import asyncio
+        import asgi
+        delay, requests = 0.3, 4
+
+        def slow_page(*args):
+            time.sleep(delay)
+            return b"[]", "slow", {}
+        monkeypatch.setattr(app_module, 'product_page', slow_page)
+
+        async def get(path):
+            sent = []
+            async def receive():
+                return {"type": "http.request", "body": b""}
+            async def send(message):
+                sent.append(message)
+            scope = {"type": "http", "method": "GET", "path": path, "root_path": "", "query_string": b"limit=5",
+                     "http_version": "1.1", "headers": [], "scheme": "http", "server": ("localhost", 80)}
+            await asgi.application(scope, receive, send)
+            return sent[0]["status"]
+
+        async def burst():
+            return await asyncio.gather(*(get('/api/products') for _ in range(requests)))
+
+        started = time.perf_counter()
+        assert asyncio.run(burst()) == [200] * requests
+        assert time.perf_counter() - started < delay * (requests - 1)
+
+
+class TestConnectionPool:
+
+    def test_pool_reuses_released_connection(self, tmp_path):
+        """Test that a released connection is handed out again as a pool hit."""
+        pool = ConnectionPool(lambda: sqlite3.connect(tmp_path / "pool.db", check_same_thread=False), 2, 0.1)
+        conn = pool.acquire()
+        pool.release(conn)
+        assert pool.acquire() is conn
+        stats = pool.stats()
+        assert stats["misses"] == 1
+        assert stats["hits"] == 1
+        pool.close_all()
+
+    def test_pool_is_bounded(self, tmp_path):
+        """Test that acquiring beyond the pool size waits and then times out."""
+        pool = ConnectionPool(lambda: sqlite3.connect(tmp_path / "pool.db", check_same_thread=False), 1, 0.05)
+        conn = pool.acquire()
+        with pytest.raises(PoolTimeout):
+            pool.acquire()
+        assert pool.stats()["waits"] == 1
+        assert pool.stats()["timeouts"] == 1
+        pool.release(conn)
+
+    def test_pool_rolls_back_uncommitted_work(self, tmp_path):
+        """Test that releasing a connection discards an open transaction."""
+        pool = ConnectionPool(lambda: sqlite3.connect(tmp_path / "pool.db", check_same_thread=False), 1, 0.1)
+        conn = pool.acquire()
+        conn.execute("CREATE TABLE t (x INTEGER);")
+        conn.commit()
+        conn.execute("INSERT INTO t VALUES (1);")
+        pool.release(conn)
+        assert pool.acquire().execute("SELECT COUNT(*) FROM t;").fetchone()[0] == 0
+        pool.close_all()
+
+    def test_pool_closes_unhealthy_connection(self, tmp_path):
+        """Test that an idle connection failing its health check is closed before being replaced."""
+        class Tracked(sqlite3.Connection):
+            closed_by_pool = False
+            def close(self):
+                self.closed_by_pool = True
+                super().close()
+
+        pool = ConnectionPool(lambda: sqlite3.connect(tmp_path / "pool.db", check_same_thread=False), 1, 0.1)
+        broken = sqlite3.connect(tmp_path / "pool.db", check_same_thread=False, factory=Tracked)
+        pool.opened = 1
+        pool.release(broken)
+        sqlite3.Connection.close(broken) # fails the health check from now on
+
+        conn = pool.acquire()
+        assert conn is not broken
+        assert broken.closed_by_pool
+        assert pool.stats()["discarded"] == 1
+        pool.release(conn)
+        pool.close_all()
+
+    def test_health_check_not_counted_as_a_query(self, tmp_path, monkeypatch):
+        """Test that the pool's ping stays out of query counts and the slow-query log."""
+        recorded = []
+        monkeypatch.setattr(app_module, 'record_query', lambda sql, elapsed: recorded.append(sql))
+        conn = sqlite3.connect(tmp_path / "ping.db", check_same_thread=False, factory=app_module.InstrumentedConnection)
+        assert ConnectionPool(lambda: conn, 1, 0.1).healthy(conn)
+        assert recorded == []
+        conn.close()
+
+    def test_pragmas_applied_to_new_connections(self, tmp_path):
+        """Test that get_db_connection applies the configured PRAGMAs."""
+        app_module.app.config['DATABASE'] = str(tmp_path / "pragma.db")
+        try:
+            conn = app_module.get_db_connection()
+            assert conn.execute("PRAGMA journal_mode;").fetchone()[0] == "wal"
+            assert conn.execute("PRAGMA cache_size;").fetchone()[0] == -8000
+            conn.close()
+        finally:
+            app_module.app.config['DATABASE'] = 'app.db'
+
+    def test_pool_stats_requires_admin(self, client):
+        """Test that pool metrics are only exposed to admins."""
+        response = client.get('/admin/dbpool')
+        assert response.status_code == 403
+
+        with client.session_transaction() as sess:
+            sess['username'] = 'admin'
+            sess['privilege'] = 'admin'
+        response = client.get('/admin/dbpool')
+        assert response.status_code == 200
+        assert {"hits", "misses", "waits", "in_use"} <= set(response.json)
+
+
+
+class TestOrderFulfilment:
+
+    def place(self, db_conn, username, stock=10, quantity=2, price=500):
+        user_id = add_user(db_conn, username, "password")
+        product_id = add_product(db_conn, "Fulfilment Product", "Desc", price, stock, "fulfil.jpg")
+        line = app_module.BasketLine(product_id, "Fulfilment Product", price, "fulfil.jpg", stock, quantity)
+        orderid = app_module.run_transaction(db_conn, lambda cursor: app_module.place_order(cursor, user_id, "addr", [line]))
+        return orderid, product_id
+
+    def order_state(self, db_conn, orderid):
+        return db_conn.execute("SELECT o.status, j.status, j.attempts, j.error FROM orders o JOIN orderjobs j ON j.orderid = o.orderid WHERE o.orderid = ?;", (orderid,)).fetchone()
+
+    def test_checkout_only_queues_the_order(self, client, db_conn, monkeypatch):
+        """Test that checkout leaves the order ORDERED with a queued job, whatever the processor costs."""
+        monkeypatch.setitem(app_module.app.config, 'STUB_PROCESSOR_DELAY', 5)
+        add_user(db_conn, "queued", "password")
+        product_id = add_product(db_conn, "Queued Product", "Desc", 500, 10, "queued.jpg")
+        with client.session_transaction() as sess:
+            sess['username'] = 'queued'
+            sess['privilege'] = 'user'
+            set_basket(db_conn, sess, {str(product_id): 1})
+
+        response = client.post('/checkout', data={'addr_l1': '1 St', 'addr_city': 'Town', 'addr_postcode': 'T1', 'payment_cvv': '123'})
+        assert b"Order Placed" in response.data
+        orderid = db_conn.execute("SELECT orderid FROM orders;").fetchone()[0]
+        assert self.order_state(db_conn, orderid) == ("ORDERED", "queued", 0, None)
+
+    def test_order_advances_through_each_step(self, client, db_conn):
+        """Test that worker rounds take an order from ORDERED to PAID to DISPATCHED."""
+        orderid, _ = self.place(db_conn, "advance")
+
+        assert app_module.process_order_jobs(db_conn) == {"PAID": 1}
+        assert self.order_state(db_conn, orderid) == ("PAID", "queued", 0, None)
+        assert app_module.process_order_jobs(db_conn) == {"DISPATCHED": 1}
+        assert self.order_state(db_conn, orderid) == ("DISPATCHED", "done", 1, None)
+        assert app_module.process_order_jobs(db_conn) == {}
+
+    def test_declined_payment_restocks(self, client, db_conn, monkeypatch):
+        """Test that a declined payment fails the order at once and puts its stock back."""
+        monkeypatch.setitem(app_module.app.config, 'STUB_PAYMENT_LIMIT', 999)
+        orderid, product_id = self.place(db_conn, "declined", stock=5, quantity=2)
+        assert app_module.stock_levels(db_conn.cursor(), [product_id]) == {product_id: 3}
+
+        assert app_module.process_order_jobs(db_conn) == {"PAYMENT_FAILED": 1}
+        assert self.order_state(db_conn, orderid) == ("PAYMENT_FAILED", "failed", 1, "payment declined")
+        assert app_module.stock_levels(db_conn.cursor(), [product_id]) == {product_id: 5}
+
+    def test_transient_errors_retry_then_give_up(self, client, db_conn, monkeypatch):
+        """Test that failing steps are retried with backoff and failed after ORDER_JOB_ATTEMPTS."""
+        class Flaky:
+            def payment(self, order):
+                raise ConnectionError("gateway timeout")
+        monkeypatch.setitem(app_module.order_processors, 'flaky', Flaky())
+        monkeypatch.setitem(app_module.app.config, 'ORDER_PROCESSOR', 'flaky')
+        monkeypatch.setitem(app_module.app.config, 'ORDER_JOB_ATTEMPTS', 2)
+        orderid, product_id = self.place(db_conn, "flaky", stock=5, quantity=1)
+
+        assert app_module.process_order_jobs(db_conn) == {"retrying": 1}
+        assert self.order_state(db_conn, orderid) == ("ORDERED", "queued", 1, "gateway timeout")
+        assert app_module.process_order_jobs(db_conn) == {} # backing off
+
+        db_conn.execute("UPDATE orderjobs SET run_after = datetime('now', '-1 seconds');")
+        db_conn.commit()
+        assert app_module.process_order_jobs(db_conn) == {"PAYMENT_FAILED": 1}
+        assert self.order_state(db_conn, orderid) == ("PAYMENT_FAILED", "failed", 2, "gateway timeout")
+        assert app_module.stock_levels(db_conn.cursor(), [product_id]) == {product_id: 5}
+
+    def test_claims_are_batched_and_exclusive(self, client, db_conn):
+        """Test that workers claim disjoint batches and reclaim jobs whose lease ran out."""
+        orderids = [self.place(db_conn, f"batch{n}")[0] for n in range(3)]
+
+        first = app_module.claim_order_jobs(db_conn, 2)
+        second = app_module.claim_order_jobs(db_conn, 2)
+        assert sorted(first) == orderids[:2]
+        assert list(second) == orderids[2:]
+        assert app_module.claim_order_jobs(db_conn, 2) == {}
+
+        db_conn.execute("UPDATE orderjobs SET claimed_at = datetime('now', '-1 hours') WHERE orderid = ?;", (orderids[0],))
+        db_conn.commit()
+        assert app_module.claim_order_jobs(db_conn, 2) == {orderids[0]: 2}
+
+    def test_fulfil_orders_cli_drains_queue(self, client, db_conn):
+        """Test that flask fulfil-orders runs rounds until nothing is due."""
+        orderid, _ = self.place(db_conn, "cli")
+        result = app_module.app.test_cli_runner().invoke(args=['fulfil-orders'])
+        assert result.exit_code == 0
+        assert "1 paid" in result.output and "1 dispatched" in result.output
+        assert self.order_state(db_conn, orderid)[0] == "DISPATCHED"
+
+class TestStockLedger:
+
+    def test_checkout_appends_to_ledger_until_compaction(self, client, db_conn, monkeypatch):
+        """Test that a sale leaves the products row alone until compact_stock() folds it in."""
+        monkeypatch.setitem(app_module.app.config, 'STOCK_LEDGER', True)
+        monkeypatch.setitem(app_module.app.config, 'STOCK_COMPACT_INTERVAL', 3600) # the checkout mustn't compact on its own
+        monkeypatch.setitem(app_module.stock_compaction, "last", time.monotonic())
+        add_user(db_conn, "ledger", "password")
+        product_id = add_product(db_conn, "Ledger Product", "Desc", 500, 10, "ledger.jpg")
+        app_module.compact_stock(db_conn)
+        with client.session_transaction() as sess:
+            sess['username'] = 'ledger'
+            sess['privilege'] = 'user'
+            set_basket(db_conn, sess, {str(product_id): 3})
+
+        assert b"Order Placed" in client.post('/checkout', data={'addr_l1': '1 Ledger St'}).data
+        assert db_conn.execute("SELECT stock, version FROM products WHERE itemid = ?;", (product_id,)).fetchone() == (10, 1)
+        assert db_conn.execute("SELECT itemid, quantity, kind FROM stockmovements;").fetchall() == [(product_id, -3, 'sale')]
+        assert app_module.stock_levels(db_conn.cursor(), [product_id]) == {product_id: 7}
+
+        assert app_module.compact_stock(db_conn) == [product_id]
+        assert db_conn.execute("SELECT stock, version FROM products WHERE itemid = ?;", (product_id,)).fetchone() == (7, 2)
+        assert app_module.stock_levels(db_conn.cursor(), [product_id]) == {product_id: 7}
+        assert app_module.compact_stock(db_conn) == []
+
+    def test_sale_inside_interval_compacted_by_timer(self, client, db_conn, monkeypatch):
+        """Test that a sale made just after a compaction reaches products.stock without another checkout."""
+        add_user(db_conn, "timed", "password")
+        product_id = add_product(db_conn, "Timed Product", "Desc", 500, 10, "timed.jpg")
+        with client.session_transaction() as sess:
+            sess['username'] = 'timed'
+            sess['privilege'] = 'user'
+            set_basket(db_conn, sess, {str(product_id): 2})
+
+        monkeypatch.setitem(app_module.app.config, 'STOCK_LEDGER', True)
+        monkeypatch.setitem(app_module.app.config, 'STOCK_COMPACT_INTERVAL', 0.5)
+        monkeypatch.setitem(app_module.stock_compaction, "last", time.monotonic()) # as if a compaction just ran
+        assert b"Order Placed" in client.post('/checkout', data={'addr_l1': '1 Timer St'}).data
+        assert db_conn.execute("SELECT stock FROM products WHERE itemid = ?;", (product_id,)).fetchone()[0] == 10
+        deadline = time.monotonic() + 5
+        while db_conn.execute("SELECT stock FROM products WHERE itemid = ?;", (product_id,)).fetchone()[0] != 8:
+            assert time.monotonic() < deadline, "timer never compacted the sale"
+            time.sleep(0.05)
+
+    def test_fulfil_orders_watch_compacts_with_empty_queue(self, client, db_conn, monkeypatch):
+        """Test that the order worker folds in the ledger even when no orders are due."""
+        monkeypatch.setitem(app_module.app.config, 'STOCK_COMPACT_INTERVAL', 0)
+        product_id = add_product(db_conn, "Watched Product", "Desc", 100, 5, "watched.jpg")
+        db_conn.execute("INSERT INTO stockmovements (itemid, quantity, kind) VALUES (?, -2, 'sale');", (product_id,))
+        db_conn.commit()
+
+        def stop(seconds):
+            raise KeyboardInterrupt # leave the --watch loop after its first idle round
+        monkeypatch.setattr(app_module.time, 'sleep', stop)
+        app_module.app.test_cli_runner().invoke(args=['fulfil-orders', '--watch'])
+        assert db_conn.execute("SELECT stock FROM products WHERE itemid = ?;", (product_id,)).fetchone()[0] == 3
+
+    def test_group_commit_rolls_back_only_the_failing_entry(self, client, db_conn):
+        """Test that one buyer's OutOfStock inside a shared transaction doesn't undo the others."""
+        user_id = add_user(db_conn, "grouped", "password")
+        product_id = add_product(db_conn, "Grouped Product", "Desc", 100, 3, "grouped.jpg")
+        line = lambda quantity: app_module.BasketLine(product_id, "Grouped Product", 100, "grouped.jpg", 3, quantity)
+        batch = [{"work": lambda cursor, quantity=quantity: app_module.place_order(cursor, user_id, "addr", [line(quantity)]), "done": False}
+                 for quantity in (2, 2, 1)]
+
+        commits = app_module.checkout_commits.metrics["commits"]
+        app_module.checkout_commits.commit(db_conn, batch)
+        assert app_module.checkout_commits.metrics["commits"] == commits + 1
+        assert [entry["done"] for entry in batch] == [True, True, True]
+        assert isinstance(batch[1]["error"], app_module.OutOfStock)
+        assert batch[0]["error"] is None and batch[2]["error"] is None
+        assert db_conn.execute("SELECT COUNT(*) FROM orders;").fetchone()[0] == 2
+        assert app_module.stock_levels(db_conn.cursor(), [product_id]) == {product_id: 0}
+
+    def test_basket_clamped_to_ledger_stock(self, client, db_conn):
+        """Test that basket clamping sees ledger movements that aren't compacted yet."""
+        product_id = add_product(db_conn, "Clamped Product", "Desc", 100, 5, "clamped.jpg")
+        db_conn.execute("INSERT INTO stockmovements (itemid, quantity, kind) VALUES (?, -4, 'sale');", (product_id,))
+        db_conn.commit()
+
+        client.post('/basket', data={'itemid': product_id, 'quantity': 3})
+        assert saved_basket(client, db_conn) == {str(product_id): 1}
+
+    def test_ledger_shortfall_names_only_short_lines(self, client, db_conn, monkeypatch):
+        """Test that a line short of ledger stock fails the order after earlier lines' movements went in, naming just that line."""
+        monkeypatch.setitem(app_module.app.config, 'STOCK_LEDGER', True)
+        plenty = add_product(db_conn, "Plenty", "Desc", 100, 10, "plenty.jpg")
+        scarce = add_product(db_conn, "Scarce", "Desc", 100, 5, "scarce.jpg")
+        db_conn.execute("INSERT INTO stockmovements (itemid, quantity, kind) VALUES (?, -4, 'sale');", (scarce,))
+        db_conn.commit()
+        lines = [app_module.BasketLine(plenty, "Plenty", 100, "plenty.jpg", 10, 3), app_module.BasketLine(scarce, "Scarce", 100, "scarce.jpg", 5, 2)]
+
+        with app_module.app.test_request_context('/checkout'):
+            with pytest.raises(app_module.OutOfStock) as error:
+                app_module.run_transaction(app_module.get_db(), lambda cursor: app_module.place_order(cursor, 1, "addr", lines))
+        assert [line.itemid for line in error.value.lines] == [scarce]
+        assert db_conn.execute("SELECT COUNT(*) FROM stockmovements;").fetchone()[0] == 1
+        assert db_conn.execute("SELECT COUNT(*) FROM orders;").fetchone()[0] == 0
+
+    def test_restock_cli_appends_movement(self, client, db_conn):
+        """Test that flask restock adds a restock movement and reports the new level."""
+        product_id = add_product(db_conn, "Restocked Product", "Desc", 100, 2, "restocked.jpg")
+        result = app_module.app.test_cli_runner().invoke(args=['restock', str(product_id), '5'])
+        assert result.exit_code == 0
+        assert "7 available" in result.output
+        assert app_module.app.test_cli_runner().invoke(args=['restock', str(product_id), '0']).exit_code != 0
+
+class TestSalesReports:
+
+    def order(self, db_conn, user_id, *lines):
+        basket = [app_module.BasketLine(itemid, "Item", price, "item.jpg", 100, quantity) for itemid, price, quantity in lines]
+        return app_module.run_transaction(db_conn, lambda cursor: app_module.place_order(cursor, user_id, "addr", basket))
+
+    def summaries(self, db_conn):
+        return {table: db_conn.execute(f"SELECT * FROM {table} ORDER BY 1, 2;").fetchall()
+                for table in ('productsalesdays', 'productsales', 'salesdays', 'usersales')}
+
+    def admin(self, client):
+        with client.session_transaction() as sess:
+            sess['username'] = 'admin'
+            sess['privilege'] = 'admin'
+
+    def test_orders_update_summaries_and_reports(self, client, db_conn):
+        """Test that placed orders feed the daily, top seller and customer reports."""
+        alice, bob = add_user(db_conn, "alice", "password"), add_user(db_conn, "bob", "password")
+        kettle = add_product(db_conn, "Kettle", "Desc", 2000, 100, "kettle.jpg")
+        teapot = add_product(db_conn, "Teapot", "Desc", 500, 100, "teapot.jpg")
+        self.order(db_conn, alice, (kettle, 2000, 1), (teapot, 500, 4))
+        self.order(db_conn, bob, (teapot, 500, 1))
+
+        assert client.get('/admin/reports/sales').status_code == 403
+        self.admin(client)
+        sales = client.get('/admin/reports/sales').json
+        assert sales["totals"] == {"orders": 2, "units": 6, "revenue": 4500}
+        assert len(sales["daily"]) == 1
+
+        by_units = client.get('/admin/reports/top-sellers').json
+        assert [(row["name"], row["units"], row["revenue"]) for row in by_units] == [("Teapot", 5, 2500), ("Kettle", 1, 2000)]
+        assert client.get('/admin/reports/top-sellers?by=revenue&limit=1').json[0]["name"] == "Teapot"
+        assert client.get('/admin/reports/top-sellers?by=price').status_code == 400
+
+        product = client.get(f'/admin/reports/products/{teapot}').json
+        assert product["totals"] == {"orders": 2, "units": 5, "revenue": 2500}
+        customers = client.get('/admin/reports/customers').json
+        assert [(row["username"], row["orders"], row["spent"]) for row in customers] == [("alice", 1, 4000), ("bob", 1, 500)]
+
+    def test_rebuild_matches_incremental_summaries(self, client, db_conn):
+        """Test that flask rebuild-sales recomputes exactly what checkouts maintained."""
+        user_id = add_user(db_conn, "rebuild", "password")
+        first = add_product(db_conn, "First", "Desc", 300, 100, "first.jpg")
+        second = add_product(db_conn, "Second", "Desc", 700, 100, "second.jpg")
+        self.order(db_conn, user_id, (first, 300, 2))
+        self.order(db_conn, user_id, (first, 300, 1), (second, 700, 3))
+        incremental = self.summaries(db_conn)
+
+        result = app_module.app.test_cli_runner().invoke(args=['rebuild-sales'])
+        assert result.exit_code == 0
+        assert "from 2 orders over 1 days" in result.output
+        assert self.summaries(db_conn) == incremental
+
+    def test_failed_payment_leaves_the_reports(self, client, db_conn, monkeypatch):
+        """Test that a declined order is taken back out of the summaries."""
+        monkeypatch.setitem(app_module.app.config, 'STUB_PAYMENT_LIMIT', 1000)
+        user_id = add_user(db_conn, "decliner", "password")
+        product_id = add_product(db_conn, "Pricey", "Desc", 900, 100, "pricey.jpg")
+        self.order(db_conn, user_id, (product_id, 900, 1))
+        self.order(db_conn, user_id, (product_id, 900, 2))
+
+        assert app_module.process_order_jobs(db_conn) == {"PAID": 1, "PAYMENT_FAILED": 1}
+        assert db_conn.execute("SELECT orders, units, revenue FROM productsales;").fetchall() == [(1, 1, 900)]
+        assert db_conn.execute("SELECT orders, spent FROM usersales;").fetchall() == [(1, 900)]
+        incremental = self.summaries(db_conn)
+        app_module.rebuild_sales(db_conn)
+        assert self.summaries(db_conn) == incremental
+
+    def test_top_sellers_read_from_index(self, client, db_conn):
+        """Test that the top sellers query walks the index instead of sorting every product."""
+        for by in ('units', 'revenue'):
+            plan = " | ".join(row[-1] for row in db_conn.execute(
+                f"EXPLAIN QUERY PLAN SELECT s.productid, p.name FROM productsales s LEFT JOIN products p ON p.itemid = s.productid ORDER BY s.{by} DESC, s.productid LIMIT 10;"))
+            assert f"idx_productsales_{by}" in plan
+            assert "TEMP B-TREE" not in plan
+
+class TestRelatedProducts:
+
+    def order(self, db_conn, user_id, *itemids):
+        basket = [app_module.BasketLine(itemid, "Item", 100, "item.jpg", 100, 1) for itemid in itemids]
+        return app_module.run_transaction(db_conn, lambda cursor: app_module.place_order(cursor, user_id, "addr", basket))
+
+    def test_related_products_ranked_and_cached(self, client, db_conn):
+        """Test that /api/products/<id>/related ranks co-purchases and answers warm requests without sql."""
+        user_id = add_user(db_conn, "related", "password")
+        kettle, teapot, cups, toaster = [add_product(db_conn, name, "Desc", 100, 100, "item.jpg") for name in ("Kettle", "Teapot", "Cups", "Toaster")]
+        self.order(db_conn, user_id, kettle, teapot, cups)
+        self.order(db_conn, user_id, kettle, cups)
+        self.order(db_conn, user_id, kettle, toaster)
+        self.order(db_conn, user_id, kettle, cups)
+
+        response = client.get(f'/api/products/{kettle}/related')
+        assert [product["name"] for product in response.json] == ["Cups", "Teapot", "Toaster"]
+        assert [product["name"] for product in client.get(f'/api/products/{teapot}/related').json] == ["Kettle", "Cups"] # ties go to the lower id
+
+        warm = client.get(f'/api/products/{kettle}/related')
+        assert warm.data == response.data
+        assert 'desc="0 queries"' in warm.headers['Server-Timing']
+        assert client.get(f'/api/products/{kettle}/related', headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+        assert b"loadRelatedProducts(%d)" % kettle in client.get(f'/product?id={kettle}').data
+
+    def test_rebuild_matches_incremental_counts(self, client, db_conn, monkeypatch):
+        """Test that flask rebuild-related streams history into the same counts checkouts maintained."""
+        monkeypatch.setitem(app_module.app.config, 'RELATED_REBUILD_BATCH', 2) # flush mid-pass
+        monkeypatch.setitem(app_module.app.config, 'RELATED_ORDER_LINES_MAX', 3)
+        user_id = add_user(db_conn, "rebuilder", "password")
+        ids = [add_product(db_conn, f"Item {n}", "Desc", 100, 100, "item.jpg") for n in range(5)]
+        self.order(db_conn, user_id, ids[0], ids[1])
+        self.order(db_conn, user_id, ids[1], ids[2], ids[3])
+        self.order(db_conn, user_id, *ids) # too big to count
+        self.order(db_conn, user_id, ids[4])
+        counts = db_conn.execute("SELECT * FROM copurchases ORDER BY productid, relatedid;").fetchall()
+        assert len(counts) == 8
+
+        result = app_module.app.test_cli_runner().invoke(args=['rebuild-related'])
+        assert result.exit_code == 0
+        assert "from 4 orders, 8 product pairs" in result.output
+        assert db_conn.execute("SELECT * FROM copurchases ORDER BY productid, relatedid;").fetchall() == counts
+
+class TestHomeGrid:
+
+    def test_first_page_rendered_from_catalog_cache(self, client, db_conn, monkeypatch):
+        """Test that index() renders the first grid page with preload hints and shares /api/products?limit=24's cache entry."""
+        monkeypatch.setitem(app_module.app.config, 'HOME_PAGE_SIZE', 3)
+        monkeypatch.setitem(app_module.app.config, 'HOME_PRELOAD_IMAGES', 2)
+        ids = [add_product(db_conn, f"Grid {n}", "Desc", 1050, 10, f"grid{n}.jpg") for n in range(4)]
+        db_conn.execute("INSERT INTO imagevariants (image, width, format, filename) VALUES ('grid3.jpg', 320, 'avif', 'grid3-320.avif');")
+        db_conn.commit()
+
+        page = client.get('/').data.decode()
+        assert [name in page for name in ("Grid 3", "Grid 2", "Grid 1", "Grid 0")] == [True, True, True, False]
+        assert "£10.50" in page
+        assert f'data-next-cursor="{ids[1]}"' in page
+        assert 'type="image/avif" imagesrcset="/static/uploads/grid3-320.avif 320w"' in page
+        assert 'rel="preload" as="image" href="../static/uploads/grid2.jpg"' in page
+        assert "grid1.jpg" in page and 'href="../static/uploads/grid1.jpg"' not in page # past the first row
+        assert page.count('fetchpriority="high"') == 4 and page.count('loading="lazy"') == 1
+
+        api = client.get('/api/products?limit=3')
+        assert 'desc="0 queries"' in api.headers['Server-Timing']
+        assert api.headers['X-Next-Cursor'] == str(ids[1])
+
+    def test_imageless_products_not_preloaded(self, client, db_conn):
+        """Test that a first-row product without an image gets no preload hint and a lazy <img>."""
+        add_product(db_conn, "No Picture", "Desc", 100, 10, "")
+        page = client.get('/').data.decode()
+        assert "No Picture" in page
+        assert 'rel="preload"' not in page
+        assert 'fetchpriority="high"' not in page
+
+    def test_home_etag_follows_catalog(self, client, db_conn):
+        """Test that the home page revalidates to 304 until the rendered products change."""
+        add_product(db_conn, "Before", "Desc", 100, 10, "before.jpg")
+        etag = client.get('/').headers['ETag']
+        assert client.get('/', headers={'If-None-Match': etag}).status_code == 304
+
+        add_product(db_conn, "After", "Desc", 100, 10, "after.jpg")
+        app_module.catalog_cache.invalidate() # what addProduct does after committing
+        response = client.get('/', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert b"After" in response.data
+
+class TestCheckoutConcurrency:
+
+    @pytest.mark.parametrize("ledger", [True, False])
+    def test_concurrent_buyers_never_oversell(self, client, db_conn, monkeypatch, ledger):
+        """Load test: N buyers race for fewer items than there are buyers, with and without the stock ledger."""
+        monkeypatch.setitem(app_module.app.config, 'STOCK_LEDGER', ledger)
+        buyers, stock = 16, 5
+        add_user(db_conn, "racer", "password")
+        product_id = add_product(db_conn, "Flash Sale", "Desc", 1000, stock, "flash.jpg")
+        barrier = threading.Barrier(buyers)
+        results = []
+
+        sessions = []
+        for _ in range(buyers):
+            sess = {'username': 'racer', 'privilege': 'user'}
+            set_basket(db_conn, sess, {str(product_id): 1})
+            sessions.append(sess)
+
+        def buy():
+            with app_module.app.test_client() as buyer:
+                with buyer.session_transaction() as sess:
+                    sess.update(sessions.pop())
+                barrier.wait()
+                response = buyer.post('/checkout', data={'addr_l1': '1 Race St'})
+                results.append((response.status_code, b"Error:" not in response.data))
+
+        threads = [threading.Thread(target=buy) for _ in range(buyers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert all(status == 200 for status, _ in results)
+        assert sum(placed for _, placed in results) == stock
+        assert app_module.stock_levels(db_conn.cursor(), [product_id]) == {product_id: 0}
+        assert db_conn.execute("SELECT COUNT(*) FROM orders;").fetchone()[0] == stock
+        assert db_conn.execute("SELECT SUM(quantity) FROM orderitems;").fetchone()[0] == stock
+
+
+
+class TestMigrations:
+
+    def test_migrate_is_ordered_and_idempotent(self, tmp_path):
+        """Test that migrations apply once, in order, and record schema_version."""
+        conn = sqlite3.connect(tmp_path / "migrate.db")
+        applied = app_module.migrate(conn)
+        assert [version for version, _ in applied] == sorted(version for version, _ in applied)
+        assert applied[0] == (1, "baseline")
+        assert app_module.migrate(conn) == []
+        versions = [row[0] for row in conn.execute("SELECT version FROM schema_version ORDER BY version;")]
+        assert versions == [version for version, _ in applied]
+        conn.close()
+
+    def test_failed_migration_rolls_back(self, tmp_path, monkeypatch):
+        """Test that a broken migration leaves neither its changes nor a version row."""
+        folder = tmp_path / "migrations"
+        folder.mkdir()
+        (folder / "0001_good.sql").write_text("CREATE TABLE good (x INTEGER);")
+        (folder / "0002_bad.sql").write_text("CREATE TABLE half (x INTEGER);\nCREATE TABLE good (x INTEGER);")
+        monkeypatch.setitem(app_module.app.config, 'MIGRATIONS_FOLDER', str(folder))
+
+        conn = sqlite3.connect(tmp_path / "broken.db")
+        with pytest.raises(sqlite3.OperationalError):
+            app_module.migrate(conn)
+        assert conn.execute("SELECT MAX(version) FROM schema_version;").fetchone()[0] == 1
+        assert conn.execute("SELECT name FROM sqlite_master WHERE name = 'half';").fetchone() is None
+        conn.close()
+
+    def test_migration_applied_by_another_process_is_skipped(self, tmp_path, monkeypatch):
+        """Test that a migration another process committed while we waited is skipped, not run twice."""
+        folder = tmp_path / "migrations"
+        folder.mkdir()
+        (folder / "0001_first.sql").write_text("CREATE TABLE first (x INTEGER);")
+        (folder / "0002_second.sql").write_text("ALTER TABLE first ADD COLUMN y INTEGER;")
+        monkeypatch.setitem(app_module.app.config, 'MIGRATIONS_FOLDER', str(folder))
+        path = tmp_path / "raced.db"
+        listed = app_module.list_migrations
+
+        def racing():
+            # the other process gets in after we've read schema_version
+            other = sqlite3.connect(path)
+            other.executescript("CREATE TABLE first (x INTEGER, y INTEGER);"
+                                "INSERT INTO schema_version (version, name) VALUES (1, 'first'), (2, 'second');")
+            other.close()
+            return listed()
+        monkeypatch.setattr(app_module, 'list_migrations', racing)
+
+        conn = sqlite3.connect(path)
+        assert app_module.migrate(conn) == []
+        assert conn.execute("SELECT COUNT(*) FROM schema_version;").fetchone()[0] == 2
+        conn.close()
+
+    def test_first_request_migrates_schema(self, client, tmp_path, monkeypatch):
+        """Test that a process brings an old database up to date before serving from it."""
+        path = tmp_path / "fresh.db"
+        monkeypatch.setattr(app_module, 'schema_migrated', False)
+        monkeypatch.setattr(app_module, 'get_db_connection', lambda: sqlite3.connect(path, check_same_thread=False, factory=app_module.InstrumentedConnection))
+        app_module.db_pool.close_all()
+        try:
+            assert client.get('/api/products').status_code == 200
+        finally:
+            app_module.db_pool.close_all()
+        conn = sqlite3.connect(path)
+        assert conn.execute("SELECT MAX(version) FROM schema_version;").fetchone()[0] == app_module.list_migrations()[-1][0]
+        conn.close()
+
+    def test_username_is_unique(self, client, db_conn):
+        """Test the unique index on users.username."""
+        add_user(db_conn, "onlyonce", "password")
+        with pytest.raises(sqlite3.IntegrityError):
+            add_user(db_conn, "onlyonce", "password")
+
+    def test_order_history_query_uses_indexes(self, client, db_conn):
+        """Test that the order-history join no longer scans orders or users."""
+        with open(os.path.join(app_module.app.root_path, 'queries', 'order_history.sqlite3-query')) as f:
+            query = f.read().split('\n', 1)[1] # drop the "-- database:" header
+        plan = " | ".join(row[-1] for row in db_conn.execute("EXPLAIN QUERY PLAN " + query))
+        assert "idx_users_username" in plan
+        assert "idx_orders_user_placed" in plan
+        assert "SCAN o" not in plan